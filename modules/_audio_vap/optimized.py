@@ -0,0 +1,120 @@
+import json
+import torch
+import torch.nn as nn
+from torch import Tensor
+
+from vap.objective import VAPObjective
+from _audio_vap.VAP import VAP
+from _audio_vap.encoder import EncoderCPC
+from _audio_vap.modules import TransformerStereo
+
+# Metadata stored in the artifact next to the TorchScript graph
+META_FILENAME = "remdis_vap.json"
+
+
+def load_checkpoint_model(filename: str, map_location="cpu") -> VAP:
+    """VAP(EncoderCPC(), TransformerStereo()) from a Lightning checkpoint"""
+    model = VAP(EncoderCPC(), TransformerStereo())
+    ckpt = torch.load(filename, map_location=map_location)["state_dict"]
+    restored_ckpt = {}
+    for k, v in ckpt.items():
+        restored_ckpt[k.replace("model.", "")] = v
+    model.load_state_dict(restored_ckpt)
+    model.eval()
+    return model
+
+
+class VAPLogits(nn.Module):
+    """VAP.forward returning only (logits, vad) so that it can be traced"""
+
+    def __init__(self, model: VAP):
+        super().__init__()
+        self.model = model
+
+    def forward(self, waveform: Tensor) -> tuple[Tensor, Tensor]:
+        out = self.model(waveform)
+        return out["logits"], out["vad"]
+
+
+def export_vap(
+    model: VAP,
+    filename: str,
+    num_samples: int,
+    quantize: bool = True,
+    source: str = "",
+    device: str = "cpu",
+) -> None:
+    """
+    Save an inference artifact of `model` for (1, 2, num_samples) inputs.
+
+    * quantize: dynamic int8 quantization of the Linear/LSTM/GRU layers (CPU only)
+    * The graph is traced with TorchScript. The aLiBi masks and the input length are fixed at
+      `num_samples`, so the artifact has to be used with the same VAP.buffer_length.
+    * The traced graph keeps the tensors created during tracing on `device`, so the artifact
+      has to be run on the device it was traced on (stored in the metadata).
+    """
+    device = torch.device(device)
+    if quantize and device.type != "cpu":
+        raise ValueError(f"Quantized VAP artifacts can only be traced on cpu (got {device})")
+    model = model.to(device).eval()
+    if quantize:
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {nn.Linear, nn.LSTM, nn.GRU}, dtype=torch.qint8
+        )
+    example = torch.zeros(1, 2, num_samples, device=device)
+    with torch.no_grad():
+        traced = torch.jit.trace(VAPLogits(model), example, check_trace=False)
+    meta = {
+        "num_samples": num_samples,
+        "sample_rate": model.sample_rate,
+        "frame_hz": model.frame_hz,
+        "bin_times": list(getattr(model.objective, "bin_times", [0.2, 0.4, 0.6, 0.8])),
+        "quantized": quantize,
+        "source": source,
+        "device": str(device),
+    }
+    torch.jit.save(traced, filename, _extra_files={META_FILENAME: json.dumps(meta)})
+
+
+class OptimizedVAP(nn.Module):
+    """
+    Loads an artifact saved by `export_vap`. `probs` returns the same outputs as VAP.probs.
+
+    The graph is loaded on the device it was traced on (`device`); inputs have to be moved there.
+    """
+
+    entropy = VAP.entropy
+    aggregate_probs = VAP.aggregate_probs
+
+    def __init__(self, filename: str):
+        super().__init__()
+        extra_files = {META_FILENAME: ""}
+        self.net = torch.jit.load(filename, _extra_files=extra_files)
+        self.net.eval()
+        self.meta = json.loads(extra_files[META_FILENAME])
+        # Artifacts without the device were traced on cpu
+        self.device = torch.device(self.meta.get("device", "cpu"))
+        self.num_samples = self.meta["num_samples"]
+        self.frame_hz = self.meta["frame_hz"]
+        self.objective = VAPObjective(bin_times=self.meta["bin_times"], frame_hz=self.frame_hz)
+
+    @property
+    def sample_rate(self) -> int:
+        return self.meta["sample_rate"]
+
+    @torch.inference_mode()
+    def probs(
+        self,
+        waveform: Tensor,
+        now_lims: list[int] = [0, 1],
+        future_lims: list[int] = [2, 3],
+    ) -> dict[str, Tensor]:
+        logits, vad = self.net(waveform)
+        probs = logits.softmax(dim=-1)
+        ret = {
+            "probs": probs,
+            "vad": vad.sigmoid(),
+            "H": self.entropy(probs),
+        }
+        ret.update(self.aggregate_probs(probs, now_lims, future_lims))
+        return ret
@@ -0,0 +1,229 @@
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import Tensor
+from typing import Callable, Optional
+
+
+def conv_geometry(module: nn.Module, causal: bool = False) -> tuple[int, int, int]:
+    """
+    Geometry of the stacked Conv1d layers in `module` (in registration order).
+
+    Output frame j depends on the input samples [j * stride - left, j * stride - left + receptive_field - 1].
+    With `causal=True` every convolution is assumed to be left-padded by (kernel - 1) * dilation
+    (CConv1d) instead of using its symmetric `padding`.
+
+    Return:
+        stride, left, receptive_field
+    """
+    convs = [m for m in module.modules() if isinstance(m, nn.Conv1d)]
+    assert len(convs) > 0, f"No Conv1d layers in {module.__class__.__name__}"
+    stride, start, end = 1, 0, 0
+    for conv in reversed(convs):
+        k, s, d = conv.kernel_size[0], conv.stride[0], conv.dilation[0]
+        p = (k - 1) * d if causal else conv.padding[0]
+        start, end = start * s - p, end * s - p + d * (k - 1)
+        stride *= s
+    return stride, -start, end - start + 1
+
+
+class StreamingConv:
+    """
+    Runs a stack of strided convolutions over a stream chunk by chunk.
+
+    Only the input needed for the frames that have not been output yet (the receptive-field tail) is
+    kept. A frame is output once its whole receptive field has been received, so that it is not
+    affected by the zero padding at the end of the chunk and never has to be recomputed.
+    """
+
+    def __init__(
+        self,
+        fn: Callable[[Tensor], Tensor],
+        stride: int,
+        left: int,
+        receptive_field: int,
+        dim: int,
+    ):
+        self.fn = fn
+        self.stride = stride
+        self.left = left
+        self.receptive_field = receptive_field
+        self.dim = dim  # time dimension of the input and the output
+        self.reset()
+
+    def reset(self) -> None:
+        self.buffer: Optional[Tensor] = None
+        self.buffer_start = 0  # absolute index of buffer[0]
+        self.total = 0  # number of received samples
+        self.next_frame = 0
+
+    def chunk_start(self, frame: int) -> int:
+        # The first input index such that `frame` and later frames are computed without the chunk padding
+        return max(0, (frame - math.ceil(self.left / self.stride)) * self.stride)
+
+    def step(self, x: Tensor) -> Optional[Tensor]:
+        self.buffer = x if self.buffer is None else torch.cat((self.buffer, x), dim=self.dim)
+        self.total += x.size(self.dim)
+
+        # Last frame whose receptive field has been received
+        last_frame = (self.total - self.receptive_field + self.left) // self.stride
+        if last_frame < self.next_frame:
+            return None
+
+        start = self.chunk_start(self.next_frame)
+        chunk = self.buffer.narrow(self.dim, start - self.buffer_start, self.total - start)
+        out = self.fn(chunk)
+        first = self.next_frame - start // self.stride
+        out = out.narrow(self.dim, first, last_frame - self.next_frame + 1)
+
+        # Drop the input that is no longer needed
+        self.next_frame = last_frame + 1
+        new_start = self.chunk_start(self.next_frame)
+        self.buffer = self.buffer.narrow(
+            self.dim, new_start - self.buffer_start, self.total - new_start
+        )
+        self.buffer_start = new_start
+        return out
+
+
+def attend(mha: nn.Module, q_in: Tensor, kv_in: Tensor, cache: dict, max_context: int) -> Tensor:
+    """
+    MultiHeadAttentionAlibi for the new frames `q_in` with cached keys/values.
+
+    The aLiBi bias of MultiHeadAttentionAlibi (m * key_index plus the causal mask) is shift invariant
+    over each row of the scores, so it is equivalent to m * (key_index - query_index) used here.
+    """
+    q = mha.unstack_heads(mha.query(q_in))  # (B, heads, T_new, D_head)
+    k = mha.unstack_heads(mha.key(kv_in))
+    v = mha.unstack_heads(mha.value(kv_in))
+    if cache.get("k") is not None:
+        k = torch.cat((cache["k"], k), dim=2)
+        v = torch.cat((cache["v"], v), dim=2)
+    cache["k"] = k[:, :, -max_context:]
+    cache["v"] = v[:, :, -max_context:]
+
+    T_new, T_k = q.size(2), k.size(2)
+    q_pos = torch.arange(T_k - T_new, T_k, device=q.device)
+    k_pos = torch.arange(T_k, device=q.device)
+    rel = (k_pos.unsqueeze(0) - q_pos.unsqueeze(1)).to(q.dtype)  # (T_new, T_k)
+    bias = mha.m.to(q.device, q.dtype).view(1, -1, 1, 1) * rel
+    bias = bias.masked_fill(rel > 0, float("-inf"))
+
+    att = mha.get_scores(q, k) * mha.scale + bias
+    att = F.softmax(att, dim=-1)
+    y = mha.stack_heads(att @ v)
+    return mha.proj(y)
+
+
+def layer_step(
+    layer: nn.Module, x: Tensor, src: Optional[Tensor], cache: dict, max_context: int
+) -> Tensor:
+    """TransformerLayer.forward (eval mode) for the new frames"""
+    z = layer.ln_self_attn(x)
+    x = x + attend(layer.mha, z, z, cache.setdefault("self", {}), max_context)
+    if layer.cross_attention and src is not None:
+        z = layer.ln_src_attn(x)
+        x = x + attend(layer.mha_cross, z, src, cache.setdefault("cross", {}), max_context)
+    x = x + layer.ffnetwork(layer.ln_ffnetwork(x))
+    return x
+
+
+class StreamingVAP:
+    """
+    Incremental inference of VAP(EncoderCPC(), TransformerStereo()).
+
+    Each call of `step` encodes only the newly arrived samples and returns the outputs of the new
+    frames (frame_hz) only:
+        * EncoderCPC.gEncoder: the receptive-field tail of the waveform is carried over (StreamingConv)
+        * EncoderCPC.gAR: the recurrent state is carried over
+        * EncoderCPC.downsample: the tail of the gAR output is carried over (StreamingConv)
+        * TransformerStereo: per-layer key/value caches of the last `max_context` frames
+
+    A frame is output once the CPC receptive field after it has been received (about one CPC frame,
+    10ms, later than the last frame of the full window inference).
+    The recurrent state keeps the whole history instead of restarting at the beginning of a window,
+    so the outputs are close to, but not identical with, VAP.probs on a sliding window.
+    """
+
+    def __init__(self, model: nn.Module, max_context: int = 1250):
+        self.model = model
+        self.max_context = max_context
+
+        encoder = model.encoder
+        g_encoder = encoder.encoder.gEncoder
+        self.ar = encoder.encoder.gAR
+        assert not getattr(self.ar, "reverse", False), "Reversed gAR can not be streamed"
+
+        self.cpc = StreamingConv(g_encoder, *conv_geometry(g_encoder), dim=2)
+        # Same layers as EncoderCPC.forward
+        downsample = encoder.downsample
+        self.downsample = StreamingConv(
+            lambda z: downsample[4](downsample[2](downsample[1](downsample[0](z)))),
+            *conv_geometry(downsample, causal=True),
+            dim=1,
+        )
+        self.reset()
+
+    def reset(self) -> None:
+        self.cpc.reset()
+        self.downsample.reset()
+        self.ar_state = None
+        self.caches = {"channel": [{} for _ in self.model.transformer.ar_channel.layers],
+                       "cross": [{} for _ in self.model.transformer.ar.layers]}
+
+    def encode(self, waveform: Tensor) -> Optional[Tensor]:
+        """(B, 2, n_samples) -> (B * 2, n_frames, D) or None (no new frames)"""
+        B = waveform.size(0)
+        z = self.cpc.step(waveform.reshape(B * 2, 1, -1))
+        if z is None:
+            return None
+        z = z.transpose(1, 2)  # b c n -> b n c
+        self.ar.baseNet.flatten_parameters()
+        z, self.ar_state = self.ar.baseNet(z, self.ar_state)
+        return self.downsample.step(z)
+
+    def transformer(self, x: Tensor, B: int) -> dict[str, Tensor]:
+        """TransformerStereo.forward for the new frames"""
+        transformer = self.model.transformer
+        for layer, cache in zip(transformer.ar_channel.layers, self.caches["channel"]):
+            x = layer_step(layer, x, None, cache, self.max_context)
+
+        # Both towers share the weights: run them as one batch (x1 attends to x2 and vice versa)
+        x = x.view(B, 2, x.size(1), x.size(2))
+        x1, x2 = x[:, 0], x[:, 1]
+        for layer, cache in zip(transformer.ar.layers, self.caches["cross"]):
+            z = layer_step(
+                layer, torch.cat((x1, x2)), torch.cat((x2, x1)), cache, self.max_context
+            )
+            x1, x2 = z[:B], z[B:]
+        x = transformer.ar.combinator(x1, x2)
+        return {"x": x, "x1": x1, "x2": x2}
+
+    @torch.inference_mode()
+    def step(
+        self,
+        waveform: Tensor,
+        now_lims: list[int] = [0, 1],
+        future_lims: list[int] = [2, 3],
+    ) -> Optional[dict[str, Tensor]]:
+        """
+        Arguments:
+            waveform: (B, 2, n_new_samples) newly arrived samples
+
+        Return:
+            Same as VAP.probs for the new frames, or None if no frame has been completed
+        """
+        x = self.encode(waveform)
+        if x is None or x.size(1) == 0:
+            return None
+        out = self.transformer(x, waveform.size(0))
+        logits, vad = self.model.head(out["x"], out["x1"], out["x2"])
+        probs = logits.softmax(dim=-1)
+        ret = {
+            "probs": probs,
+            "vad": vad.sigmoid(),
+            "H": self.model.entropy(probs),
+        }
+        ret.update(self.model.aggregate_probs(probs, now_lims, future_lims))
+        return ret
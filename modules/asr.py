@@ -4,47 +4,222 @@ import time
 from google.cloud import speech as gspeech
 import MeCab
 
+import numpy as np
 import queue
+import bisect
+import difflib
 import threading
-import base64
-
-from base import RemdisModule, RemdisUpdateType
-
-STREAMING_LIMIT = 240  # 4 minutes
-
-def get_text_increment(module, new_text, tagger):
+from collections import OrderedDict, deque
+
+from base import RemdisModule, RemdisUpdateType, RemdisQueuePolicy
+
+STREAMING_LIMIT = 240  # 4 minutes (1ストリームの接続時間の上限)
+
+# 認識結果の変化した部分のみを形態素解析するトークナイザ
+# 前回の認識結果との共通接頭辞に含まれるトークンを再利用し，それ以降の文字列のみを解析する
+# (MeCabの解析結果は前後の文脈に依存するため，変化点の直前のトークンも解析し直す)
+# 解析結果は文字列ごとにLRUキャッシュに保持する
+class IncrementalTokenizer:
+    def __init__(self, tagger, cache_size=256, context_tokens=1):
+        self.tagger = tagger
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.context_tokens = context_tokens
+
+        # 前回の認識結果とトークン・各トークンの終了位置
+        self.text = ''
+        self.tokens = []
+        self.token_ends = []
+
+    def tokenize(self, text):
+        prefix_length = len(os.path.commonprefix([self.text, text]))
+
+        # 共通接頭辞に含まれるトークン (変化点の直前のトークンを除く) を再利用
+        num_reused = bisect.bisect_right(self.token_ends, prefix_length)
+        num_reused = max(0, num_reused - self.context_tokens)
+        offset = self.token_ends[num_reused - 1] if num_reused > 0 else 0
+
+        suffix_tokens, suffix_ends = self.parse(text[offset:])
+        self.tokens = self.tokens[:num_reused] + suffix_tokens
+        self.token_ends = self.token_ends[:num_reused] + [offset + end for end in suffix_ends]
+        self.text = text
+        return self.tokens
+
+    # トークンとその終了位置 (文字列中の空白は解析結果から除かれる)
+    def parse(self, text):
+        if text in self.cache:
+            self.cache.move_to_end(text)
+            return self.cache[text]
+
+        tokens = [token for token in self.tagger.parse(text).strip().split(" ") if token]
+        token_ends = []
+        position = 0
+        for token in tokens:
+            found = text.find(token, position)
+            position = found + len(token) if found >= 0 else position + len(token)
+            token_ends.append(position)
+
+        self.cache[text] = (tokens, token_ends)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return tokens, token_ends
+
+    def reset(self):
+        self.text = ''
+        self.tokens = []
+        self.token_ends = []
+
+# 前回の認識結果のIU系列と新しい認識結果のトークン系列を対応付け，最小限の差分を求める
+# iu_buffer: 変化したトークンのIU (REVOKEに設定)
+# new_tokens: 追加するトークンとその位置 (位置, トークン) のリスト
+# new_output: 新しい認識結果のIU系列 (追加するトークンの位置はNone)
+def get_text_increment(module, new_text, tokenizer):
     iu_buffer = []
-    
+
     # 認識結果をトークンへ分割
-    new_text = tagger.parse(new_text)
-    tokens = new_text.strip().split(" ")
+    tokens = tokenizer.tokenize(new_text)
 
     # トークンがない場合は終了
-    if tokens == [""]:
-        return iu_buffer, []
+    if len(tokens) == 0:
+        return iu_buffer, [], list(module.current_output)
+
+    current_tokens = [iu['body'] for iu in module.current_output]
+    matcher = difflib.SequenceMatcher(None, current_tokens, tokens, autojunk=False)
 
     new_tokens = []
-    iu_idx = 0
-    token_idx = 0
-    while token_idx < len(tokens):
-        # 過去の音声認識結果と新しい音声認識結果を比較
-        if iu_idx >= len(module.current_output):
-            new_tokens.append(tokens[token_idx])
-            token_idx += 1
-        else:
-            current_iu = module.current_output[iu_idx]
-            iu_idx += 1
-            if tokens[token_idx] == current_iu['body']:
-                token_idx += 1
-            else:
-                # 変更があったIUをREVOKEに設定し格納
-                current_iu['update_type'] = RemdisUpdateType.REVOKE
-                iu_buffer.append(current_iu)
+    new_output = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            new_output.extend(module.current_output[i1:i2])
+            continue
+        # 変更・削除があったIUをREVOKEに設定し格納
+        for current_iu in module.current_output[i1:i2]:
+            current_iu['update_type'] = RemdisUpdateType.REVOKE
+            iu_buffer.append(current_iu)
+        # 変更・挿入されたトークンを追加
+        for j in range(j1, j2):
+            new_tokens.append((j, tokens[j]))
+            new_output.append(None)
+
+    return iu_buffer, new_tokens, new_output
+
+# 前のストリームの認識結果 (prefix) と新しいストリームの認識結果 (text) を結合
+# 新しいストリームには切り替え前の音声 (オーバーラップ) も送るため，
+# prefixの末尾とtextの先頭で一致する部分を重複として除く
+def stitch_text(prefix, text, window):
+    tail = prefix[-window:]
+    head = text[:window]
+    match = difflib.SequenceMatcher(None, tail, head, autojunk=False).find_longest_match(
+        0, len(tail), 0, len(head))
+    if match.size >= 2:
+        return prefix[:len(prefix) - len(tail) + match.a] + text[match.b:]
+    return prefix + text
+
+# Google Cloud Speech-to-Textのストリーミング認識1回分 (接続時間には上限がある)
+# 認識結果は (ストリーム, レスポンス) として共有のキューに格納し，終了時はレスポンスをNoneとする
+class ASRStream:
+    def __init__(self, client, streaming_config, results):
+        self.client = client
+        self.streaming_config = streaming_config
+        self.results = results
+        self.start_time = time.time()
+        self.last_put_time = self.start_time
+
+        # 送信する音声
+        self.audio = queue.Queue()
+
+        self.thread = threading.Thread(target=self.recognize_loop, daemon=True)
+        self.thread.start()
+
+    def put(self, chunk):
+        self.last_put_time = time.time()
+        self.audio.put(chunk)
+
+    def close(self):
+        self.audio.put(None)
+
+    def recognize_loop(self):
+        requests = (
+            gspeech.StreamingRecognizeRequest(audio_content=content)
+            for content in self.generator()
+        )
+        try:
+            for response in self.client.streaming_recognize(self.streaming_config, requests):
+                self.results.put((self, response))
+        except Exception as e:
+            sys.stderr.write('ASR stream error: %r\n' % e)
+        self.results.put((self, None))
+
+    # キューに溜まった音声波形を結合し返却するgenerator
+    def generator(self):
+        while True:
+            # 最初のデータの取得
+            chunk = self.audio.get()
+            # ストリームが閉じられていれば処理を終了
+            if chunk is None:
+                return
+            data = [chunk]
+
+            # データがキューに残っていれば全て取得
+            while True:
+                try:
+                    chunk = self.audio.get(block=False)
+                    if chunk is None:
+                        yield b"".join(data)
+                        return
+                    data.append(chunk)
+                except queue.Empty:
+                    break
 
-    # current_outputに新しい音声認識結果のIUを格納
-    module.current_output = [iu for iu in module.current_output if iu['update_type'] is not RemdisUpdateType.REVOKE]
+            # 取得されたデータを結合し返却
+            yield b"".join(data)
 
-    return iu_buffer, new_tokens
+# 音声区間のみを認識に送るためのパワーによる音声区間検出
+# threshold: 音声とみなすパワー (dBFS)
+# pre_roll: 音声区間の開始時に遡って送る音声の長さ (sec)
+# post_roll: 音声区間の終了後も送り続ける音声の長さ (sec)
+class VoiceActivityGate:
+    def __init__(self, rate, threshold, pre_roll, post_roll):
+        self.rate = rate
+        self.threshold = threshold
+        self.pre_roll = pre_roll
+        self.post_roll = post_roll
+
+        self.pre_roll_chunks = deque()
+        self.pre_roll_length = 0.0
+        # 最後に音声とみなしてからの経過時間 (Noneの場合は非音声区間)
+        self.silence_length = None
+
+    # 送信する音声のリストを返却
+    def process(self, chunk):
+        length = len(chunk) / (2 * self.rate)
+        if self.power(chunk) >= self.threshold:
+            self.silence_length = 0.0
+        elif self.silence_length is not None:
+            self.silence_length += length
+            if self.silence_length > self.post_roll:
+                self.silence_length = None
+
+        # 非音声区間の音声は音声区間の開始に備えて保持
+        if self.silence_length is None:
+            self.pre_roll_chunks.append(chunk)
+            self.pre_roll_length += length
+            while self.pre_roll_length - len(self.pre_roll_chunks[0]) / (2 * self.rate) >= self.pre_roll:
+                self.pre_roll_length -= len(self.pre_roll_chunks.popleft()) / (2 * self.rate)
+            return []
+
+        chunks = list(self.pre_roll_chunks)
+        chunks.append(chunk)
+        self.pre_roll_chunks.clear()
+        self.pre_roll_length = 0.0
+        return chunks
+
+    @staticmethod
+    def power(chunk):
+        samples = np.frombuffer(chunk, dtype=np.int16).astype(np.float32)
+        if len(samples) == 0:
+            return -np.inf
+        return 10 * np.log10(np.mean(samples ** 2) / 32768.0 ** 2 + 1e-10)
 
 class ASR(RemdisModule):
     def __init__(self,
@@ -54,7 +229,8 @@ class ASR(RemdisModule):
                          sub_exchanges=sub_exchanges)
 
         self.buff_size = self.config['ASR']['buff_size']
-        self.audio_buffer = queue.Queue() # 受信用キュー
+        # 受信用キュー (認識が遅れた場合は古い音声から破棄)
+        self.audio_buffer = self.mk_queue('audio_buffer', 1000, RemdisQueuePolicy.DROP_OLDEST)
 
         # 一つ前のステップの音声認識結果
         self.current_output = [] 
@@ -66,90 +242,249 @@ class ASR(RemdisModule):
 
         self.client = None
         self.streaming_config = None
-        self.responses = []
 
         os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = self.config['ASR']['json_key']
 
-        # ASR リスタート用の変数
-        self.asr_start_time = 0.0
+        # ストリーム切り替え用の変数
+        # rollover_margin: 上限のこの時間前から発話の切れ目で次のストリームに切り替える (sec)
+        # overlap: 発話の途中で切り替える時に次のストリームに先に送る直前の音声の長さ (sec)
+        # stitch_window: 切り替え時に重複を探す認識結果の文字数
+        # preopen: 切り替えを始めるこの時間前から次のストリームを開いておく (sec)
+        self.rollover_margin = self.config['ASR']['rollover_margin']
+        self.preopen = self.config['ASR']['preopen']
+        self.overlap_length = int(self.config['ASR']['overlap'] * self.rate * 2)
+        self.stitch_window = self.config['ASR']['stitch_window']
+        self.overlap_chunks = deque()
+        self.overlap_bytes = 0
+        self.stream = None
+        # 上限が近づいたら先に開いておく次のストリーム (切り替えまでは無音のみを送る)
+        self.next_stream = None
+        self.next_stream_retry_time = 0.0
+        self.stream_lock = threading.Lock()
+        self.stream_results = queue.Queue()
+        # 発話の途中で切り替えた場合の前のストリームの認識結果
+        self.stitch_prefix = ''
+        # 最後の確定結果 (is_final) 以降に音声を送ったかどうか
+        # (途中結果が届く前の発話の冒頭も発話の途中として扱う)
+        self.speech_since_final = False
+        self.speech_threshold = self.config['ASR']['vad']['threshold']
+        # ストリームが途中で終了した場合の再接続の待ち時間 (sec, 連続で失敗するごとに倍にする)
+        self.retry_backoff = self.config['ASR']['retry_backoff']
+        self.retry_backoff_max = self.config['ASR']['retry_backoff_max']
+        self.stream_failures = 0
+
+        # 音声区間検出 (無効の場合は全ての音声を送る)
+        # keepalive_interval: 非音声区間にストリームを維持するため無音を送る間隔 (sec)
+        self.vad = None
+        if self.config['ASR']['vad']['enabled']:
+            self.vad = VoiceActivityGate(self.rate,
+                                         self.config['ASR']['vad']['threshold'],
+                                         self.config['ASR']['vad']['pre_roll'],
+                                         self.config['ASR']['vad']['post_roll'])
+        self.keepalive_interval = self.config['ASR']['vad']['keepalive_interval']
+        self.last_sent_time = time.time()
         self.asr_init()
         
         self.tagger = MeCab.Tagger("-Owakati")
+        self.tokenizer = IncrementalTokenizer(self.tagger,
+                                              self.config['ASR']['token_cache_size'])
 
         self._is_running = True
-        self.resume_asr = False
 
     def run(self):
         # メッセージ受信スレッド
         t1 = threading.Thread(target=self.listen_loop)
+        # 音声送信・ストリーム切り替えスレッド
+        t2 = threading.Thread(target=self.send_audio_loop)
         # 音声認識・メッセージ送信スレッド
-        t2 = threading.Thread(target=self.produce_predictions_loop)
+        t3 = threading.Thread(target=self.produce_predictions_loop)
 
         # スレッド実行
+        self.stream = self.open_stream()
         t1.start()
         t2.start()
+        t3.start()
 
     def listen_loop(self):
         self.subscribe('ain', self.callback)
 
-    def produce_predictions_loop(self):
-        while self._is_running:                
-            # 逐次音声認識結果の取得
-            requests = (
-                gspeech.StreamingRecognizeRequest(audio_content=content)
-                for content in self._generator()
-            )
-
-            if self.resume_asr == True:
-                sys.stderr.write('Resume: ASR\n')
-                self.asr_init()
-            
-            self.responses = self.client.streaming_recognize(
-                self.streaming_config, requests
-            )
-            
-            # 音声認識結果の解析とメッセージの発出
-            for response in self.responses:
-                # Google Cloud Speech-to-Textの結果を格納
-                p = self._extract_results(response)
+    # 受信した音声 (音声区間検出が有効な場合は音声区間のみ) を現在のストリームに送信
+    # 上限が近づいたら発話の切れ目で，上限に達したら発話の途中でも次のストリームに切り替える
+    def send_audio_loop(self):
+        while self._is_running:
+            chunk = self.audio_buffer.get()
+            if chunk is None:
+                break
 
-                if p:
-                    current_text = p['text']
+            # 取得した音声と送信する音声の長さを記録
+            self.metrics.inc('asr_audio_captured_seconds', len(chunk) / (2 * self.rate))
+            if self.vad is None:
+                chunks = [chunk]
+                voiced = VoiceActivityGate.power(chunk) >= self.speech_threshold
+            else:
+                chunks = self.vad.process(chunk)
+                voiced = self.vad.silence_length == 0.0
+                # 非音声区間が続く場合も一定間隔で無音を送ってストリームを維持
+                if not chunks and time.time() - self.last_sent_time >= self.keepalive_interval:
+                    chunks = [bytes(len(chunk))]
+
+            for chunk in chunks:
+                self.send_audio(chunk, voiced)
+
+        with self.stream_lock:
+            self.stream.close()
+            if self.next_stream is not None:
+                self.next_stream.close()
+
+    # voiced: 音声とみなすパワーの音声を含むかどうか
+    def send_audio(self, chunk, voiced=False):
+        self.last_sent_time = time.time()
+        self.metrics.inc('asr_audio_sent_seconds', len(chunk) / (2 * self.rate))
+
+        # 切り替え時に次のストリームに送る直前の音声
+        self.overlap_chunks.append(chunk)
+        self.overlap_bytes += len(chunk)
+        while self.overlap_bytes - len(self.overlap_chunks[0]) >= self.overlap_length:
+            self.overlap_bytes -= len(self.overlap_chunks.popleft())
+
+        with self.stream_lock:
+            if voiced:
+                self.speech_since_final = True
+            proc_time = time.time() - self.stream.start_time
+            if proc_time >= STREAMING_LIMIT or \
+               (proc_time >= STREAMING_LIMIT - self.rollover_margin and not self.in_utterance()):
+                # 直前の音声を送らなかった場合はこの音声から次のストリームに送る
+                if not self.rollover():
+                    self.stream.put(chunk)
+                return
+            self.stream.put(chunk)
+
+            # 上限が近づいたら次のストリームを先に開き，切り替えまで一定間隔で無音を送って維持
+            # (切り替え時に接続を待たずに音声を送れる)
+            if proc_time >= STREAMING_LIMIT - self.rollover_margin - self.preopen:
+                if self.next_stream is None and time.time() >= self.next_stream_retry_time:
+                    self.next_stream = self.open_stream()
+                if self.next_stream is not None and \
+                   time.time() - self.next_stream.last_put_time >= self.keepalive_interval:
+                    self.next_stream.put(bytes(len(chunk)))
+
+    # 最後の確定結果以降に音声を送ったか，確定していない認識結果がある場合は発話の途中
+    def in_utterance(self):
+        return self.speech_since_final or bool(self.current_output)
+
+    # 次のストリーム (先に開いていればそのストリーム) に切り替えて前のストリームを閉じる
+    # (前のストリームの以降の認識結果は使わない)
+    # 発話の途中で切り替える場合のみ直前の音声を次のストリームに先に送り，認識結果を結合する
+    # 発話の切れ目 (確定結果の後に音声がない) で直前の音声を送ると確定済みの発話を再び認識してしまう
+    # 直前の音声を送った場合はTrueを返す
+    def rollover(self):
+        sys.stderr.write('Rollover: Streaming ASR\n')
+        previous_stream = self.stream
+        self.stream = self.next_stream or self.open_stream()
+        self.next_stream = None
+        replay = self.in_utterance()
+        if replay:
+            self.stitch_prefix = ''.join(iu['body'] for iu in self.current_output)
+            for chunk in self.overlap_chunks:
+                self.stream.put(chunk)
+        previous_stream.close()
+        return replay
+
+    def open_stream(self):
+        return ASRStream(self.client, self.streaming_config, self.stream_results)
+
+    # 再接続までの待ち時間 (連続で失敗するごとに倍にする)
+    def retry_delay(self):
+        self.stream_failures += 1
+        self.metrics.inc('asr_stream_failures')
+        return min(self.retry_backoff * 2 ** (self.stream_failures - 1),
+                   self.retry_backoff_max)
 
-                    # iu_buffer: REVOKEしたIUを格納した送信用IUバッファ
-                    # new_tokens: 新しい音声認識結果のトークン系列
-                    iu_buffer, new_tokens = get_text_increment(self,
+    def produce_predictions_loop(self):
+        while self._is_running:
+            # 音声認識結果の取得
+            stream, response = self.stream_results.get()
+
+            # ストリームが途中で終了した場合は待ち時間の後に次のストリームに切り替え
+            # (待つ間は音声の送信を止めないようロックの外で待つ)
+            if response is None and stream is self.stream:
+                delay = self.retry_delay()
+                sys.stderr.write('Resume: ASR (retry in %.1f sec)\n' % delay)
+                time.sleep(delay)
+
+            with self.stream_lock:
+                # 先に開いた次のストリームが終了した場合は待ち時間の後に開き直す
+                if response is None and stream is self.next_stream:
+                    delay = self.retry_delay()
+                    sys.stderr.write('Reopen: ASR (retry in %.1f sec)\n' % delay)
+                    self.next_stream = None
+                    self.next_stream_retry_time = time.time() + delay
+                    continue
+
+                # 切り替え前のストリーム・切り替え前の次のストリームの認識結果は破棄
+                if stream is not self.stream:
+                    continue
+
+                if response is None:
+                    self.rollover()
+                    continue
+
+                # 認識結果を受け取れたら再接続の待ち時間を初期化
+                self.stream_failures = 0
+                # 音声認識結果の解析とメッセージの発出
+                self.process_response(response)
+
+    def process_response(self, response):
+        # Google Cloud Speech-to-Textの結果を格納
+        p = self._extract_results(response)
+        if not p:
+            return
+
+        current_text = p['text']
+        # 発話の途中でストリームを切り替えた場合は前のストリームの認識結果と結合
+        if self.stitch_prefix:
+            current_text = stitch_text(self.stitch_prefix, current_text, self.stitch_window)
+            if p['is_final']:
+                self.stitch_prefix = ''
+
+        # iu_buffer: REVOKEしたIUを格納した送信用IUバッファ
+        # new_tokens: 新しい音声認識結果で追加するトークンとその位置
+        # new_output: 新しい音声認識結果のIU系列
+        iu_buffer, new_tokens, new_output = get_text_increment(self,
                                                                current_text,
-                                                               self.tagger)
-
-                    # 発出するトークンがない場合の処理
-                    if len(new_tokens) == 0:
-                        if not p['is_final']:
-                            continue
-                        else:
-                            # f (is_final)がTrueの時は空のIUをCOMMITで作成
-                            output_iu = self.createIU_ASR('', [p['stability'], p['confidence']])
-                            output_iu['update_type'] = RemdisUpdateType.COMMIT
-                            #self.current_output = []
-                            # 送信用バッファに格納
-                            iu_buffer.append(output_iu)
-
-                    # 発出するトークンが存在する場合の処理        
-                    for i, token in enumerate(new_tokens):
-                        output_iu = self.createIU_ASR(token, [0.0, 0.99])
-                        eou = p['is_final'] and i == len(new_tokens) - 1
-                        if eou:
-                            # 発話終端であればCOMMITに設定
-                            output_iu['update_type'] = RemdisUpdateType.COMMIT
-                        else:
-                            self.current_output.append(output_iu)
-
-                        iu_buffer.append(output_iu)
-
-                    # 送信用バッファに格納したIUを発出
-                    for snd_iu in iu_buffer:
-                        self.printIU(snd_iu)
-                        self.publish(snd_iu, 'asr')
+                                                               self.tokenizer)
+
+        # 発出するトークンがない場合の処理
+        if len(new_tokens) == 0 and len(iu_buffer) == 0 and not p['is_final']:
+            return
+
+        # 追加するトークンのIUを作成 (previous_idで挿入位置を指定)
+        for i, (position, token) in enumerate(new_tokens):
+            output_iu = self.createIU_ASR(token, [0.0, 0.99])
+            output_iu['previous_id'] = new_output[position - 1]['id'] if position > 0 else None
+            new_output[position] = output_iu
+            iu_buffer.append(output_iu)
+
+        # 発話終端であれば末尾のトークンをCOMMITに設定
+        # (末尾のトークンが既に送信済みの場合は空のIUをCOMMITで作成)
+        if p['is_final']:
+            if new_tokens and new_tokens[-1][0] == len(new_output) - 1:
+                output_iu = new_output.pop()
+            else:
+                output_iu = self.createIU_ASR('', [p['stability'], p['confidence']])
+                iu_buffer.append(output_iu)
+            output_iu['update_type'] = RemdisUpdateType.COMMIT
+            # 次の発話のIUが確定済みのIUの後に挿入されないよう初期化
+            new_output = []
+            self.tokenizer.reset()
+            # 以降に音声を送るまでは発話の切れ目
+            self.speech_since_final = False
+        self.current_output = new_output
+
+        # 送信用バッファに格納したIUを発出
+        for snd_iu in iu_buffer:
+            self.printIU(snd_iu)
+            self.publish(snd_iu, 'asr')
 
     # ASRモジュール用のIU作成関数 (信頼スコアなどを格納)
     def createIU_ASR(self, token, asr_result):
@@ -157,36 +492,6 @@ class ASR(RemdisModule):
         iu['stability'] = asr_result[0]
         iu['confidence'] = asr_result[1]
         return iu
-        
-    # バッファに溜まった音声波形を結合し返却するgenerator
-    def _generator(self):
-        while self._is_running:
-            # ASRがタイムアウトしそうな場合は再起動
-            current_time = time.time()
-            proc_time = current_time - self.asr_start_time
-            if proc_time >= STREAMING_LIMIT:
-                self.resume_asr = True
-                break
-            
-            # 最初のデータの取得
-            chunk = self.audio_buffer.get()
-            # 何も送られていなければ処理を終了
-            if chunk is None:
-                return
-            data = [chunk]
-
-            # データがバッファに残っていれば全て取得
-            while True:
-                try:
-                    chunk = self.audio_buffer.get(block=False)
-                    if chunk is None:
-                        return
-                    data.append(chunk)
-                except queue.Empty:
-                    break
-
-            # 取得されたデータを結合し返却
-            yield b"".join(data)
 
     def _extract_results(self, response):
         predictions = {}
@@ -227,9 +532,7 @@ class ASR(RemdisModule):
                     
     def asr_init(self):
         sys.stderr.write('Start: Streaming ASR\n')
-        self.asr_start_time = time.time()
-        self.resume_asr = False
-        
+
         # Google Cloud Speech-to-Textクライアントのインスタンス構築
         self.client = gspeech.SpeechClient()
         config = gspeech.RecognitionConfig(
@@ -246,7 +549,7 @@ class ASR(RemdisModule):
     # メッセージ受信用コールバック関数
     def callback(self, ch, method, properties, in_msg):
         in_msg = self.parse_msg(in_msg)
-        self.audio_buffer.put(base64.b64decode(in_msg['body'].encode()))
+        self.audio_buffer.put(self.decode_audio(in_msg['body']))
 
 def main():
     asr = ASR()
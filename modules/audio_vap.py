@@ -1,21 +1,19 @@
 import sys, os
 import time
 import numpy
-import queue
 
 import threading
-import base64, copy
+import copy
 import librosa, pysptk
 
 import torch
 import torch.nn as nn
-from _audio_vap.VAP import VAP
-from _audio_vap.encoder import EncoderCPC
-from _audio_vap.modules import TransformerStereo
+from _audio_vap.optimized import load_checkpoint_model, OptimizedVAP
+from _audio_vap.streaming import StreamingVAP
 
 from scipy.io.wavfile import write
 
-from base import RemdisModule, RemdisUpdateType
+from base import RemdisModule, RemdisUpdateType, RemdisQueuePolicy
 
 from vap.utils.audio import load_waveform
 
@@ -27,7 +25,53 @@ else:
     # Windows/Linux
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu') 
 
+# launcher.pyが割り当てたtorchのスレッド数
+if 'REMDIS_TORCH_THREADS' in os.environ:
+    torch.set_num_threads(int(os.environ['REMDIS_TORCH_THREADS']))
+
+# 音声のリングバッファ
+# 同じ音声を2か所 (posとpos + size) に書き込むことで，直近size個のサンプルを常に
+# 連続した領域 (data[pos:pos + size]) として参照できる
+# 書き込みはチャンク長に比例した処理のみで，受信スレッドと推論スレッドの間はロックで排他制御する
+class AudioRingBuffer:
+    def __init__(self, size):
+        self.size = size
+        self.data = numpy.zeros(2 * size, dtype=numpy.float32)
+        # 次の書き込み位置 (最も古いサンプルの位置)
+        self.pos = 0
+        # 書き込んだサンプル数
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def write(self, chunk):
+        with self.lock:
+            self.total += len(chunk)
+            chunk = chunk[-self.size:]
+            first = min(len(chunk), self.size - self.pos)
+            self.data[self.pos:self.pos + first] = chunk[:first]
+            self.data[self.pos + self.size:self.pos + self.size + first] = chunk[:first]
+            rest = len(chunk) - first
+            if rest > 0:
+                self.data[:rest] = chunk[first:]
+                self.data[self.size:self.size + rest] = chunk[first:]
+            self.pos = (self.pos + len(chunk)) % self.size
+
+    # 直近のlen(out)個のサンプルをoutにコピー
+    def copy_to(self, out):
+        with self.lock:
+            end = self.pos + self.size
+            out[:] = self.data[end - len(out):end]
+
+    # 直近のnum_samples個のサンプルのコピーを返却
+    def read(self, num_samples):
+        out = numpy.empty(num_samples, dtype=numpy.float32)
+        self.copy_to(out)
+        return out
+
 class Audio_VAP(RemdisModule):
+    # VAPモデルの読み込み・ウォームアップ後に準備完了
+    ready_after_warmup = True
+
     def __init__(self, 
                  pub_exchanges=['vap', 'score'],
                  sub_exchanges=['ain', 'tts']):
@@ -36,18 +80,21 @@ class Audio_VAP(RemdisModule):
 
         # VAP用変数
         self.model_name = self.config['VAP']['model_filename']
+        self.artifact_filename = self.config['VAP']['artifact_filename']
         self.buffer_length = self.config['VAP']['buffer_length']
         self.threshold = self.config['VAP']['threshold']
         self.sample_rate = self.config['TTS']['sample_rate']
         self.buffer_size = int(self.buffer_length * self.sample_rate)
         self.tts_frame_length = self.config['TTS']['frame_length']
+        # 新たに受信した音声のみを推論するモード
+        self.streaming = self.config['VAP']['streaming']
+        # 推論の間隔 (モデルのフレーム数)
+        self.hop_frames = self.config['VAP']['hop_frames']
 
-        self.us_audio_buffer = numpy.zeros(self.buffer_size,
-                                           dtype=numpy.float32)
-        self.ss_audio_buffer = numpy.zeros(self.buffer_size,
-                                           dtype=numpy.float32)
+        self.us_audio_buffer = AudioRingBuffer(self.buffer_size)
+        self.ss_audio_buffer = AudioRingBuffer(self.buffer_size)
 
-        self.ss_msg_buffer = queue.Queue()
+        self.ss_msg_buffer = self.mk_queue('ss_msg_buffer', 100, RemdisQueuePolicy.DROP_OLDEST)
         self.prev_event = None
         
         self._is_running = True
@@ -86,13 +133,13 @@ class Audio_VAP(RemdisModule):
             try:
                 # システム発話がキューにあったら全てバッファに格納
                 chunk = self.ss_msg_buffer.get(block=False)
-                self.ss_audio_buffer = self.shift_buffer(self.ss_audio_buffer, chunk)
+                self.ss_audio_buffer.write(chunk)
             except:
                 # ない場合は遅延時間とTTSのフレーム長を合わせた分の無音を格納
                 chunk_time = delay_time + self.tts_frame_length
                 chunk_size = int(chunk_time * self.sample_rate)
                 chunk = numpy.zeros(chunk_size)
-                self.ss_audio_buffer = self.shift_buffer(self.ss_audio_buffer, chunk)
+                self.ss_audio_buffer.write(chunk)
                 delay_time = 0.0
 
             # TTSのフレーム長に同期してループ
@@ -104,32 +151,85 @@ class Audio_VAP(RemdisModule):
                     
     def vap_loop(self):
         # VAPモデルの読み込み
-        encoder = EncoderCPC()
-        transformer = TransformerStereo()
-        model = VAP(encoder, transformer)
-        ckpt = torch.load(self.model_name, map_location=device)['state_dict']
-        restored_ckpt = {}
-        for k,v in ckpt.items():
-            restored_ckpt[k.replace('model.', '')] = v
-        model.load_state_dict(restored_ckpt)
-        model.eval()
-        model.to(device)
-        sys.stderr.write('Load VAP model: %s\n' % (self.model_name))
-        sys.stderr.write('Device: %s\n' % (device))
+        # artifact_filenameを指定した場合はbuild_vap.pyで作成した成果物 (量子化・TorchScript) を読み込む
+        model_device = device
+        if self.artifact_filename:
+            # TorchScriptのグラフはトレース時のデバイスに固定されるため，成果物を作成したデバイスで推論
+            # (量子化したモデルはCPUで作成される)
+            model = OptimizedVAP(self.artifact_filename)
+            model_device = model.device
+            if model_device != device:
+                sys.stderr.write('VAP artifact %s was built for %s (available: %s)\n'
+                                 % (self.artifact_filename, model_device, device))
+            if model.num_samples != self.buffer_size:
+                raise ValueError('VAP artifact %s was built for %d samples (buffer_size: %d)'
+                                 % (self.artifact_filename, model.num_samples, self.buffer_size))
+            if self.streaming:
+                sys.stderr.write('Streaming inference is not available with the VAP artifact\n')
+                self.streaming = False
+            sys.stderr.write('Load VAP artifact: %s\n' % (self.artifact_filename))
+        else:
+            model = load_checkpoint_model(self.model_name, map_location=device)
+            model.to(model_device)
+            sys.stderr.write('Load VAP model: %s\n' % (self.model_name))
+        sys.stderr.write('Device: %s\n' % (model_device))
+
+        # ウォームアップ (初回の推論はメモリ確保などで遅いため無音で1回推論)
+        with torch.no_grad():
+            model.probs(torch.zeros(1, 2, self.buffer_size).to(model_device))
+        if self.streaming:
+            # 推論済みの音声の状態を保持するモデル (注意機構はバッファ長分のフレームを参照)
+            streaming_model = StreamingVAP(model, int(self.buffer_length * model.frame_hz))
+            streaming_model.step(torch.zeros(1, 2, self.sample_rate).to(model_device))
+            streaming_model.reset()
+            processed_samples = self.us_audio_buffer.total
+        self.notify_ready()
         
         s_threshold = self.threshold
         u_threshold = 1 - self.threshold
+
+        # 推論の入力バッファ (input_tensorはinput_audioとメモリを共有)
+        input_audio = numpy.zeros((1, 2, self.buffer_size), dtype=numpy.float32)
+        input_tensor = torch.from_numpy(input_audio)
+
+        # モデルのフレームに同期した一定間隔で推論
+        # 推論が間に合わなかった周期は後から実行せずに飛ばし，その数を記録
+        period = self.hop_frames / model.frame_hz
+        next_tick = time.monotonic()
         while True:
-            # 両話者のデータを結合してバッチを作成
-            ss_audio = torch.Tensor(self.ss_audio_buffer)
-            us_audio = torch.Tensor(self.us_audio_buffer)
-            input_audio = torch.stack((ss_audio, us_audio))
-            input_audio = input_audio.unsqueeze(0)
-            batch = torch.Tensor(input_audio)
-            batch = batch.to(device)
-
-            # 推論
-            out = model.probs(batch)
+            wait_time = next_tick - time.monotonic()
+            if wait_time > 0:
+                time.sleep(wait_time)
+            missed_ticks = int((time.monotonic() - next_tick) // period)
+            if missed_ticks > 0:
+                self.metrics.inc('vap_overrun_ticks', missed_ticks)
+            next_tick += (missed_ticks + 1) * period
+            self.metrics.inc('vap_ticks')
+
+            inference_start_time = time.perf_counter()
+            if self.streaming:
+                # 前回の推論以降に受信した分の音声のみを推論
+                num_samples = min(self.us_audio_buffer.total - processed_samples, self.buffer_size)
+                if num_samples == 0:
+                    continue
+                processed_samples += num_samples
+                input_audio = numpy.stack((self.ss_audio_buffer.read(num_samples),
+                                           self.us_audio_buffer.read(num_samples)))
+                batch = torch.from_numpy(input_audio).unsqueeze(0).to(model_device)
+
+                # 推論 (新たなフレームがない場合は次の音声を待つ)
+                out = streaming_model.step(batch)
+                if out is None:
+                    continue
+            else:
+                # 両話者のデータを確保済みの入力バッファにコピーしてバッチを作成
+                self.ss_audio_buffer.copy_to(input_audio[0, 0])
+                self.us_audio_buffer.copy_to(input_audio[0, 1])
+                batch = input_tensor.to(model_device)
+
+                # 推論
+                out = model.probs(batch)
+            self.metrics.observe('vap_inference_seconds', time.perf_counter() - inference_start_time)
             #print(out['vad'].shape,
             #      out['p_now'].shape,
             #      out['p_future'].shape,
@@ -168,7 +268,8 @@ class Audio_VAP(RemdisModule):
                 print('n:%.3f, f:%.3f, %s' % (score_n,
                                               score_f,
                                               event))
-                self.publish(snd_iu, 'vap')
+                # ターンテイキングイベントは送信待ちのスコアより先に送信
+                self.publish(snd_iu, 'vap', priority=True)
                 self.prev_event = event
             else:
                 print('n:%.3f, f:%.3f' % (score_n,
@@ -176,28 +277,23 @@ class Audio_VAP(RemdisModule):
             
     def us_callback(self, ch, method, properties, in_msg):
         in_msg = self.parse_msg(in_msg)
-        chunk = base64.b64decode(in_msg['body'].encode())
+        chunk = self.decode_audio(in_msg['body'])
         chunk = numpy.frombuffer(chunk, dtype=numpy.int16)
         # 振幅を-1.0から1.0の範囲に正規化
         chunk = chunk.astype(numpy.float32) / 32768.0
         chunk = chunk.astype(numpy.float32)
-        self.us_audio_buffer = self.shift_buffer(self.us_audio_buffer, chunk)
+        self.us_audio_buffer.write(chunk)
 
     def ss_callback(self, ch, method, properties, in_msg):
         in_msg = self.parse_msg(in_msg)
-        chunk = base64.b64decode(in_msg['body'].encode())
+        # ADD以外 (COMMITなど) は音声を取り出さずに破棄
+        if in_msg['update_type'] != RemdisUpdateType.ADD:
+            return
+        chunk = self.decode_audio(in_msg['body'])
         chunk = numpy.frombuffer(chunk, dtype=numpy.int16)
          # 振幅を-1.0から1.0の範囲に正規化
         chunk = chunk.astype(numpy.float32) / 32768.0
-        if in_msg['update_type'] == RemdisUpdateType.ADD:
-            self.ss_msg_buffer.put(chunk)
-
-    # バッファ格納用関数
-    def shift_buffer(self, in_buffer, chunk):
-        chunk_size = len(chunk)
-        in_buffer[:-chunk_size] = in_buffer[chunk_size:]
-        in_buffer[-chunk_size:] = chunk
-        return in_buffer
+        self.ss_msg_buffer.put(chunk)
 
     # デバッグ用音声保存関数
     def save_wave(self, in_buffer, wav_filename='tmp.wav'):
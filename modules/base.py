@@ -5,8 +5,20 @@ import enum
 import abc
 import pika
 import json
+import struct
+import base64
 
-import time, uuid
+import time
+import random, itertools
+import queue
+import threading
+import functools
+import asyncio
+import os, atexit
+import collections, collections.abc
+import traceback
+import http.server
+from multiprocessing import shared_memory, resource_tracker
 
 class RemdisUpdateType:
     EMPTY = 'empty'
@@ -14,6 +26,375 @@ class RemdisUpdateType:
     REVOKE = 'revoke'
     COMMIT = 'commit'
 
+    # 受信したupdate_typeを上記の定数オブジェクトに置き換えるための辞書
+    # (同一オブジェクト同士の==は同一性の比較だけで済む)
+    interned = {EMPTY: EMPTY, ADD: ADD, REVOKE: REVOKE, COMMIT: COMMIT}
+
+# IU (Incremental Unit)
+# 標準フィールドは__slots__の属性として保持し，それ以外のフィールド
+# (ASRのstability/confidence，TTSのdata_typeなど) はextraに保持する
+# 従来のdictによるIUと同様に iu['body'] のようにアクセス可能
+class RemdisIU(collections.abc.MutableMapping):
+    __slots__ = ('timestamp', 'monotonic', 'id', 'producer',
+                 'update_type', 'exchange', 'body', 'extra')
+
+    std_keys = frozenset(('timestamp', 'monotonic', 'id', 'producer',
+                          'update_type', 'exchange', 'body'))
+
+    def __init__(self, timestamp, monotonic, iu_id, producer,
+                 update_type, exchange, body, extra=None):
+        self.timestamp = timestamp
+        self.monotonic = monotonic
+        self.id = iu_id
+        self.producer = producer
+        self.update_type = update_type
+        self.exchange = exchange
+        self.body = body
+        self.extra = extra
+
+    # dictによるIU (JSON形式で受信したものなど) から作成
+    @classmethod
+    def from_dict(cls, d):
+        d = dict(d)
+        iu = cls(d.pop('timestamp', None), d.pop('monotonic', None), d.pop('id', None),
+                 d.pop('producer', None),
+                 RemdisUpdateType.interned.get(d.get('update_type'), d.get('update_type')),
+                 d.pop('exchange', None), d.pop('body', None))
+        d.pop('update_type', None)
+        iu.extra = d or None
+        return iu
+
+    def to_dict(self):
+        d = {'timestamp': self.timestamp,
+             'monotonic': self.monotonic,
+             'id': self.id,
+             'producer': self.producer,
+             'update_type': self.update_type,
+             'exchange': self.exchange,
+             'body': self.body}
+        if self.extra:
+            d.update(self.extra)
+        return d
+
+    def copy(self):
+        return RemdisIU(self.timestamp, self.monotonic, self.id, self.producer,
+                        self.update_type, self.exchange, self.body,
+                        dict(self.extra) if self.extra else None)
+
+    def __getitem__(self, key):
+        if key in RemdisIU.std_keys:
+            return getattr(self, key)
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __setitem__(self, key, value):
+        if key in RemdisIU.std_keys:
+            setattr(self, key, value)
+        elif self.extra is None:
+            self.extra = {key: value}
+        else:
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        if key in RemdisIU.std_keys or self.extra is None:
+            raise KeyError(key)
+        del self.extra[key]
+
+    def __contains__(self, key):
+        return key in RemdisIU.std_keys or (self.extra is not None and key in self.extra)
+
+    def get(self, key, default=None):
+        if key in RemdisIU.std_keys:
+            return getattr(self, key)
+        if self.extra is None:
+            return default
+        return self.extra.get(key, default)
+
+    def __iter__(self):
+        yield from ('timestamp', 'monotonic', 'id', 'producer',
+                    'update_type', 'exchange', 'body')
+        if self.extra:
+            yield from self.extra
+
+    def __len__(self):
+        return 7 + (len(self.extra) if self.extra else 0)
+
+    def __repr__(self):
+        return 'RemdisIU(%r)' % self.to_dict()
+
+# 受信したbinary形式のIU
+# ヘッダ (update_type・タイムスタンプ・id・producer・exchange) のみを先に読み出し，
+# bodyと追加フィールドは最初にアクセスされた時点で受信データから取り出す
+# (update_typeだけを見て捨てるIUではbodyのコピー・デコードを行わない)
+class RemdisLazyIU(RemdisIU):
+    __slots__ = ('message', 'body_type', 'body_start', 'body_end', 'meta_start')
+
+    # 親クラスのスロット (デコード済みのbody・extraを保持)
+    slot_body = RemdisIU.body
+    slot_extra = RemdisIU.extra
+
+    def __init__(self, timestamp, monotonic, iu_id, producer, update_type, exchange,
+                 message, body_type, meta_start, body_start, body_end):
+        self.timestamp = timestamp
+        self.monotonic = monotonic
+        self.id = iu_id
+        self.producer = producer
+        self.update_type = update_type
+        self.exchange = exchange
+        RemdisLazyIU.slot_body.__set__(self, None)
+        RemdisLazyIU.slot_extra.__set__(self, None)
+        self.message = message
+        self.body_type = body_type
+        self.meta_start = meta_start
+        self.body_start = body_start
+        self.body_end = body_end
+
+    @property
+    def body(self):
+        if self.body_type is not None:
+            body = memoryview(self.message)[self.body_start:self.body_end]
+            if self.body_type == RemdisSerializer.BODY_STR:
+                body = str(body, 'utf-8')
+            elif self.body_type == RemdisSerializer.BODY_JSON:
+                body = json.loads(body.tobytes())
+            RemdisLazyIU.slot_body.__set__(self, body)
+            self.body_type = None
+            self.release()
+        return RemdisLazyIU.slot_body.__get__(self)
+
+    @body.setter
+    def body(self, value):
+        RemdisLazyIU.slot_body.__set__(self, value)
+        self.body_type = None
+        self.release()
+
+    @property
+    def extra(self):
+        if self.meta_start is not None:
+            meta = self.message[self.meta_start:self.body_start]
+            RemdisLazyIU.slot_extra.__set__(self, json.loads(meta) if meta else None)
+            self.meta_start = None
+            self.release()
+        return RemdisLazyIU.slot_extra.__get__(self)
+
+    @extra.setter
+    def extra(self, value):
+        RemdisLazyIU.slot_extra.__set__(self, value)
+        self.meta_start = None
+        self.release()
+
+    # body・追加フィールドを全て取り出したら受信データへの参照を解放
+    # (bytesのbodyは受信データのmemoryviewのため，受信データ自体はbodyが保持する)
+    def release(self):
+        if self.body_type is None and self.meta_start is None:
+            self.message = None
+
+class RemdisWireFormat:
+    JSON = 'json'
+    BINARY = 'binary'
+
+# IUのシリアライズ・デシリアライズ
+# binary形式: 固定長ヘッダ + id/producer/exchange + 追加フィールド(JSON) + body(生バイト列)
+# json形式: 従来通りのJSON (bytesのbodyはbase64文字列に変換)
+class RemdisSerializer:
+    # magic, version, update_type, body_type, timestamp, monotonic,
+    # id長, producer長, exchange長, 追加フィールド長, body長
+    header = struct.Struct('<4sBBBddHHHII')
+    magic = b'RIU\x00'
+    version = 2
+
+    update_type2code = {RemdisUpdateType.EMPTY: 0,
+                        RemdisUpdateType.ADD: 1,
+                        RemdisUpdateType.REVOKE: 2,
+                        RemdisUpdateType.COMMIT: 3}
+    code2update_type = {v: k for k, v in update_type2code.items()}
+
+    # bodyの種類
+    BODY_BYTES = 0
+    BODY_STR = 1
+    BODY_JSON = 2
+
+    def __init__(self, wire_formats=None):
+        # exchangeごとの送信形式 (未指定のexchangeはJSON)
+        self.wire_formats = wire_formats or {}
+
+    # セッション名を付けたexchange ('<exchange>@<セッション名>') は元のexchangeの送信形式
+    def wire_format(self, exchange):
+        return self.wire_formats.get(exchange.partition('@')[0], RemdisWireFormat.JSON)
+
+    # IUをexchangeの送信形式でバイト列に変換
+    def encode(self, iu, exchange):
+        if self.wire_format(exchange) == RemdisWireFormat.BINARY:
+            return self.encode_binary(iu)
+        return self.encode_json(iu)
+
+    def encode_json(self, iu):
+        iu = iu.to_dict() if isinstance(iu, RemdisIU) else dict(iu)
+        if isinstance(iu['body'], (bytes, bytearray, memoryview)):
+            iu['body'] = base64.b64encode(iu['body']).decode('utf-8')
+        return json.dumps(iu)
+
+    def encode_binary(self, iu):
+        body = iu['body']
+        if isinstance(body, (bytes, bytearray, memoryview)):
+            body_type = self.BODY_BYTES
+        elif isinstance(body, str):
+            body_type = self.BODY_STR
+            body = body.encode('utf-8')
+        else:
+            body_type = self.BODY_JSON
+            body = json.dumps(body).encode('utf-8')
+
+        iu_id = str(iu['id']).encode('utf-8')
+        producer = str(iu['producer']).encode('utf-8')
+        exchange = str(iu['exchange']).encode('utf-8')
+        if isinstance(iu, RemdisIU):
+            meta = iu.extra
+        else:
+            meta = {k: v for k, v in iu.items() if k not in RemdisIU.std_keys}
+        meta = json.dumps(meta).encode('utf-8') if meta else b''
+        monotonic = iu.get('monotonic')
+
+        header = self.header.pack(self.magic, self.version,
+                                  self.update_type2code.get(iu['update_type'], 0),
+                                  body_type, iu['timestamp'],
+                                  monotonic if monotonic is not None else float('nan'),
+                                  len(iu_id), len(producer), len(exchange),
+                                  len(meta), len(body))
+        return b''.join((header, iu_id, producer, exchange, meta, body))
+
+    # 受信したバイト列をIUに変換 (先頭のmagicで形式を判定)
+    def decode(self, message):
+        if message[:4] == self.magic:
+            return self.decode_binary(message)
+        return RemdisIU.from_dict(json.loads(message))
+
+    def decode_binary(self, message):
+        (_, version, update_type, body_type, timestamp, monotonic,
+         id_len, producer_len, exchange_len,
+         meta_len, body_len) = self.header.unpack_from(message)
+        if version != self.version:
+            raise ValueError('Unsupported IU wire format version: %d' % version)
+
+        pos = self.header.size
+        iu_id = str(message[pos:pos+id_len], 'utf-8')
+        pos += id_len
+        producer = str(message[pos:pos+producer_len], 'utf-8')
+        pos += producer_len
+        exchange = str(message[pos:pos+exchange_len], 'utf-8')
+        pos += exchange_len
+
+        # bodyと追加フィールドはアクセスされるまでデコードしない
+        return RemdisLazyIU(timestamp,
+                            None if monotonic != monotonic else monotonic,
+                            iu_id, producer,
+                            self.code2update_type[update_type],
+                            exchange, message, body_type,
+                            pos if meta_len else None,
+                            pos + meta_len, pos + meta_len + body_len)
+
+# キューが一杯の時の処理
+class RemdisQueuePolicy:
+    BLOCK = 'block'              # 空きが出るまで待つ (制御用のIU．コールバックは受信スレッドとは別のスレッドで実行される)
+    DROP_OLDEST = 'drop_oldest'  # 最も古い要素を捨てる (音声)
+    COALESCE = 'coalesce'        # 最も新しい要素を置き換える (スコアなど最新値のみ意味があるもの)
+
+# 最大長と溢れた時の処理を指定できるキュー
+# 最大到達長 (high water mark) と破棄した要素数を記録する
+class RemdisQueue(queue.Queue):
+    def __init__(self, maxsize=0, policy=RemdisQueuePolicy.BLOCK, name=''):
+        super().__init__(maxsize)
+        self.policy = policy
+        self.name = name
+        self.high_water_mark = 0
+        self.dropped = 0
+
+    def put(self, item, block=True, timeout=None):
+        if self.policy == RemdisQueuePolicy.BLOCK or self.maxsize <= 0:
+            super().put(item, block, timeout)
+            return
+
+        with self.not_full:
+            if self._qsize() >= self.maxsize:
+                if self.policy == RemdisQueuePolicy.DROP_OLDEST:
+                    self.queue.popleft()
+                else:
+                    self.queue.pop()
+                self.unfinished_tasks -= 1
+                self.dropped += 1
+                # 破棄が続く場合は100回ごとに通知
+                if self.dropped % 100 == 1:
+                    sys.stderr.write('Queue %s is full (maxsize: %d), %d items dropped\n'
+                                     % (self.name, self.maxsize, self.dropped))
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def _put(self, item):
+        super()._put(item)
+        if self._qsize() > self.high_water_mark:
+            self.high_water_mark = self._qsize()
+
+    # キューを空にする (空き待ちのスレッドは再開)
+    def clear(self):
+        with self.mutex:
+            self.unfinished_tasks -= self._qsize()
+            self.queue.clear()
+            self.not_full.notify_all()
+            if self.unfinished_tasks <= 0:
+                self.unfinished_tasks = 0
+                self.all_tasks_done.notify_all()
+
+    def stats(self):
+        return {'size': self.qsize(),
+                'maxsize': self.maxsize,
+                'high_water_mark': self.high_water_mark,
+                'dropped': self.dropped}
+
+# イベントループ上で使うRemdisQueue (AsyncRemdisModuleのmk_queueが作成)
+# 溢れた時の処理・記録する値はRemdisQueueと同じで，BLOCKの場合はawait put()で空きを待つ
+class AsyncRemdisQueue(asyncio.Queue):
+    def __init__(self, maxsize=0, policy=RemdisQueuePolicy.BLOCK, name=''):
+        super().__init__(maxsize)
+        self.policy = policy
+        self.name = name
+        self.high_water_mark = 0
+        self.dropped = 0
+
+    async def put(self, item):
+        if self.policy == RemdisQueuePolicy.BLOCK:
+            await super().put(item)
+        else:
+            self.put_nowait(item)
+
+    def put_nowait(self, item):
+        if self.policy != RemdisQueuePolicy.BLOCK and self.full():
+            if self.policy == RemdisQueuePolicy.DROP_OLDEST:
+                self._queue.popleft()
+            else:
+                self._queue.pop()
+            self.task_done()
+            self.dropped += 1
+            # 破棄が続く場合は100回ごとに通知
+            if self.dropped % 100 == 1:
+                sys.stderr.write('Queue %s is full (maxsize: %d), %d items dropped\n'
+                                 % (self.name, self.maxsize, self.dropped))
+        super().put_nowait(item)
+
+    def _put(self, item):
+        super()._put(item)
+        if self.qsize() > self.high_water_mark:
+            self.high_water_mark = self.qsize()
+
+    # キューを空にする (空き待ちのタスクは再開)
+    def clear(self):
+        while not self.empty():
+            self.get_nowait()
+            self.task_done()
+
+    stats = RemdisQueue.stats
+
 class RemdisState:
     transition = {'talking':
                   {'SYSTEM_BACKCHANNEL': 'talking',
@@ -37,82 +418,792 @@ class RemdisState:
                    'ASR_COMMIT': 'talking'}
                   }
 
+# メッセージ送受信の基底クラス
+class RemdisTransport(abc.ABC):
+    # 送信チャネル作成関数
+    @abc.abstractmethod
+    def mk_pub_connection(self, exchange):
+        pass
+
+    # 受信チャネル作成関数
+    @abc.abstractmethod
+    def mk_sub_connection(self, exchange):
+        pass
+
+    # メッセージ送信関数 (送信したバイト数を返す．バイト列に変換しない場合はNone)
+    @abc.abstractmethod
+    def publish(self, connection, message, exchange):
+        pass
+
+    # メッセージ受信関数 (受信ループを実行するか，実行中の受信ループにコールバックを登録)
+    @abc.abstractmethod
+    def subscribe(self, connection, exchange, callback):
+        pass
+
+    # 送信がない間に送信スレッドから呼ばれる (ハートビートの処理など)
+    def keepalive(self):
+        pass
+
+# RabbitMQ (AMQP) のfanout exchangeを用いた送受信
+# 送信用・受信用にそれぞれ1つの接続をモジュール内で共有し，exchange・queueの宣言はキャッシュして1回だけ行う
+# 受信は1つの受信スレッドが全exchangeの受信ループ (start_consuming) を実行し，
+# 受信したメッセージをexchangeごとのキューに振り分けるだけにする
+# コールバックはsubscribeを呼び出したスレッドがexchangeごとに実行するため，
+# 遅いコールバックが他のexchangeの受信やハートビートの処理を止めない
+class RemdisAMQPTransport(RemdisTransport):
+    def __init__(self, host, serializer):
+        self.host = host
+        self.serializer = serializer
+
+        self.pub_connection = None
+        self.sub_connection = None
+        self.declared_exchanges = set()
+        # exchange -> 受信の情報 (queue名・振り分け先のキュー)
+        self.subscriptions = {}
+
+        self.lock = threading.Lock()
+        self.consumer_thread = None
+
+    def connect(self):
+        connection = pika.BlockingConnection(
+            pika.ConnectionParameters(host=self.host)
+        )
+        channel = connection.channel()
+        return {'connection': connection, 'channel': channel}
+
+    def declare_exchange(self, channel, exchange):
+        if exchange not in self.declared_exchanges:
+            channel.exchange_declare(exchange, 'fanout')
+            self.declared_exchanges.add(exchange)
+
+    def mk_pub_connection(self, exchange):
+        if self.pub_connection is None:
+            self.pub_connection = self.connect()
+        self.declare_exchange(self.pub_connection['channel'], exchange)
+        return self.pub_connection
+
+    def mk_sub_connection(self, exchange):
+        with self.lock:
+            if exchange in self.subscriptions:
+                return self.subscriptions[exchange]
+            if self.sub_connection is None:
+                self.sub_connection = self.connect()
+
+            # 受信したメッセージは上限なしのキューに格納 (受信スレッドを止めない)
+            subscription = {'exchange': exchange,
+                            'messages': RemdisQueue(name='subscribe.%s' % exchange)}
+            if self.consumer_thread is None:
+                self.declare_queue(subscription)
+            else:
+                # 受信ループの実行中は受信スレッドで宣言する (pikaの接続はスレッドセーフでないため)
+                declared = threading.Event()
+                def declare():
+                    self.declare_queue(subscription)
+                    declared.set()
+                self.sub_connection['connection'].add_callback_threadsafe(declare)
+                declared.wait()
+            self.subscriptions[exchange] = subscription
+            return subscription
+
+    # exchangeに結び付けたqueueを宣言し，受信したメッセージをexchangeごとのキューに振り分ける
+    def declare_queue(self, subscription):
+        channel = self.sub_connection['channel']
+        channel.exchange_declare(subscription['exchange'], 'fanout')
+        result = channel.queue_declare(queue='', exclusive=True)
+        subscription['queue'] = result.method.queue
+        channel.queue_bind(exchange=subscription['exchange'], queue=subscription['queue'])
+        channel.basic_consume(queue=subscription['queue'],
+                              auto_ack=True,
+                              on_message_callback=functools.partial(self.dispatch, subscription))
+
+    def dispatch(self, subscription, ch, method, properties, body):
+        subscription['messages'].put((ch, method, properties, body))
+
+    def publish(self, connection, message, exchange):
+        body = self.serializer.encode(message, exchange)
+        connection['channel'].basic_publish(exchange=exchange,
+                                            routing_key='',
+                                            body=body)
+        return len(body)
+
+    def keepalive(self):
+        if self.pub_connection is not None:
+            self.pub_connection['connection'].process_data_events(0)
+
+    # 全exchangeの受信ループを実行する受信スレッドを開始 (2回目以降は何もしない)
+    def start_consuming(self):
+        with self.lock:
+            if self.consumer_thread is None:
+                self.consumer_thread = threading.Thread(target=self.sub_connection['channel'].start_consuming,
+                                                        daemon=True)
+                self.consumer_thread.start()
+
+    # 呼び出したスレッドでこのexchangeのメッセージのコールバックを実行
+    def subscribe(self, connection, exchange, callback):
+        self.start_consuming()
+        while True:
+            ch, method, properties, body = connection['messages'].get()
+            callback(ch, method, properties, body)
+
+# プロセス内のfanoutバス (ブローカ不要，シリアライズなし)
+# 同一プロセス内でスレッドとして動作する全モジュールで共有される
+class RemdisInProcessTransport(RemdisTransport):
+    # exchange名 -> 購読キューのリスト
+    queues = {}
+    lock = threading.Lock()
+
+    def mk_pub_connection(self, exchange):
+        return {}
+
+    def mk_sub_connection(self, exchange):
+        sub_queue = RemdisQueue(name='subscribe.%s' % exchange)
+        with RemdisInProcessTransport.lock:
+            RemdisInProcessTransport.queues.setdefault(exchange, []).append(sub_queue)
+        return {'messages': sub_queue}
+
+    def publish(self, connection, message, exchange):
+        with RemdisInProcessTransport.lock:
+            sub_queues = list(RemdisInProcessTransport.queues.get(exchange, []))
+        # 受信側でのIUの書き換えが他の受信側に影響しないように浅いコピーを渡す
+        for sub_queue in sub_queues:
+            sub_queue.put(message.copy())
+
+    def subscribe(self, connection, exchange, callback):
+        # pikaのコールバックと同じ引数 (ch, method, properties, body) で呼び出す
+        while True:
+            message = connection['messages'].get()
+            callback(None, None, None, message)
+
+# 高頻度なADDの音声IUをまとめて1つのメッセージとして送信するバッファ
+# max_frames個たまるか，最初のフレームからmax_delay秒経過した時点で送信
+# 各フレームのタイムスタンプ・IDは'batch'フィールドに保持
+# 送信スレッドからのみ呼び出される
+class RemdisBatcher:
+    def __init__(self, exchange, max_frames, max_delay, send):
+        self.exchange = exchange
+        self.max_frames = max_frames
+        self.max_delay = max_delay
+        self.send = send
+
+        self.frames = []
+        self.deadline = None
+
+    def publish(self, message):
+        body = message['body']
+        if (message['update_type'] != RemdisUpdateType.ADD
+                or not isinstance(body, (bytes, bytearray, memoryview))):
+            # 音声以外のIU (COMMITなど) は順序を保つため溜まっているバッチの後に送信
+            self.flush()
+            self.send(message, self.exchange)
+            return
+
+        self.frames.append(message)
+        if len(self.frames) == 1:
+            self.deadline = time.monotonic() + self.max_delay
+        if len(self.frames) >= self.max_frames:
+            self.flush()
+
+    # 溜まっているフレームを1つのIUにまとめて送信
+    def flush(self):
+        if not self.frames:
+            return
+        frames = self.frames
+        self.frames = []
+        self.deadline = None
+
+        batch_iu = frames[0].copy()
+        batch_iu['body'] = b''.join(frame['body'] for frame in frames)
+        batch_iu['batch'] = [[frame['timestamp'], frame.get('monotonic'), frame['id'], len(frame['body'])]
+                             for frame in frames]
+        self.send(batch_iu, self.exchange)
+
+# モジュールごとの送信スレッド
+# publish()は送信キューに追加するだけで，ソケットへの書き込みは全てこのスレッドで行う
+# (pikaのチャネルはスレッドセーフでないため)
+# 通常のメッセージは送信順序を保証し，priority=Trueのメッセージは通常のメッセージを追い越す
+class RemdisPublisher:
+    # 送信するものがない時にブローカとの接続を維持する間隔 (秒)
+    keepalive_interval = 1.0
+
+    def __init__(self, transport, batchers, send):
+        self.transport = transport
+        self.batchers = batchers
+        self.send = send
+
+        # deque.append/popleftはスレッドセーフのため，キューの数だけ起床用のトークンを送る
+        self.messages = collections.deque()
+        self.priority_messages = collections.deque()
+        self.wakeup = queue.SimpleQueue()
+
+        t = threading.Thread(target=self.publish_loop, daemon=True)
+        t.start()
+
+    def publish(self, message, exchange, priority=False):
+        if priority:
+            self.priority_messages.append((message, exchange))
+        else:
+            self.messages.append((message, exchange))
+        self.wakeup.put(None)
+
+    # 送信待ちのメッセージ数
+    def pending(self):
+        return len(self.messages) + len(self.priority_messages)
+
+    # それまでにpublish()されたメッセージ (バッチを含む) が送信されるまで待つ
+    def flush(self, timeout=None):
+        done = threading.Event()
+        self.messages.append((done, None))
+        self.wakeup.put(None)
+        return done.wait(timeout)
+
+    def publish_loop(self):
+        while True:
+            try:
+                self.wakeup.get(timeout=self.next_timeout())
+            except queue.Empty:
+                self.flush_expired_batches()
+                self.transport.keepalive()
+                continue
+
+            if self.priority_messages:
+                message, exchange = self.priority_messages.popleft()
+            else:
+                message, exchange = self.messages.popleft()
+
+            try:
+                if isinstance(message, threading.Event):
+                    for batcher in self.batchers.values():
+                        batcher.flush()
+                    message.set()
+                elif exchange in self.batchers:
+                    self.batchers[exchange].publish(message)
+                else:
+                    self.send(message, exchange)
+                self.flush_expired_batches()
+            except Exception:
+                traceback.print_exc()
+
+    def next_timeout(self):
+        deadlines = [b.deadline for b in self.batchers.values() if b.deadline is not None]
+        if not deadlines:
+            return self.keepalive_interval
+        return max(0.0, min(deadlines) - time.monotonic())
+
+    def flush_expired_batches(self):
+        now = time.monotonic()
+        for batcher in self.batchers.values():
+            if batcher.deadline is not None and batcher.deadline <= now:
+                batcher.flush()
+
+# 同一ホスト上のプロセス間で音声データを共有するリングバッファ
+# 送信側は共有メモリに1度だけ書き込み，バスには位置情報 (名前・位置・長さ) のみを流す
+# 受信側はbodyとして保持する分だけ共有メモリから1度コピーして読み出す
+class RemdisAudioRing:
+    # 共有メモリ先頭のヘッダ (リングの容量, これまでに書き込んだ総バイト数)
+    header = struct.Struct('<QQ')
+
+    def __init__(self, name, size=0, create=False):
+        self.name = name
+        self.lock = threading.Lock()
+        if create:
+            self.shm = shared_memory.SharedMemory(name=name, create=True,
+                                                  size=self.header.size + size)
+            self.capacity = size
+            self.header.pack_into(self.shm.buf, 0, self.capacity, 0)
+        else:
+            # 受信側の終了時に共有メモリが削除されないように管理対象から外す
+            if sys.version_info >= (3, 13):
+                self.shm = shared_memory.SharedMemory(name=name, track=False)
+            else:
+                self.shm = shared_memory.SharedMemory(name=name)
+                # 3.12以前はtrackを指定できないため登録を解除
+                # (resource_trackerには先頭に'/'の付いた非公開の_nameで登録されている)
+                resource_tracker.unregister(self.shm._name, 'shared_memory')
+            self.capacity, _ = self.header.unpack_from(self.shm.buf, 0)
+        self.data = self.shm.buf[self.header.size:self.header.size+self.capacity]
+
+    # データを書き込み，読み出し用の位置 (総バイト数での位置) を返す
+    def write(self, data):
+        length = len(data)
+        if length > self.capacity // 2:
+            raise ValueError('Audio chunk (%d bytes) is too large for ring %s' % (length, self.name))
+        with self.lock:
+            _, position = self.header.unpack_from(self.shm.buf, 0)
+            offset = position % self.capacity
+            # 末尾をまたぐ場合は先頭から書き込み，読み出し時に連続した領域として参照できるようにする
+            if offset + length > self.capacity:
+                position += self.capacity - offset
+                offset = 0
+            self.data[offset:offset+length] = data
+            self.header.pack_into(self.shm.buf, 0, self.capacity, position + length)
+        return position
+
+    # 書き込まれたデータのコピーを返す
+    # IUはキューに長く留まることがあるため，共有メモリのビューではなくbytesとして取り出す
+    # 上書きされている (または間もなく上書きされる) 場合はNoneを返す
+    # 送信側はデータを書き込んでから書き込み位置を進めるため，コピー後に書き込み位置を読み直し，
+    # コピー中に上書きされた可能性がある (位置がcapacity//2を超えて進んだ) 場合も破棄する
+    def read(self, position, length):
+        if self.write_position() - position > self.capacity // 2:
+            return None
+        offset = position % self.capacity
+        data = bytes(self.data[offset:offset+length])
+        if self.write_position() - position > self.capacity // 2:
+            return None
+        return data
+
+    # これまでに書き込まれた総バイト数
+    def write_position(self):
+        _, position = self.header.unpack_from(self.shm.buf, 0)
+        return position
+
+    def close(self, unlink=False):
+        self.data.release()
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+# モジュールの実行時メトリクス
+# 送受信数・バイト数・コールバックの処理時間は基底クラスが自動で記録し，
+# モジュール固有の値 (VAPの推論時間など) はset_gauge/observeで記録する
+class RemdisMetrics:
+    # 処理時間のパーセンタイル計算に使う直近のサンプル数
+    max_samples = 1000
+    quantiles = (0.5, 0.9, 0.99)
+
+    def __init__(self, producer, queues):
+        self.producer = producer
+        self.queues = queues
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(int)
+        self.gauges = {}
+        self.summaries = {}
+
+    # (メトリクス名, ラベル) をキーとして記録
+    def key(self, name, labels):
+        return (name, tuple(sorted(labels.items())) if labels else ())
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] += value
+
+    def set_gauge(self, name, value, **labels):
+        self.gauges[self.key(name, labels)] = value
+
+    # 処理時間などの値を記録 (Prometheusのsummaryとして出力)
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            summary = self.summaries.get(key)
+            if summary is None:
+                summary = self.summaries[key] = [0, 0.0, collections.deque(maxlen=self.max_samples)]
+            summary[0] += 1
+            summary[1] += value
+            summary[2].append(value)
+
+    def format_labels(self, labels, extra=()):
+        labels = (('module', self.producer),) + tuple(labels) + tuple(extra)
+        return '{%s}' % ','.join('%s="%s"' % (k, v) for k, v in labels)
+
+    # Prometheusのテキスト形式で出力
+    def render(self):
+        # 呼び出し可能なゲージは出力時に値を取得
+        gauges = {key: value() if callable(value) else value
+                  for key, value in list(self.gauges.items())}
+        gauges[self.key('remdis_threads', None)] = threading.active_count()
+        for name, in_queue in list(self.queues.items()):
+            for stat, value in in_queue.stats().items():
+                gauges[self.key('remdis_queue_%s' % stat, {'queue': name})] = value
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            summaries = sorted((key, (count, total, sorted(samples)))
+                               for key, (count, total, samples) in self.summaries.items())
+
+        lines = []
+        typed = set()
+        def add_type(name, metric_type):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE %s %s' % (name, metric_type))
+
+        for (name, labels), value in counters:
+            add_type(name, 'counter')
+            lines.append('%s%s %s' % (name, self.format_labels(labels), value))
+        for (name, labels), value in sorted(gauges.items()):
+            add_type(name, 'gauge')
+            lines.append('%s%s %s' % (name, self.format_labels(labels), value))
+        for (name, labels), (count, total, samples) in summaries:
+            add_type(name, 'summary')
+            for q in self.quantiles:
+                value = samples[min(len(samples) - 1, int(len(samples) * q))]
+                lines.append('%s%s %s' % (name, self.format_labels(labels, (('quantile', q),)), value))
+            lines.append('%s_sum%s %s' % (name, self.format_labels(labels), total))
+            lines.append('%s_count%s %s' % (name, self.format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    # interval秒ごとにfilenameに書き出す (書き出し途中のファイルが読まれないよう置き換える)
+    def dump_loop(self, filename, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                with open(filename + '.tmp', 'w', encoding='utf-8') as f:
+                    f.write(self.render())
+                os.replace(filename + '.tmp', filename)
+            except Exception:
+                traceback.print_exc()
+
+# メトリクスをHTTP (GET /metrics) で返すハンドラ
+class RemdisMetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
 class RemdisModule:
+    # モデルの読み込み・ウォームアップが必要なモジュールはTrueにし，完了時にnotify_readyを呼ぶ
+    # (Falseの場合は初期化時に準備完了とする)
+    ready_after_warmup = False
+    # mk_queueで作成するキュー
+    queue_class = RemdisQueue
+
     def __init__(self,
-                 config_filename='../config/config.yaml',
+                 config_filename=None,
                  host='localhost',
                  pub_exchanges=[],
                  sub_exchanges=[]):
 
+        # 設定ファイルは環境変数REMDIS_CONFIGで差し替え可能 (ベンチマークなど)
+        if config_filename is None:
+            config_filename = os.environ.get('REMDIS_CONFIG', '../config/config.yaml')
         self.config_filename = config_filename
         self.pub_exchanges = pub_exchanges
         self.sub_exchanges = sub_exchanges
         self.host = host
         self._is_running = False
 
+        # IU作成用の変数
+        self.producer = self.__class__.__name__
+        self.iu_id_prefix = '%08x' % random.getrandbits(32)
+        self.iu_counter = itertools.count()
+
         # 設定ファイルの読み込み
         self.config = self.load_config(self.config_filename)
+        self.bus_config = self.config.get('BUS') or {}
+
+        # exchangeごとのIU送信形式
+        self.serializer = RemdisSerializer(self.bus_config.get('wire_format'))
+
+        # 送受信方式 (amqp or inprocess)
+        self.transport = self.mk_transport(self.bus_config.get('transport', 'amqp'))
+
+        # 対話セッション名 (環境変数REMDIS_SESSIONまたはBUS.session)
+        # 指定した場合は全てのexchangeを'<exchange>@<セッション名>'として送受信し，
+        # 同じブローカ上の他のセッションと分離する (vap_server.pyが複数セッションを扱うため)
+        self.session = os.environ.get('REMDIS_SESSION') or self.bus_config.get('session')
+
+        # 本体 (音声など) を除いたIUを'<exchange>.control'にも送信するexchange
+        # 制御情報 (update_type・タイムスタンプなど) のみが必要なモジュールはこちらを受信する
+        self.control_exchanges = set(self.bus_config.get('control_plane') or [])
 
         # 送信チャネル作成
         self.pub_connections = {}
         for pub_exchange in self.pub_exchanges:
             self.pub_connections[pub_exchange] = self.mk_pub_connection(pub_exchange)
+            if pub_exchange in self.control_exchanges:
+                control_exchange = self.control_exchange(pub_exchange)
+                self.pub_connections[control_exchange] = self.mk_pub_connection(control_exchange)
 
         # 受信チャネル作成
         self.sub_connections = {}
         for sub_exchange in self.sub_exchanges:
             self.sub_connections[sub_exchange] = self.mk_sub_connection(sub_exchange)
 
+        # 音声IUをまとめて送信するexchangeのバッファ
+        self.batchers = {}
+        batch_config = self.bus_config.get('batch') or {}
+        for pub_exchange in self.pub_exchanges:
+            if pub_exchange in batch_config:
+                self.batchers[pub_exchange] = RemdisBatcher(pub_exchange,
+                                                            batch_config[pub_exchange]['max_frames'],
+                                                            batch_config[pub_exchange]['max_delay'],
+                                                            self.send)
+
+        # 送信スレッド
+        self.publisher = None
+        if self.pub_exchanges:
+            self.publisher = RemdisPublisher(self.transport, self.batchers, self.send)
+
+        # 共有メモリ経由で音声を送信するexchangeのリングバッファ (AMQP使用時のみ)
+        self.pub_audio_rings = {}
+        self.sub_audio_rings = {}
+        self.dropped_shared_audio = 0
+        if isinstance(self.transport, RemdisAMQPTransport):
+            shm_config = self.bus_config.get('shared_memory') or {}
+            for pub_exchange in self.pub_exchanges:
+                if pub_exchange in shm_config:
+                    ring_name = 'remdis_%s_%d' % (pub_exchange, os.getpid())
+                    ring = RemdisAudioRing(ring_name, shm_config[pub_exchange], create=True)
+                    self.pub_audio_rings[pub_exchange] = ring
+                    atexit.register(ring.close, unlink=True)
+
+        # モジュール内部のキュー (名前 -> RemdisQueue)
+        # 受信したメッセージがコールバックの実行を待つexchangeごとのキューも含む
+        self.queues = {}
+        for sub_exchange, sub_connection in self.sub_connections.items():
+            self.queues['subscribe.%s' % sub_exchange] = sub_connection['messages']
+
+        # 実行時メトリクス
+        self.metrics = RemdisMetrics(self.producer, self.queues)
+        if self.publisher is not None:
+            self.metrics.set_gauge('remdis_publisher_pending', self.publisher.pending)
+        self.start_metrics()
+
+        # 準備完了 (launcher.pyが起動完了の判定に使用)
+        self.ready = threading.Event()
+        if not self.ready_after_warmup:
+            self.notify_ready()
+
+        # IUの系譜 (元になったIUのid) と各処理の時刻を記録するexchange
+        trace_config = self.config.get('TRACE') or {}
+        if trace_config.get('enabled', False):
+            self.trace_exchanges = set(trace_config.get('exchanges') or [])
+        else:
+            self.trace_exchanges = set()
+
     # 汎用メッセージ送信関数
-    def publish(self, message, exchange):
-        self.pub_connections[exchange]['channel'].basic_publish(exchange=exchange,
-                                                                routing_key='',
-                                                                body=json.dumps(message))
+    # 送信スレッドのキューに追加してすぐに戻る
+    # 送信後にIUが書き換えられても影響しないよう，追加時点のIUをコピーして送信
+    # priority=Trueの場合は送信待ちの通常のメッセージより先に送信
+    def publish(self, message, exchange, priority=False):
+        message = message.copy()
+        if exchange in self.trace_exchanges:
+            self.add_hop(message, 'enqueue')
+        self.publisher.publish(message, exchange, priority)
+
+    # 送信待ちのメッセージが全て送信されるまで待つ関数
+    def flush(self, timeout=None):
+        if self.publisher is None:
+            return True
+        return self.publisher.flush(timeout)
+
+    # メッセージをそのまま送信する関数 (送信スレッドから呼び出される)
+    # 共有メモリを使うexchangeでは音声を共有メモリに書き込み，位置情報のみを送信
+    def send(self, message, exchange):
+        if exchange in self.trace_exchanges:
+            self.add_hop(message, 'publish')
+
+        if exchange in self.control_exchanges:
+            control_message = message.copy()
+            control_message['body'] = ''
+            control_exchange = self.control_exchange(exchange)
+            self.count_out(control_exchange,
+                           self.transport.publish(self.pub_connections[control_exchange],
+                                                  control_message,
+                                                  self.session_exchange(control_exchange)))
+
+        ring = self.pub_audio_rings.get(exchange)
+        if ring is not None and isinstance(message['body'], (bytes, bytearray, memoryview)) and message['body']:
+            length = len(message['body'])
+            position = ring.write(message['body'])
+            message = message.copy()
+            message['body'] = b''
+            message['shm'] = [ring.name, position, length]
+        self.count_out(exchange,
+                       self.transport.publish(self.pub_connections[exchange], message,
+                                              self.session_exchange(exchange)))
+
+    # 送信数・送信バイト数を記録
+    def count_out(self, exchange, size):
+        self.metrics.inc('remdis_messages_total', exchange=exchange, direction='out')
+        if size is not None:
+            self.metrics.inc('remdis_bytes_total', size, exchange=exchange, direction='out')
 
     # 汎用メッセージ受信関数
+    # まとめて送信されたIUはフレームごとのIUに分解してコールバックに渡す
     def subscribe(self, exchange, callback):
-        self.sub_connections[exchange]['channel'].basic_consume(queue='',
-                                                                auto_ack=True,
-                                                                on_message_callback=callback)
-        self.sub_connections[exchange]['channel'].start_consuming()
+        def unbatch_callback(ch, method, properties, in_msg):
+            start_time = time.perf_counter()
+            self.metrics.inc('remdis_messages_total', exchange=exchange, direction='in')
+            if isinstance(in_msg, (bytes, bytearray)):
+                self.metrics.inc('remdis_bytes_total', len(in_msg), exchange=exchange, direction='in')
+            try:
+                handle(ch, method, properties, in_msg)
+            finally:
+                self.metrics.observe('remdis_callback_seconds',
+                                     time.perf_counter() - start_time, exchange=exchange)
+
+        def handle(ch, method, properties, in_msg):
+            in_msg = self.parse_msg(in_msg)
+            if 'shm' in in_msg and not self.resolve_shared_audio(in_msg):
+                return
+            if self.trace_exchanges and 'lineage' in in_msg:
+                self.add_hop(in_msg, 'receive')
+            if 'batch' not in in_msg:
+                callback(ch, method, properties, in_msg)
+                return
+            for iu in self.unpack_batch(in_msg):
+                callback(ch, method, properties, iu)
+
+        self.transport.subscribe(self.sub_connections[exchange], self.session_exchange(exchange),
+                                 unbatch_callback)
+
+    # まとめて送信されたIUをフレームごとのIUに分解
+    def unpack_batch(self, batch_iu):
+        body = memoryview(self.decode_audio(batch_iu['body']))
+        frames = batch_iu.pop('batch')
+
+        ius = []
+        pos = 0
+        for timestamp, monotonic, iu_id, length in frames:
+            iu = batch_iu.copy()
+            iu['timestamp'] = timestamp
+            iu['monotonic'] = monotonic
+            iu['id'] = iu_id
+            iu['body'] = body[pos:pos+length]
+            ius.append(iu)
+            pos += length
+        return ius
+
+    # 共有メモリ上の音声をIUのbodyに設定 (上書き済みで読み出せない場合はFalse)
+    def resolve_shared_audio(self, iu):
+        ring_name, position, length = iu.pop('shm')
+        ring = self.sub_audio_rings.get(ring_name)
+        if ring is None:
+            ring = RemdisAudioRing(ring_name)
+            self.sub_audio_rings[ring_name] = ring
+
+        body = ring.read(position, length)
+        if body is None:
+            self.dropped_shared_audio += 1
+            sys.stderr.write('Shared audio in %s was overwritten before it was read (dropped: %d)\n'
+                             % (ring_name, self.dropped_shared_audio))
+            return False
+        iu['body'] = body
+        return True
 
     # 送信チャネル作成関数
     def mk_pub_connection(self, exchange):
-        connection = pika.BlockingConnection(
-            pika.ConnectionParameters(host=self.host)
-        )
-        channel = connection.channel()
-        channel.exchange_declare(exchange, 'fanout')
-        return {'connection': connection, 'channel': channel}
+        return self.transport.mk_pub_connection(self.session_exchange(exchange))
+
+    # 準備完了を通知
+    # 環境変数REMDIS_READY_FILEが指定されている場合はそのファイルを作成 (別プロセスのlauncher.pyへの通知)
+    def notify_ready(self):
+        self.ready.set()
+        ready_file = os.environ.get('REMDIS_READY_FILE')
+        if ready_file:
+            with open(ready_file, 'w') as f:
+                f.write('%f\n' % time.time())
+
+    # メトリクスのHTTPサーバ・ファイル書き出しを開始
+    # METRICS.portsにモジュール名 (クラス名) が指定されている場合のみHTTPで公開
+    def start_metrics(self):
+        metrics_config = self.config.get('METRICS') or {}
+        port = (metrics_config.get('ports') or {}).get(self.producer)
+        if port is not None:
+            server = http.server.ThreadingHTTPServer(
+                (metrics_config.get('host', '127.0.0.1'), port), RemdisMetricsHandler)
+            server.daemon_threads = True
+            server.metrics = self.metrics
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        dump_dir = metrics_config.get('dump_dir')
+        if dump_dir:
+            os.makedirs(dump_dir, exist_ok=True)
+            threading.Thread(target=self.metrics.dump_loop,
+                             args=(os.path.join(dump_dir, '%s.prom' % self.producer),
+                                   metrics_config.get('dump_interval', 10.0)),
+                             daemon=True).start()
 
     # 受信チャネル作成関数
+    # '<exchange>.control'が設定ファイルのcontrol_planeで有効になっていない場合は本体を含むexchangeを受信
     def mk_sub_connection(self, exchange):
-        connection = pika.BlockingConnection(
-            pika.ConnectionParameters(host=self.host)
-        )
-        channel = connection.channel()
-        channel.exchange_declare(exchange, 'fanout')
-        result = channel.queue_declare(queue='', exclusive=True)
-        queue_name = result.method.queue
-        channel.queue_bind(exchange=exchange, queue=queue_name)
-        return {'connection': connection, 'channel': channel}
+        if exchange.endswith('.control'):
+            data_exchange = exchange[:-len('.control')]
+            if data_exchange not in self.control_exchanges:
+                sys.stderr.write('%s is not in BUS.control_plane, subscribing to %s instead\n'
+                                 % (exchange, data_exchange))
+                exchange = data_exchange
+        return self.transport.mk_sub_connection(self.session_exchange(exchange))
+
+    # ブローカ上のexchange名 (セッション名を指定した場合は'<exchange>@<セッション名>')
+    def session_exchange(self, exchange):
+        if self.session:
+            return '%s@%s' % (exchange, self.session)
+        return exchange
+
+    # 制御情報のみを流すexchange名
+    def control_exchange(self, exchange):
+        return exchange + '.control'
+
+    # 送受信方式の作成関数
+    def mk_transport(self, transport_name):
+        if transport_name == 'amqp':
+            return RemdisAMQPTransport(self.host, self.serializer)
+        elif transport_name == 'inprocess':
+            return RemdisInProcessTransport()
+        else:
+            raise ValueError('Unknown transport: %s (amqp or inprocess)' % transport_name)
+
+    # モジュール内部のキュー作成関数
+    # 最大長・処理は設定ファイルのQUEUE.<モジュール名>.<キュー名>で上書き可能
+    def mk_queue(self, name, maxsize=0, policy=RemdisQueuePolicy.BLOCK):
+        queue_config = (self.config.get('QUEUE') or {}).get(self.__class__.__name__) or {}
+        queue_config = queue_config.get(name) or {}
+        in_queue = self.queue_class(queue_config.get('maxsize', maxsize),
+                                    queue_config.get('policy', policy),
+                                    '%s.%s' % (self.__class__.__name__, name))
+        self.queues[name] = in_queue
+        return in_queue
 
     @abc.abstractmethod
     def run(self):
         pass
 
     # 汎用IU作成関数
-    def createIU(self, body, exchange, update_type):
-        iu = {}
-        iu['timestamp'] = time.time()
-        iu['id'] = str(uuid.uuid1())
-        iu['producer'] = str(self.__class__.__name__)
-        iu['update_type'] = str(update_type)
-        #iu['data_type'] = data_type
-        iu['exchange'] = exchange
-        iu['body'] = body
+    # timestamp: 時刻 (time.time), monotonic: 同一ホスト内での経過時間計測用 (time.monotonic)
+    # id: モジュールのインスタンスごとのランダムな32bit + 連番32bitの64bit (16進数)
+    # parentsには作成の元になった受信IUを指定 (トレース有効時にlineageとして記録)
+    def createIU(self, body, exchange, update_type, parents=None):
+        iu = RemdisIU(time.time(), time.monotonic(),
+                      '%s%08x' % (self.iu_id_prefix, next(self.iu_counter)),
+                      self.producer, update_type, exchange, body)
+        if exchange in self.trace_exchanges:
+            iu['lineage'] = {'parents': [self.parent_entry(parent) for parent in parents or []
+                                         if parent is not None],
+                             'hops': [[self.producer, 'create', iu.timestamp]]}
         return iu
 
+    # lineageの親IUの情報 [id, exchange, 受信時刻]
+    def parent_entry(self, parent):
+        received = None
+        lineage = parent.get('lineage')
+        if lineage:
+            for producer, event, t in lineage['hops']:
+                if event == 'receive' and producer == self.producer:
+                    received = t
+        return [parent['id'], parent['exchange'], received]
+
+    # IUのlineageに処理時刻を追加 (lineageを持たないIUは何もしない)
+    # コピーしたIU間でlineageを共有しないよう，新しいリストに置き換える
+    def add_hop(self, iu, event, t=None):
+        lineage = iu.get('lineage')
+        if lineage is None:
+            return
+        iu['lineage'] = {'parents': lineage['parents'],
+                         'hops': lineage['hops'] + [[self.producer, event,
+                                                     time.time() if t is None else t]]}
+
     # 汎用IUプリント関数
     def printIU(self, iu, flush=False):
         sys.stdout.write('[%s] Body: %s, Update_type: %s, ID: %s\n'
@@ -129,11 +1220,258 @@ class RemdisModule:
 
     # 汎用メッセージ読み込み関数
     def parse_msg(self, message):
-        return json.loads(message)
+        # プロセス内バスではIUがそのまま渡される
+        if isinstance(message, (RemdisIU, dict)):
+            return message
+        return self.serializer.decode(message)
+
+    # 音声データ取得関数 (binary形式・共有メモリではそのまま，JSON形式ではbase64をデコード)
+    def decode_audio(self, body):
+        if isinstance(body, str):
+            return base64.b64decode(body.encode())
+        return body
+
+# asyncio版のモジュール基底クラス
+# IUハンドラ・タイマーを1つのイベントループ上のコルーチンとして実行する
+# ハンドラは同期関数・コルーチン関数のどちらも登録可能
+class AsyncRemdisModule(RemdisModule):
+    # キューはイベントループ上のハンドラ・タスクの間で使う (await get()で待つ)
+    queue_class = AsyncRemdisQueue
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.loop = None
+        self.stop_event = None
+        self.tasks = set()
+
+    # モジュール固有の初期化処理 (ハンドラ・タイマーの登録など)
+    @abc.abstractmethod
+    async def main(self):
+        pass
+
+    # 単独で実行する場合のメインループ
+    def run(self):
+        asyncio.run(self.run_async())
+
+    # 複数のモジュールを1つのイベントループで実行する場合は
+    # asyncio.gather(m1.run_async(), m2.run_async(), ...) のように呼び出す
+    async def run_async(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        await self.main()
+        await self.stop_event.wait()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.stop_event.set)
+
+    # 非同期メッセージ受信関数
+    # 受信・パースは受信スレッドで行い，ハンドラはイベントループ上で実行
+    async def subscribe_async(self, exchange, handler):
+        loop = asyncio.get_running_loop()
+
+        def callback(ch, method, properties, in_msg):
+            in_msg = self.parse_msg(in_msg)
+            loop.call_soon_threadsafe(self.dispatch, handler, in_msg)
+
+        t = threading.Thread(target=self.subscribe,
+                             args=(exchange, callback),
+                             daemon=True)
+        t.start()
+
+    # 非同期メッセージ送信関数 (送信は送信スレッドで行われるためブロックしない)
+    async def publish_async(self, message, exchange, priority=False):
+        self.publish(message, exchange, priority)
+
+    # 送信待ちのメッセージが全て送信されるまで待つ
+    async def flush_async(self):
+        if self.publisher is not None:
+            await self.loop.run_in_executor(None, self.publisher.flush)
+
+    # ブロッキング処理 (LLMのAPI呼び出しなど) をスレッドプールで実行
+    async def run_in_thread(self, func, *args):
+        return await self.loop.run_in_executor(None, func, *args)
+
+    # ブロッキングなイテレータ (LLMのストリーミング応答など) の要素を1つずつスレッドプールで取得
+    # (要素を待つ間だけスレッドを使い，イベントループは止めない)
+    async def iterate_in_thread(self, iterator):
+        end = object()
+        while True:
+            item = await self.run_in_thread(next, iterator, end)
+            if item is end:
+                return
+            yield item
+
+    # delay秒後にハンドラを1回実行
+    def call_later(self, delay, handler, *args):
+        return self.loop.call_later(delay, self.dispatch, handler, *args)
+
+    # interval秒ごとにハンドラを実行
+    def call_every(self, interval, handler, *args):
+        async def timer():
+            while True:
+                await asyncio.sleep(interval)
+                result = handler(*args)
+                if asyncio.iscoroutine(result):
+                    await result
+        return self.create_task(timer())
+
+    # 同期ハンドラはその場で実行し，コルーチン関数はタスクとして実行
+    def dispatch(self, handler, *args):
+        if asyncio.iscoroutinefunction(handler):
+            self.create_task(handler(*args))
+        else:
+            handler(*args)
+
+    # 実行中のタスクへの参照を保持 (ガベージコレクションによる中断を防ぐ)
+    def create_task(self, coro):
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+# 受信したIUを逐次的に管理するバッファ
+# idで索引付けしてREVOKE・COMMITを定数時間で処理し，連結したテキストを逐次的に更新する
+# previous_idを持つIUはそのIUの直後に挿入する (Noneの場合は先頭．ASRの差分更新で使用)
+# 変更時には登録したリスナーを (イベント名, IU) で呼び出す ('add', 'revoke', 'commit', 'clear')
+class RemdisIUBuffer:
+    def __init__(self):
+        # id -> IU
+        self.ius = {}
+        # IUの並び (双方向リンク)
+        self.prev_ids = {}
+        self.next_ids = {}
+        self.head = None
+        self.tail = None
+        # 並び順のbodyのリスト (text_validがFalseの場合は次の参照時に作り直す)
+        # 連結したテキストは参照時に作成し，変更があるまで再利用する
+        self.text_parts = []
+        self.text_cache = ''
+        self.text_valid = True
+        self.committed = False
+        self.listeners = []
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def notify(self, event, iu):
+        for listener in self.listeners:
+            listener(event, iu)
+
+    # update_typeに応じてIUを追加・取り消し・確定
+    def append(self, iu):
+        update_type = iu['update_type']
+        if update_type == RemdisUpdateType.REVOKE:
+            self.revoke(iu)
+        elif update_type == RemdisUpdateType.COMMIT:
+            self.commit(iu)
+        else:
+            self.add(iu)
+
+    def add(self, iu):
+        self.put(iu)
+        self.notify('add', iu)
+
+    # 確定したIUのbodyも発話の一部として追加
+    def commit(self, iu):
+        self.put(iu)
+        self.committed = True
+        self.notify('commit', iu)
+
+    def put(self, iu):
+        iu_id = iu['id']
+        # 同じidのIUを再度受信した場合は置き換え
+        if iu_id in self.ius:
+            self.remove(iu_id)
+
+        # 末尾以外への挿入 (previous_idのIUが既に取り消されている場合は末尾に追加)
+        previous_id = iu['previous_id'] if 'previous_id' in iu else self.tail
+        if previous_id != self.tail and (previous_id is None or previous_id in self.ius):
+            self.link_after(previous_id, iu_id)
+            self.text_valid = False
+        else:
+            self.link_after(self.tail, iu_id)
+            if self.text_valid:
+                self.text_parts.append(iu['body'])
+                self.text_cache = None
+        self.ius[iu_id] = iu
+
+    def link_after(self, previous_id, iu_id):
+        next_id = self.head if previous_id is None else self.next_ids[previous_id]
+        self.prev_ids[iu_id] = previous_id
+        self.next_ids[iu_id] = next_id
+        if previous_id is None:
+            self.head = iu_id
+        else:
+            self.next_ids[previous_id] = iu_id
+        if next_id is None:
+            self.tail = iu_id
+        else:
+            self.prev_ids[next_id] = iu_id
+
+    # 取り消されたIUを削除 (受信していないidの場合は何もしない)
+    def revoke(self, iu):
+        if self.remove(iu['id']) is not None:
+            self.notify('revoke', iu)
+
+    def remove(self, iu_id):
+        if iu_id not in self.ius:
+            return None
+        removed = self.ius.pop(iu_id)
+        previous_id = self.prev_ids.pop(iu_id)
+        next_id = self.next_ids.pop(iu_id)
+        if previous_id is None:
+            self.head = next_id
+        else:
+            self.next_ids[previous_id] = next_id
+        if next_id is None:
+            self.tail = previous_id
+        else:
+            self.prev_ids[next_id] = previous_id
+
+        # 末尾のIUの取り消しは末尾のbodyを除くだけで済む
+        if self.text_valid and next_id is None:
+            self.text_parts.pop()
+            self.text_cache = None
+        else:
+            self.text_valid = False
+        return removed
+
+    def text(self):
+        if not self.text_valid:
+            self.text_parts = [iu['body'] for iu in self]
+            self.text_cache = None
+            self.text_valid = True
+        if self.text_cache is None:
+            self.text_cache = ''.join(self.text_parts)
+        return self.text_cache
+
+    def clear(self):
+        self.ius.clear()
+        self.prev_ids.clear()
+        self.next_ids.clear()
+        self.head = None
+        self.tail = None
+        self.text_parts = []
+        self.text_cache = ''
+        self.text_valid = True
+        self.committed = False
+        self.notify('clear', None)
+
+    def __len__(self):
+        return len(self.ius)
+
+    def __iter__(self):
+        iu_id = self.head
+        while iu_id is not None:
+            yield self.ius[iu_id]
+            iu_id = self.next_ids[iu_id]
+
+    def __contains__(self, iu_id):
+        return iu_id in self.ius
 
 class RemdisUtil:
     def remove_revoked_ius(self, iu_buffer):
-        revoked_iu_ids = [iu['id'] for iu in iu_buffer if iu['update_type'] == RemdisUpdateType.REVOKE]
+        revoked_iu_ids = set(iu['id'] for iu in iu_buffer if iu['update_type'] == RemdisUpdateType.REVOKE)
         
         output_iu_buffer = []
         for iu in iu_buffer:
@@ -142,10 +1480,7 @@ class RemdisUtil:
         return output_iu_buffer
 
     def concat_ius_body(self, iu_buffer):
-        concat_body = ''
-        for iu in iu_buffer:
-           concat_body += iu['body']
-        return concat_body
+        return ''.join(iu['body'] for iu in iu_buffer)
 
     def check_buffer_empty(self, in_buffer):
         return len(in_buffer) == 0
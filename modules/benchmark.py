@@ -0,0 +1,397 @@
+import sys, os
+import json
+import time
+import types
+import argparse
+import tempfile
+import importlib
+import threading
+import collections
+
+import yaml
+import numpy
+
+from base import RemdisModule, RemdisUpdateType, RemdisQueuePolicy
+import prompt.util as prompt_util
+
+# ターンテイキングのレイテンシのベンチマーク
+# 実際のDialogue・TextVAP・TimeOut・TTS・Audio_VAPを同一プロセス内のバスで動かし，
+# ASR・LLMをスタブに，AOUTを音声を再生しないシンクに置き換えてシナリオを実行する
+# 結果 (応答レイテンシ・割り込みによる停止レイテンシ・ターンごとのLLM呼び出し回数・
+# モジュールごとのCPU時間) はJSONで出力する
+
+# ベンチマーク対象のモジュール (モジュール名 -> (ファイル名, クラス名))
+MODULES = {'Dialogue': ('dialogue', 'Dialogue'),
+           'TextVAP': ('text_vap', 'TextVAP'),
+           'TimeOut': ('time_out', 'TimeOut'),
+           'TTS': ('tts', 'TTS'),
+           'Audio_VAP': ('audio_vap', 'Audio_VAP')}
+
+# モジュールごとのCPU時間の計測
+# スレッドを作成したスレッドのモジュールを引き継ぎ，終了したスレッドはthread_timeを，
+# 実行中のスレッドは/proc/self/task/<tid>/statを集計する
+class ThreadCPU:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.finished = collections.defaultdict(float)
+        self.running = {}
+        self.clock_ticks = os.sysconf('SC_CLK_TCK')
+
+    def install(self):
+        tracker = self
+        start = threading.Thread.start
+
+        def tracked_start(thread):
+            if not hasattr(thread, 'bench_module'):
+                thread.bench_module = getattr(threading.current_thread(), 'bench_module', 'harness')
+            run = thread.run
+
+            def tracked_run():
+                native_id = threading.get_native_id()
+                with tracker.lock:
+                    tracker.running[native_id] = thread.bench_module
+                try:
+                    run()
+                finally:
+                    with tracker.lock:
+                        del tracker.running[native_id]
+                        tracker.finished[thread.bench_module] += time.thread_time()
+
+            thread.run = tracked_run
+            start(thread)
+
+        threading.Thread.start = tracked_start
+
+    def cpu_times(self):
+        with self.lock:
+            times = collections.defaultdict(float, self.finished)
+            running = dict(self.running)
+        for native_id, module in running.items():
+            try:
+                with open('/proc/self/task/%d/stat' % native_id) as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+            except OSError:
+                continue
+            # utime, stime (statの14, 15番目のフィールド)
+            times[module] += (int(fields[11]) + int(fields[12])) / self.clock_ticks
+        return dict(times)
+
+# OpenAIのChatCompletion.createのスタブ
+# 最初のトークンまでttft秒待ち，以降はtoken_rateトークン/秒で1文字ずつ返す
+class StubLLM:
+    def __init__(self, config, bc_prompt):
+        self.ttft = config['ttft']
+        self.token_rate = config['token_rate']
+        self.response = config['response']
+        self.text_vap = config['text_vap']
+        self.bc_prompt = bc_prompt
+        self.lock = threading.Lock()
+        # (呼び出し時刻, 種類)
+        self.calls = []
+
+    def install(self):
+        try:
+            import openai
+        except ImportError:
+            openai = types.ModuleType('openai')
+            sys.modules['openai'] = openai
+        openai.ChatCompletion = types.SimpleNamespace(create=self.create)
+
+    def create(self, model=None, messages=None, max_tokens=None, stream=True, **kwargs):
+        # TextVAPは相槌判定用のプロンプトを最初に入力する
+        if messages and messages[0]['content'] == self.bc_prompt:
+            kind, text = 'text_vap', self.text_vap
+        else:
+            kind, text = 'response', self.response
+        with self.lock:
+            self.calls.append((time.time(), kind))
+        return self.stream(text)
+
+    def stream(self, text):
+        time.sleep(self.ttft)
+        for i, token in enumerate(text):
+            if i > 0:
+                time.sleep(1.0 / self.token_rate)
+            yield {'choices': [{'delta': {'content': token}}]}
+
+    def count_calls(self, start, end):
+        counts = collections.Counter()
+        with self.lock:
+            for t, kind in self.calls:
+                if start <= t < end:
+                    counts[kind] += 1
+        return dict(counts)
+
+# シナリオのトークンを音声認識結果として送信するASRのスタブ
+# 割り込みはAudio_VAPの代わりにUSER_TAKE_TURNを送信して再現する
+class StubASR(RemdisModule):
+    def __init__(self,
+                 pub_exchanges=['asr', 'vap']):
+        super().__init__(pub_exchanges=pub_exchanges)
+
+    def run(self):
+        pass
+
+    # トークンを順に送信し，COMMITを送信した時刻を返す
+    def speak(self, tokens, token_interval):
+        for i, token in enumerate(tokens):
+            if i > 0:
+                time.sleep(token_interval)
+            update_type = RemdisUpdateType.COMMIT if i == len(tokens) - 1 else RemdisUpdateType.ADD
+            snd_iu = self.createIU(token, 'asr', update_type)
+            snd_iu['stability'] = 0.0
+            snd_iu['confidence'] = 0.99
+            self.publish(snd_iu, 'asr')
+        return time.time()
+
+    def send_vap(self, event):
+        snd_iu = self.createIU(event, 'vap', RemdisUpdateType.ADD)
+        self.publish(snd_iu, 'vap')
+        return time.time()
+
+# マイクの代わりに無音を実時間で送信するモジュール (Audio_VAPを動かす場合)
+class StubAIN(RemdisModule):
+    def __init__(self,
+                 pub_exchanges=['ain']):
+        super().__init__(pub_exchanges=pub_exchanges)
+        self.frame_length = self.config['AIN']['frame_length']
+        self.chunk = bytes(2 * round(self.frame_length * self.config['AIN']['sample_rate']))
+
+    def run(self):
+        next_time = time.monotonic()
+        while True:
+            self.publish(self.createIU(self.chunk, 'ain', RemdisUpdateType.ADD), 'ain')
+            next_time += self.frame_length
+            time.sleep(max(0.0, next_time - time.monotonic()))
+
+# 音声合成の代わりに無音を出力するTTSのスタブ (torch・ttslearnがない環境用)
+# REVOKE・COMMITの扱いはTTSモジュールと同じ
+class StubTTS(RemdisModule):
+    def __init__(self,
+                 pub_exchanges=['tts'],
+                 sub_exchanges=['dialogue'],
+                 chars_per_sec=8,
+                 real_time_factor=0.1):
+        super().__init__(pub_exchanges=pub_exchanges,
+                         sub_exchanges=sub_exchanges)
+        self.rate = self.config['TTS']['sample_rate']
+        self.send_interval = self.config['TTS']['send_interval']
+        self.chunk_size = round(self.config['TTS']['frame_length'] * self.rate)
+        self.chars_per_sec = chars_per_sec
+        self.real_time_factor = real_time_factor
+
+        # 制御用のIU (COMMIT・REVOKEなど) を含むため破棄せずに空きを待つ
+        self.input_iu_buffer = self.mk_queue('input_iu_buffer', 100, RemdisQueuePolicy.BLOCK)
+        self.output_iu_buffer = self.mk_queue('output_iu_buffer', 200, RemdisQueuePolicy.BLOCK)
+        self.is_revoked = False
+
+    def run(self):
+        threading.Thread(target=self.subscribe, args=('dialogue', self.callback), daemon=True).start()
+        threading.Thread(target=self.synthesis_loop, daemon=True).start()
+        threading.Thread(target=self.send_loop, daemon=True).start()
+
+    def synthesis_loop(self):
+        while True:
+            if self.is_revoked:
+                self.input_iu_buffer.clear()
+            in_msg = self.input_iu_buffer.get()
+            num_samples = max(self.chunk_size,
+                              round(len(in_msg['body']) / self.chars_per_sec * self.rate))
+            time.sleep(num_samples / self.rate * self.real_time_factor)
+            for t in range(0, num_samples, self.chunk_size):
+                snd_iu = self.createIU(bytes(2 * self.chunk_size), 'tts', in_msg['update_type'])
+                snd_iu['data_type'] = 'audio'
+                self.output_iu_buffer.put(snd_iu)
+
+    def send_loop(self):
+        while True:
+            if self.is_revoked:
+                self.output_iu_buffer.clear()
+                self.send_commitIU()
+            snd_iu = self.output_iu_buffer.get()
+            self.publish(snd_iu, 'tts')
+            time.sleep(self.send_interval)
+            if snd_iu['update_type'] == RemdisUpdateType.COMMIT:
+                self.send_commitIU()
+
+    def send_commitIU(self):
+        snd_iu = self.createIU('', 'tts', RemdisUpdateType.COMMIT)
+        snd_iu['data_type'] = 'audio'
+        self.publish(snd_iu, 'tts')
+
+    def callback(self, ch, method, properties, in_msg):
+        if in_msg['update_type'] == RemdisUpdateType.REVOKE:
+            self.is_revoked = True
+        else:
+            self.input_iu_buffer.put(in_msg)
+            self.is_revoked = False
+
+# 音声を再生せずに受信時刻のみを記録するシンク (AOUTの代わり)
+class NullSink(RemdisModule):
+    def __init__(self,
+                 sub_exchanges=['tts.control']):
+        super().__init__(sub_exchanges=sub_exchanges)
+        self.condition = threading.Condition()
+        # (受信時刻, 'audio' or 'commit')
+        self.events = []
+
+    def run(self):
+        threading.Thread(target=self.subscribe, args=('tts.control', self.callback), daemon=True).start()
+
+    def callback(self, ch, method, properties, in_msg):
+        kind = 'commit' if in_msg['update_type'] == RemdisUpdateType.COMMIT else 'audio'
+        with self.condition:
+            self.events.append((time.time(), kind))
+            self.condition.notify_all()
+
+    # since以降に受信したkindの最初の時刻 (timeout秒以内に受信しなければNone)
+    def wait_event(self, kind, since, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                for t, event_kind in self.events:
+                    if t >= since and event_kind == kind:
+                        return t
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+
+def summarize(values):
+    values = [v for v in values if v is not None]
+    if not values:
+        return None
+    return {'count': len(values),
+            'mean': float(numpy.mean(values)),
+            'p50': float(numpy.percentile(values, 50)),
+            'p90': float(numpy.percentile(values, 90)),
+            'max': float(numpy.max(values))}
+
+class Benchmark:
+    def __init__(self, scenario, config_filename, timeout):
+        self.scenario = scenario
+        self.timeout = timeout
+
+        # 同一プロセス内のバスを使う設定ファイルを作成し，全モジュールで使用
+        with open(config_filename, encoding='utf-8') as f:
+            config = yaml.safe_load(f)
+        for section, values in (scenario.get('config') or {}).items():
+            config.setdefault(section, {}).update(values)
+        bus_config = config.setdefault('BUS', {})
+        bus_config['transport'] = 'inprocess'
+        bus_config.pop('shared_memory', None)
+        config.pop('METRICS', None)
+        config_file = tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False, encoding='utf-8')
+        yaml.safe_dump(config, config_file, allow_unicode=True)
+        config_file.close()
+        os.environ['REMDIS_CONFIG'] = config_file.name
+        self.config = config
+
+        self.cpu = ThreadCPU()
+        self.cpu.install()
+        bc_prompt = prompt_util.load_prompts(config['ChatGPT']['prompts'])['BC']
+        self.llm = StubLLM(scenario['LLM'], bc_prompt)
+        self.llm.install()
+
+    # モジュールを作成して実行 (モジュールが作成したスレッドのCPU時間はそのモジュールに計上)
+    def start_module(self, name, factory):
+        main_thread = threading.current_thread()
+        main_thread.bench_module = name
+        try:
+            module = factory()
+        finally:
+            del main_thread.bench_module
+        t = threading.Thread(target=module.run, daemon=True)
+        t.bench_module = name
+        t.start()
+        return module
+
+    def start(self):
+        module_names = self.scenario['modules']
+        for name in module_names:
+            if name == 'StubTTS':
+                stub_tts_config = self.scenario.get('STUB_TTS') or {}
+                self.start_module(name, lambda: StubTTS(**stub_tts_config))
+                continue
+            filename, class_name = MODULES[name]
+            module_class = getattr(importlib.import_module(filename), class_name)
+            self.start_module(name, module_class)
+        if 'Audio_VAP' in module_names:
+            self.start_module('StubAIN', StubAIN)
+        self.sink = self.start_module('NullSink', NullSink)
+        self.asr = self.start_module('StubASR', StubASR)
+
+    def run(self):
+        self.start()
+        start_time = time.time()
+        turns = []
+        last_end_time = time.time()
+        for turn in self.scenario['turns']:
+            time.sleep(max(0.0, last_end_time + turn.get('pause', 1.0) - time.time()))
+            result = {'text': turn['text'], 'start': time.time()}
+            commit_time = self.asr.speak(turn['text'].split(), turn.get('token_interval', 0.15))
+
+            # ユーザ発話終端から最初の音声の受信まで
+            first_audio_time = self.sink.wait_event('audio', commit_time, self.timeout)
+            result['response_latency'] = first_audio_time - commit_time \
+                if first_audio_time is not None else None
+
+            if first_audio_time is not None and 'barge_in' in turn:
+                # 割り込みから音声合成のCOMMIT (送信停止) の受信まで
+                time.sleep(max(0.0, first_audio_time + turn['barge_in'] - time.time()))
+                barge_in_time = self.asr.send_vap('USER_TAKE_TURN')
+                stop_time = self.sink.wait_event('commit', barge_in_time, self.timeout)
+                result['barge_in_stop_latency'] = stop_time - barge_in_time \
+                    if stop_time is not None else None
+                last_end_time = stop_time or time.time()
+            elif first_audio_time is not None:
+                last_end_time = self.sink.wait_event('commit', first_audio_time, self.timeout) or time.time()
+            else:
+                last_end_time = time.time()
+            turns.append(result)
+
+        # ターンごとのLLMの呼び出し回数 (ターン開始から次のターン開始まで)
+        end_time = time.time()
+        for i, result in enumerate(turns):
+            turn_end = turns[i + 1]['start'] if i + 1 < len(turns) else end_time
+            result['llm_calls'] = self.llm.count_calls(result['start'], turn_end)
+
+        return {'scenario': self.scenario,
+                'wall_time': end_time - start_time,
+                'summary': {
+                    'response_latency': summarize([r['response_latency'] for r in turns]),
+                    'barge_in_stop_latency': summarize([r['barge_in_stop_latency']
+                                                        for r in turns if 'barge_in_stop_latency' in r]),
+                    'llm_calls_per_turn': summarize([sum(r['llm_calls'].values()) for r in turns])},
+                'cpu_time': self.cpu.cpu_times(),
+                'turns': turns}
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end turn-taking latency benchmark')
+    parser.add_argument('--scenario', default='../config/benchmark.yaml')
+    parser.add_argument('--config', default='../config/config.yaml')
+    parser.add_argument('--modules', default=None,
+                        help='comma separated modules to run (overrides the scenario)')
+    parser.add_argument('--output', default='benchmark_result.json')
+    parser.add_argument('--timeout', type=float, default=30.0,
+                        help='seconds to wait for each system response')
+    args = parser.parse_args()
+
+    with open(args.scenario, encoding='utf-8') as f:
+        scenario = yaml.safe_load(f)
+    if args.modules:
+        scenario['modules'] = args.modules.split(',')
+
+    result = Benchmark(scenario, args.config, args.timeout).run()
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(result, f, ensure_ascii=False, indent=1)
+    json.dump({'summary': result['summary'], 'cpu_time': result['cpu_time']},
+              sys.stdout, ensure_ascii=False, indent=1)
+    sys.stdout.write('\n')
+    sys.stdout.flush()
+
+    # 各モジュールのスレッドは終了しないためプロセスごと終了
+    os._exit(0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import sys, os
+import time
+import yaml
+import argparse
+
+import numpy
+import torch
+from scipy.io import wavfile
+
+from _audio_vap.optimized import load_checkpoint_model, export_vap, OptimizedVAP
+
+# VAPモデルのチェックポイントから推論用の成果物 (int8動的量子化・TorchScript) を作成し，
+# 録音した音声で元のモデル (fp32) との出力の差を確認するスクリプト
+# 成果物はconfig.yamlのVAP.artifact_filenameに指定するとAudio_VAPが読み込む
+
+# 録音したステレオ音声 (0ch: システム, 1ch: ユーザ) をAudio_VAPと同じ窓で推論し，
+# 最終フレームのp_now・p_futureを比較
+def check_parity(model, optimized, wav_filename, num_samples, hop, threshold):
+    rate, data = wavfile.read(wav_filename)
+    if data.ndim != 2 or data.shape[1] != 2:
+        raise ValueError('%s is not a stereo wav file' % wav_filename)
+    if rate != optimized.sample_rate:
+        raise ValueError('sample rate of %s is %d (expected %d)'
+                         % (wav_filename, rate, optimized.sample_rate))
+    if data.dtype == numpy.int16:
+        data = data.astype(numpy.float32) / 32768.0
+    audio = numpy.concatenate((numpy.zeros((num_samples, 2), dtype=numpy.float32),
+                               data.astype(numpy.float32))).T
+
+    hop_samples = int(hop * rate)
+    diffs = {'p_now': [], 'p_future': []}
+    agreements = 0
+    times = {'fp32': 0.0, 'optimized': 0.0}
+    ends = range(num_samples + hop_samples, audio.shape[1] + 1, hop_samples)
+    if len(ends) == 0:
+        raise ValueError('%s is shorter than the hop' % wav_filename)
+    for end in ends:
+        window = torch.from_numpy(numpy.ascontiguousarray(audio[:, end - num_samples:end])).unsqueeze(0)
+        window = window.to(optimized.device)
+
+        start_time = time.perf_counter()
+        ref = model.probs(window)
+        times['fp32'] += time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        out = optimized.probs(window)
+        times['optimized'] += time.perf_counter() - start_time
+
+        events = []
+        for result in (ref, out):
+            score_n = result['p_now'][0, -1].item()
+            score_f = result['p_future'][0, -1].item()
+            events.append((score_n >= threshold, score_f >= threshold))
+        agreements += events[0] == events[1]
+        for key in diffs:
+            diffs[key].append(abs(ref[key][0, -1].item() - out[key][0, -1].item()))
+
+    result = {key: (max(values), sum(values) / len(values)) for key, values in diffs.items()}
+    sys.stderr.write('Parity check: %d windows of %s\n' % (len(ends), wav_filename))
+    for key, (max_diff, mean_diff) in result.items():
+        sys.stderr.write('  %s: max diff %.4f, mean diff %.4f\n' % (key, max_diff, mean_diff))
+    sys.stderr.write('  threshold decisions agree: %.1f%%\n' % (100.0 * agreements / len(ends)))
+    sys.stderr.write('  inference time: fp32 %.1f ms, optimized %.1f ms (x%.2f)\n'
+                     % (1000 * times['fp32'] / len(ends),
+                        1000 * times['optimized'] / len(ends),
+                        times['fp32'] / max(times['optimized'], 1e-9)))
+    return max(max_diff for max_diff, _ in result.values())
+
+def main():
+    parser = argparse.ArgumentParser(description='Build an optimized VAP inference artifact')
+    parser.add_argument('--config', default='../config/config.yaml')
+    parser.add_argument('--output', default='../models/vap/vap_optimized.pt')
+    parser.add_argument('--no-quantize', action='store_true',
+                        help='only trace the fp32 model')
+    parser.add_argument('--device', default=None,
+                        help='device to trace the fp32 model on, where the artifact is run '
+                             '(default: cpu for the quantized model, otherwise cuda/mps if available)')
+    parser.add_argument('--check', default=None,
+                        help='stereo wav file (0ch: system, 1ch: user) for the parity check')
+    parser.add_argument('--hop', type=float, default=0.5,
+                        help='hop of the parity check windows (sec)')
+    parser.add_argument('--tolerance', type=float, default=0.05,
+                        help='maximum allowed difference of p_now/p_future')
+    args = parser.parse_args()
+
+    with open(args.config, encoding='utf-8') as f:
+        config = yaml.safe_load(f)
+    model_filename = config['VAP']['model_filename']
+    num_samples = int(config['VAP']['buffer_length'] * config['TTS']['sample_rate'])
+    threshold = config['VAP']['threshold']
+
+    # 量子化した推論はCPUのみ
+    # TorchScriptのグラフはトレース時のデバイスに固定されるため，fp32のモデルは推論するデバイスでトレース
+    if args.device:
+        device = args.device
+    elif not args.no_quantize:
+        device = 'cpu'
+    elif torch.cuda.is_available():
+        device = 'cuda'
+    elif torch.backends.mps.is_available():
+        device = 'mps'
+    else:
+        device = 'cpu'
+
+    torch.set_grad_enabled(False)
+    model = load_checkpoint_model(model_filename)
+    dirname = os.path.dirname(args.output)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    export_vap(model, args.output, num_samples,
+               quantize=not args.no_quantize,
+               source=os.path.basename(model_filename),
+               device=device)
+    sys.stderr.write('Saved VAP artifact: %s (device: %s)\n' % (args.output, device))
+
+    if args.check:
+        optimized = OptimizedVAP(args.output)
+        max_diff = check_parity(model, optimized,
+                                args.check, num_samples, args.hop, threshold)
+        if max_diff > args.tolerance:
+            sys.stderr.write('Parity check failed: max diff %.4f > %.4f\n' % (max_diff, args.tolerance))
+            sys.exit(1)
+        sys.stderr.write('Parity check passed\n')
+
+if __name__ == '__main__':
+    main()
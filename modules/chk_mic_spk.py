@@ -5,7 +5,6 @@ import queue
 import time
 
 import threading
-import base64
 import librosa
 
 from base import RemdisModule, RemdisUpdateType
@@ -39,7 +38,7 @@ class ChkMicSpk(RemdisModule):
     # メッセージ受信用コールバック関数
     def callback(self, ch, method, properties, in_msg):
         in_msg = self.parse_msg(in_msg)
-        chunk = base64.b64decode(in_msg['body'].encode())
+        chunk = self.decode_audio(in_msg['body'])
         self.input_audio_buffer.put(chunk)
 
     def plot_and_publish_loop(self):
@@ -48,7 +47,6 @@ class ChkMicSpk(RemdisModule):
             chunk = self.input_audio_buffer.get()
             data = numpy.frombuffer(chunk, dtype=numpy.int16)
 
-            chunk = base64.b64encode(chunk).decode('utf-8')
             snd_iu = self.createIU(chunk, 'tts',
                                    RemdisUpdateType.ADD)
             snd_iu['data_type'] = 'audio'
@@ -1,16 +1,14 @@
 import sys, os
 import numpy
-import queue
 
 import time
 
 import threading
-import base64
 import librosa
 
 from ttslearn.pretrained import create_tts_engine
 import pyopenjtalk
-from base import RemdisModule, RemdisUpdateType
+from base import RemdisModule, RemdisUpdateType, RemdisQueuePolicy
 
 import torch
 device = torch.device("cpu")
@@ -28,8 +26,9 @@ class TTS(RemdisModule):
         self.sample_width = self.config['TTS']['sample_width']
         self.chunk_size = round(self.frame_length * self.rate)
 
-        self.input_iu_buffer = queue.Queue()
-        self.output_iu_buffer = queue.Queue()
+        # 制御用のIU (COMMIT・REVOKEなど) を含むため破棄せずに空きを待つ
+        self.input_iu_buffer = self.mk_queue('input_iu_buffer', 100, RemdisQueuePolicy.BLOCK)
+        self.output_iu_buffer = self.mk_queue('output_iu_buffer', 200, RemdisQueuePolicy.BLOCK)
         self.engine_name = self.config['TTS']['engine_name']
         self.model_name = self.config['TTS']['model_name']
         if self.engine_name == 'ttslearn':
@@ -56,7 +55,7 @@ class TTS(RemdisModule):
         while True:
             # REVOKEされた場合は送信を停止 (= ユーザ割り込み時の処理)
             if self.is_revoked:
-                self.output_iu_buffer = queue.Queue()
+                self.output_iu_buffer.clear()
                 self.send_commitIU('tts')
                 
             snd_iu = self.output_iu_buffer.get(block=True)
@@ -96,7 +95,7 @@ class TTS(RemdisModule):
                 t = 0
                 while t <= len(x):
                     chunk = x[t:t+self.chunk_size]
-                    chunk = base64.b64encode(chunk.astype(numpy.int16).tobytes()).decode('utf-8')
+                    chunk = chunk.astype(numpy.int16).tobytes()
                     snd_iu = self.createIU(chunk, 'tts',
                                            update_type)
                     snd_iu['data_type'] = 'audio'
@@ -105,7 +104,7 @@ class TTS(RemdisModule):
             else:
                 # テキストがない場合も処理を実施
                 x = numpy.zeros(self.chunk_size)
-                chunk = base64.b64encode(x.astype(numpy.int16).tobytes()).decode('utf-8')
+                chunk = x.astype(numpy.int16).tobytes()
                 snd_iu = self.createIU(chunk, 'tts',
                                        update_type)
                 snd_iu['data_type'] = 'audio'
@@ -1,18 +1,17 @@
 import sys
-import threading
-import queue
+import asyncio
 import time
 import re
 
-from base import RemdisModule, RemdisState, RemdisUtil, RemdisUpdateType
+from base import AsyncRemdisModule, RemdisState, RemdisUtil, RemdisUpdateType, RemdisQueuePolicy, RemdisIUBuffer
 from llm import ResponseChatGPT
 import prompt.util as prompt_util
 
 
-class Dialogue(RemdisModule):
+class Dialogue(AsyncRemdisModule):
     def __init__(self, 
                  pub_exchanges=['dialogue', 'dialogue2'],
-                 sub_exchanges=['asr', 'vap', 'tts', 'bc', 'emo_act']):
+                 sub_exchanges=['asr', 'vap', 'tts.control', 'bc', 'emo_act']):
         super().__init__(pub_exchanges=pub_exchanges,
                          sub_exchanges=sub_exchanges)
 
@@ -26,86 +25,53 @@ class Dialogue(RemdisModule):
 
         # IUおよび応答の処理用バッファ
         self.system_utterance_end_time = 0.0
-        self.input_iu_buffer = queue.Queue()
-        self.bc_iu_buffer = queue.Queue()
-        self.emo_act_iu_buffer = queue.Queue()
+        # 制御用のIU (COMMIT・REVOKEなど) を含むため破棄せずに空きを待つ
+        self.input_iu_buffer = self.mk_queue('input_iu_buffer', 1000, RemdisQueuePolicy.BLOCK)
+        self.bc_iu_buffer = self.mk_queue('bc_iu_buffer')
+        self.emo_act_iu_buffer = self.mk_queue('emo_act_iu_buffer')
         self.output_iu_buffer = []
-        self.llm_buffer = queue.Queue()
+        # 応答候補は最新の音声認識結果を使うものが選ばれるため古いものから破棄
+        self.llm_buffer = self.mk_queue('llm_buffer', 16, RemdisQueuePolicy.DROP_OLDEST)
 
         # 対話状態管理
-        self.event_queue = queue.Queue()
+        # 状態遷移のイベント (TTS_COMMITなど) は失うと状態が戻らないため破棄しない
+        self.event_queue = self.mk_queue('event_queue', 100, RemdisQueuePolicy.BLOCK)
         self.state = 'idle'
         self._is_running = True
 
         # IU処理用の関数
         self.util_func = RemdisUtil()
 
-    # メインループ
-    def run(self):
-        # 音声認識結果受信スレッド
-        t1 = threading.Thread(target=self.listen_asr_loop)
-        # 音声合成結果受信スレッド
-        t2 = threading.Thread(target=self.listen_tts_loop)
-        # ターンテイキングイベント受信スレッド
-        t3 = threading.Thread(target=self.listen_vap_loop)
-        # 相槌生成結果受信スレッド
-        t4 = threading.Thread(target=self.listen_bc_loop)
-        # 表情・行動情報受信スレッド
-        t5 = threading.Thread(target=self.listen_emo_act_loop)
-        # 逐次応答生成スレッド
-        t6 = threading.Thread(target=self.parallel_response_generation)
-        # 状態制御スレッド
-        t7 = threading.Thread(target=self.state_management)
-        # 表情・行動制御スレッド
-        t8 = threading.Thread(target=self.emo_act_management)
-
-        # スレッド実行
-        t1.start()
-        t2.start()
-        t3.start()
-        t4.start()
-        t5.start()
-        t6.start()
-        t7.start()
-        t8.start()
-
-    # 音声認識結果受信用のコールバックを登録
-    def listen_asr_loop(self):
-        self.subscribe('asr', self.callback_asr)
-
-    # 音声合成結果受信用のコールバックを登録
-    def listen_tts_loop(self):
-        self.subscribe('tts', self.callback_tts)
-
-    # VAP情報受信用のコールバックを登録
-    def listen_vap_loop(self):
-        self.subscribe('vap', self.callback_vap)
-
-    # バックチャネル受信用のコールバックを登録
-    def listen_bc_loop(self):
-        self.subscribe('bc', self.callback_bc)
-
-    # 表情・行動情報受信用のコールバックを登録
-    def listen_emo_act_loop(self):
-        self.subscribe('emo_act', self.callback_emo_act)
+    # ハンドラ・タスクの登録
+    # (ハンドラ・タスクは全て同じイベントループ上で実行され，LLMの呼び出し1回は1タスクとなる)
+    async def main(self):
+        await self.subscribe_async('asr', self.callback_asr)
+        # 音声データは不要なため制御情報のみを受信
+        await self.subscribe_async('tts.control', self.callback_tts)
+        await self.subscribe_async('vap', self.callback_vap)
+        await self.subscribe_async('bc', self.callback_bc)
+        await self.subscribe_async('emo_act', self.callback_emo_act)
+        # 逐次応答生成タスク
+        self.create_task(self.parallel_response_generation())
+        # 状態制御タスク
+        self.create_task(self.state_management())
+        # 表情・行動制御タスク
+        self.create_task(self.emo_act_management())
 
     # 随時受信される音声認識結果に対して並列に応答を生成
-    def parallel_response_generation(self):
-        # 受信したIUを保持しておく変数
-        iu_memory = []
+    async def parallel_response_generation(self):
+        # 受信したIUを保持しておくバッファ (REVOKEされたIUはバッファから削除される)
+        iu_memory = RemdisIUBuffer()
         new_iu_count = 0
 
         while True:
             # IUを受信して保存
-            input_iu = self.input_iu_buffer.get()
+            input_iu = await self.input_iu_buffer.get()
             iu_memory.append(input_iu)
             
-            # IUがREVOKEだった場合はメモリから削除
-            if input_iu['update_type'] == RemdisUpdateType.REVOKE:
-                iu_memory = self.util_func.remove_revoked_ius(iu_memory)
             # ADD/COMMITの場合は応答候補生成
-            else:
-                user_utterance = self.util_func.concat_ius_body(iu_memory)
+            if input_iu['update_type'] != RemdisUpdateType.REVOKE:
+                user_utterance = iu_memory.text()
                 if user_utterance == '':
                     continue
 
@@ -120,29 +86,35 @@ class Dialogue(RemdisModule):
                 # パラレルな応答生成処理
                 # 応答がはじまったらLLM自体がbufferに格納される
                 llm = ResponseChatGPT(self.config, self.prompts)
+                llm.last_asr_iu = input_iu
                 last_asr_iu_id = input_iu['id']
-                t = threading.Thread(
-                    target=llm.run,
-                    args=(input_iu['timestamp'],
-                          user_utterance,
-                          self.dialogue_history,
-                          last_asr_iu_id,
-                          self.llm_buffer)
-                )
-                t.start()
+                self.create_task(self.generate_response(llm,
+                                                        input_iu['timestamp'],
+                                                        user_utterance,
+                                                        last_asr_iu_id))
 
                 # ユーザ発話終端の処理
                 if input_iu['update_type'] == RemdisUpdateType.COMMIT:
                     # ASR_COMMITはユーザ発話が前のシステム発話より時間的に後になる場合だけ発出
                     if self.system_utterance_end_time < input_iu['timestamp']:
-                        self.event_queue.put('ASR_COMMIT')
-                    iu_memory = []
+                        await self.event_queue.put('ASR_COMMIT')
+                    iu_memory.clear()
+
+    # 応答候補を1つ生成 (ブロッキングなChatGPTの呼び出しのみスレッドプールで実行)
+    async def generate_response(self, llm, asr_timestamp, user_utterance, last_asr_iu_id):
+        await self.run_in_thread(llm.run,
+                                 asr_timestamp,
+                                 user_utterance,
+                                 self.dialogue_history,
+                                 last_asr_iu_id)
+        # 応答が生成され始めたLLMをバッファに格納
+        await self.llm_buffer.put(llm)
 
     # 対話状態を管理
-    def state_management(self):
+    async def state_management(self):
         while True:
             # イベントに応じて状態を遷移
-            event = self.event_queue.get()
+            event = await self.event_queue.get()
             prev_state = self.state
             self.state = RemdisState.transition[self.state][event]
             self.log(f'********** State: {prev_state} -> {self.state}, Trigger: {event} **********')
@@ -163,16 +135,16 @@ class Dialogue(RemdisModule):
             # 直前の状態がidleの場合にイベントに応じて処理を実行
             elif prev_state == 'idle':
                 if event == 'SYSTEM_BACKCHANNEL':
-                    self.send_backchannel()
+                    await self.send_backchannel()
                 if event == 'SYSTEM_TAKE_TURN':
-                    self.send_response()
+                    await self.send_response()
                 if event == 'ASR_COMMIT':
-                    self.send_response()
+                    await self.send_response()
 
     # 表情・感情を管理
-    def emo_act_management(self):
+    async def emo_act_management(self):
         while True:
-            iu = self.emo_act_iu_buffer.get()
+            iu = await self.emo_act_iu_buffer.get()
             # 感情または行動の送信
             expression_and_action = {}
             if 'emotion' in iu['body']:
@@ -188,27 +160,19 @@ class Dialogue(RemdisModule):
 
 
     # システム発話を送信
-    def send_response(self):
+    async def send_response(self):
         if self.llm_buffer.empty():
             # 一瞬スリープしてそれでも応答生成中にならなければシステムから発話を開始
-            time.sleep(0.1)
+            await asyncio.sleep(0.1)
             if self.llm_buffer.empty():
                 llm = ResponseChatGPT(self.config, self.prompts)
-                t = threading.Thread(
-                    target=llm.run,
-                    args=(time.time(),
-                            None,
-                            self.dialogue_history,
-                            None,
-                            self.llm_buffer)
-                )
-                t.start()
+                self.create_task(self.generate_response(llm, time.time(), None, None))
 
         # 応答が生成され始めたLLMの中で一番新しい音声認識結果を使っているものを選択して送信
-        selected_llm = self.llm_buffer.get()
+        selected_llm = await self.llm_buffer.get()
         latest_asr_time = selected_llm.asr_time
         while not self.llm_buffer.empty():
-            llm = self.llm_buffer.get()
+            llm = self.llm_buffer.get_nowait()
             if llm.asr_time > latest_asr_time:
                 selected_llm = llm
 
@@ -216,7 +180,10 @@ class Dialogue(RemdisModule):
         sys.stderr.write('Resp: Selected user utterance: %s\n' % (selected_llm.user_utterance))
         if selected_llm.response is not None:
             conc_response = ''
-            for part in selected_llm.response:
+            parents = [selected_llm.last_asr_iu]
+            is_first_phrase = True
+            # 応答の断片はストリームから受信し次第スレッドプール経由で受け取る
+            async for part in self.iterate_in_thread(selected_llm.response):
                 # 表情・動作を送信
                 expression_and_action = {}
                 if 'expression' in part and part['expression'] != 'normal':
@@ -224,7 +191,7 @@ class Dialogue(RemdisModule):
                 if 'action' in part and part['action'] != 'wait':
                     expression_and_action['action'] = part['action']
                 if expression_and_action:
-                    snd_iu = self.createIU(expression_and_action, 'dialogue2', RemdisUpdateType.ADD)
+                    snd_iu = self.createIU(expression_and_action, 'dialogue2', RemdisUpdateType.ADD, parents)
                     snd_iu['data_type'] = 'expression_and_action'
                     self.printIU(snd_iu)
                     self.publish(snd_iu, 'dialogue2')
@@ -233,7 +200,12 @@ class Dialogue(RemdisModule):
                 # 生成中に状態が変わることがあるためその確認の後，発話を送信
                 if 'phrase' in part:
                     if self.state == 'talking':
-                        snd_iu = self.createIU(part['phrase'], 'dialogue', RemdisUpdateType.ADD)
+                        snd_iu = self.createIU(part['phrase'], 'dialogue', RemdisUpdateType.ADD, parents)
+                        # 最初の発話にはLLMの応答生成開始・最初のトークン受信の時刻を記録
+                        if is_first_phrase:
+                            self.add_hop(snd_iu, 'llm_request', selected_llm.response.request_time)
+                            self.add_hop(snd_iu, 'llm_first_token', selected_llm.response.first_token_time)
+                            is_first_phrase = False
                         self.printIU(snd_iu)
                         self.publish(snd_iu, 'dialogue')
                         self.output_iu_buffer.append(snd_iu)
@@ -253,15 +225,15 @@ class Dialogue(RemdisModule):
         self.publish(snd_iu, 'dialogue')
 
     # バックチャネルを送信
-    def send_backchannel(self):
-        iu = self.bc_iu_buffer.get()
+    async def send_backchannel(self):
+        iu = await self.bc_iu_buffer.get()
 
         # 現在の状態がidleの場合のみ後続の処理を実行してバックチャネルを送信
         if self.state != 'idle':
             return
 
         # 相槌の送信
-        snd_iu = self.createIU(iu['body']['bc'], 'dialogue', RemdisUpdateType.ADD)
+        snd_iu = self.createIU(iu['body']['bc'], 'dialogue', RemdisUpdateType.ADD, [iu])
         self.printIU(snd_iu)
         self.publish(snd_iu, 'dialogue')
 
@@ -273,34 +245,29 @@ class Dialogue(RemdisModule):
             self.publish(iu, iu['exchange'])
         self.output_iu_buffer = []
 
-    # 音声認識結果受信用のコールバック
-    def callback_asr(self, ch, method, properties, in_msg):
-        in_msg = self.parse_msg(in_msg)
-        self.input_iu_buffer.put(in_msg)
+    # 音声認識結果受信用のハンドラ (入力バッファが一杯の場合は空きを待つ)
+    async def callback_asr(self, in_msg):
+        await self.input_iu_buffer.put(in_msg)
             
-    # 音声合成結果受信用のコールバック
-    def callback_tts(self, ch, method, properties, in_msg):
-        in_msg = self.parse_msg(in_msg)
+    # 音声合成結果受信用のハンドラ
+    async def callback_tts(self, in_msg):
         if in_msg['update_type'] == RemdisUpdateType.COMMIT:
             self.output_iu_buffer = []
             self.system_utterance_end_time = in_msg['timestamp']
-            self.event_queue.put('TTS_COMMIT')
-
-    # VAP情報受信用のコールバック
-    def callback_vap(self, ch, method, properties, in_msg):
-        in_msg = self.parse_msg(in_msg)
-        self.event_queue.put(in_msg['body'])
-
-    # バックチャネル受信用のコールバック
-    def callback_bc(self, ch, method, properties, in_msg):
-        in_msg = self.parse_msg(in_msg)
-        self.bc_iu_buffer.put(in_msg)
-        self.event_queue.put('SYSTEM_BACKCHANNEL')
-
-    # 表情・行動情報受信用のコールバック
-    def callback_emo_act(self, ch, method, properties, in_msg):
-        in_msg = self.parse_msg(in_msg)
-        self.emo_act_iu_buffer.put(in_msg)
+            await self.event_queue.put('TTS_COMMIT')
+
+    # VAP情報受信用のハンドラ
+    async def callback_vap(self, in_msg):
+        await self.event_queue.put(in_msg['body'])
+
+    # バックチャネル受信用のハンドラ
+    async def callback_bc(self, in_msg):
+        self.bc_iu_buffer.put_nowait(in_msg)
+        await self.event_queue.put('SYSTEM_BACKCHANNEL')
+
+    # 表情・行動情報受信用のハンドラ
+    def callback_emo_act(self, in_msg):
+        self.emo_act_iu_buffer.put_nowait(in_msg)
 
     # 対話履歴を更新
     def history_management(self, role, utt):
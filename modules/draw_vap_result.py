@@ -1,14 +1,12 @@
 import sys, os
 import numpy
-import queue
 
 import time
 
 import threading
-import base64
 import librosa
 
-from base import RemdisModule, RemdisUpdateType
+from base import RemdisModule, RemdisUpdateType, RemdisQueuePolicy
 
 from matplotlib import pyplot as plt
 from matplotlib import animation
@@ -18,7 +16,7 @@ class DrawScore(RemdisModule):
                  sub_exchanges=['score']):
         super().__init__(sub_exchanges=sub_exchanges)
         
-        self.input_iu_buffer = queue.Queue()
+        self.input_iu_buffer = self.mk_queue('input_iu_buffer', 10, RemdisQueuePolicy.COALESCE)
         self._is_running = True
 
     def run(self):
@@ -2,7 +2,6 @@ import sys, os
 
 import pyaudio
 import queue
-import base64
 
 import threading
 
@@ -45,7 +44,6 @@ class AIN(RemdisModule):
     def listen_wav_loop(self):
         while self.stream.is_active():
             input_data = self.stream.read(self.chunk_size, exception_on_overflow=False)
-            input_data = base64.b64encode(input_data).decode('utf-8')
             snd_iu = self.createIU(input_data, 'ain',
                                    RemdisUpdateType.ADD)
             # マイクから入力されたものをそのまま送信
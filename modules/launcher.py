@@ -0,0 +1,279 @@
+import sys, os
+import time
+import yaml
+import signal
+import argparse
+import tempfile
+import importlib
+import threading
+import subprocess
+
+# 構成ファイル (config/topology.yaml) に従って全モジュールを並列に起動・監視するスーパーバイザ
+# processモード: モジュールごとに別プロセスで起動し，CPUコアの割り当て・torchのスレッド数の設定・
+#               異常終了時の再起動を行う
+# threadモード: 1プロセス内でスレッドとして起動 (バスはinprocess)
+# 全モジュールのモデルの読み込み・ウォームアップが完了した時点で準備完了を表示する
+
+MODULES_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# torchを使うモジュールのスレッド数
+# torch_threadsの指定 > cpusのコア数 > 割り当てのないコアをtorchを使うモジュールで等分
+def torch_thread_budget(specs):
+    torch_specs = [spec for spec in specs if spec.get('torch')]
+    pinned_cores = set(core for spec in specs for core in spec.get('cpus') or [])
+    free_cores = max(1, len(available_cpus()) - len(pinned_cores))
+    unassigned = [spec for spec in torch_specs
+                  if 'torch_threads' not in spec and not spec.get('cpus')]
+
+    budget = {}
+    for spec in torch_specs:
+        if 'torch_threads' in spec:
+            budget[spec['name']] = spec['torch_threads']
+        elif spec.get('cpus'):
+            budget[spec['name']] = len(spec['cpus'])
+        else:
+            budget[spec['name']] = max(1, free_cores // len(unassigned))
+    return budget
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+# 割り当て可能なコアのみに絞り込む (存在しないコアのみの場合は割り当てない)
+def valid_cpus(spec):
+    cpus = [core for core in spec.get('cpus') or [] if core in available_cpus()]
+    if spec.get('cpus') and not cpus:
+        sys.stderr.write('Launcher: cpus %s of %s are not available, not pinning\n'
+                         % (spec['cpus'], spec['name']))
+    return cpus if hasattr(os, 'sched_setaffinity') else []
+
+# torchのスレッド数を指定する環境変数
+def torch_thread_env(num_threads):
+    return {'OMP_NUM_THREADS': str(num_threads),
+            'MKL_NUM_THREADS': str(num_threads),
+            'REMDIS_TORCH_THREADS': str(num_threads)}
+
+# 別プロセスで実行するモジュール
+class ModuleProcess:
+    def __init__(self, spec, env, ready_dir, log_dir, restart_config):
+        self.spec = spec
+        self.name = spec['name']
+        self.env = env
+        self.cpus = valid_cpus(spec)
+        self.ready_file = os.path.join(ready_dir, self.name + '.ready')
+        self.log_filename = os.path.join(log_dir, self.name + '.log') if log_dir else None
+        self.max_restarts = restart_config.get('max_restarts', 5)
+        self.backoff = restart_config.get('backoff', 1.0)
+
+        self.process = None
+        self.restarts = 0
+        self.restart_time = None
+        self.start_time = None
+        self.ready_time = None
+        self.failed = False
+
+    def start(self):
+        if os.path.exists(self.ready_file):
+            os.remove(self.ready_file)
+        env = dict(self.env)
+        env['REMDIS_READY_FILE'] = self.ready_file
+
+        cpus = self.cpus
+        preexec_fn = (lambda: os.sched_setaffinity(0, cpus)) if cpus else None
+        log_file = open(self.log_filename, 'a') if self.log_filename else None
+        self.process = subprocess.Popen([sys.executable, self.spec['file'] + '.py'],
+                                        cwd=MODULES_DIR,
+                                        env=env,
+                                        stdout=log_file,
+                                        stderr=subprocess.STDOUT if log_file else None,
+                                        preexec_fn=preexec_fn)
+        if log_file:
+            log_file.close()
+        self.start_time = time.time()
+        self.ready_time = None
+
+    def is_ready(self):
+        if self.ready_time is None and os.path.exists(self.ready_file):
+            self.ready_time = time.time()
+            sys.stderr.write('Launcher: %s is ready (%.1f sec)\n'
+                             % (self.name, self.ready_time - self.start_time))
+        return self.ready_time is not None
+
+    # 終了していれば再起動を予約し，予約時刻になれば再起動
+    def supervise(self):
+        if self.failed:
+            return
+        if self.restart_time is not None:
+            if time.time() >= self.restart_time:
+                self.restart_time = None
+                self.restarts += 1
+                sys.stderr.write('Launcher: restarting %s (%d/%d)\n'
+                                 % (self.name, self.restarts, self.max_restarts))
+                self.start()
+            return
+
+        returncode = self.process.poll()
+        if returncode is None:
+            return
+        if self.restarts >= self.max_restarts:
+            sys.stderr.write('Launcher: %s exited with %d, giving up\n' % (self.name, returncode))
+            self.failed = True
+            return
+        delay = min(30.0, self.backoff * 2 ** self.restarts)
+        sys.stderr.write('Launcher: %s exited with %d, restarting in %.1f sec\n'
+                         % (self.name, returncode, delay))
+        self.restart_time = time.time() + delay
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+
+    def wait(self, timeout):
+        if self.process is None:
+            return
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+class Launcher:
+    def __init__(self, topology, config_filename):
+        self.topology = topology
+        self.config_filename = os.path.abspath(config_filename)
+        self.specs = topology['modules']
+        self.ready_timeout = topology.get('ready_timeout', 180)
+
+    def run(self):
+        if self.topology.get('mode', 'process') == 'thread':
+            self.run_threads()
+        else:
+            self.run_processes()
+
+    def run_processes(self):
+        budget = torch_thread_budget(self.specs)
+        ready_dir = tempfile.mkdtemp(prefix='remdis_ready_')
+        log_dir = self.topology.get('log_dir')
+        if log_dir:
+            log_dir = os.path.join(MODULES_DIR, log_dir)
+            os.makedirs(log_dir, exist_ok=True)
+
+        modules = []
+        for spec in self.specs:
+            env = dict(os.environ)
+            env['REMDIS_CONFIG'] = self.config_filename
+            if spec['name'] in budget:
+                env.update(torch_thread_env(budget[spec['name']]))
+            modules.append(ModuleProcess(spec, env, ready_dir, log_dir,
+                                         self.topology.get('restart') or {}))
+
+        # SIGTERMでも子プロセスを終了させる
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        # 全モジュールを同時に起動
+        start_time = time.time()
+        for module in modules:
+            module.start()
+        all_ready = False
+        try:
+            while True:
+                for module in modules:
+                    module.supervise()
+                    module.is_ready()
+                if not all_ready:
+                    if all(module.ready_time is not None for module in modules):
+                        all_ready = True
+                        sys.stderr.write('Launcher: all modules are ready (%.1f sec)\n'
+                                         % (time.time() - start_time))
+                    elif time.time() - start_time > self.ready_timeout:
+                        not_ready = [module.name for module in modules if module.ready_time is None]
+                        sys.stderr.write('Launcher: modules not ready after %.0f sec: %s\n'
+                                         % (self.ready_timeout, ', '.join(not_ready)))
+                        all_ready = True
+                time.sleep(0.2)
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            for module in modules:
+                module.stop()
+            for module in modules:
+                module.wait(5.0)
+
+    def run_threads(self):
+        # 同一プロセス内のバスを使う設定ファイルを作成
+        with open(self.config_filename, encoding='utf-8') as f:
+            config = yaml.safe_load(f)
+        config.setdefault('BUS', {})['transport'] = 'inprocess'
+        config['BUS'].pop('shared_memory', None)
+        config_file = tempfile.NamedTemporaryFile('w', suffix='.yaml', delete=False, encoding='utf-8')
+        yaml.safe_dump(config, config_file, allow_unicode=True)
+        config_file.close()
+        os.environ['REMDIS_CONFIG'] = config_file.name
+
+        # torchのスレッドプールはプロセス内で共有されるため，割り当ての合計を上限とする
+        budget = torch_thread_budget(self.specs)
+        if budget:
+            os.environ.update(torch_thread_env(min(sum(budget.values()), len(available_cpus()))))
+        if any(spec.get('cpus') for spec in self.specs):
+            sys.stderr.write('Launcher: cpus are ignored in thread mode\n')
+
+        # モデルの読み込みを並列に行うため，モジュールの作成もスレッドで行う
+        start_time = time.time()
+        modules = {}
+        def start_module(spec):
+            try:
+                module_class = getattr(importlib.import_module(spec['file']), spec['class'])
+                module = module_class()
+                modules[spec['name']] = module
+                threading.Thread(target=module.run, daemon=True).start()
+            except Exception as e:
+                sys.stderr.write('Launcher: failed to start %s: %r\n' % (spec['name'], e))
+
+        sys.path.insert(0, MODULES_DIR)
+        os.chdir(MODULES_DIR)
+        threads = [threading.Thread(target=start_module, args=(spec,), daemon=True)
+                   for spec in self.specs]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        deadline = start_time + self.ready_timeout
+        for name, module in modules.items():
+            if module.ready.wait(max(0.0, deadline - time.time())):
+                sys.stderr.write('Launcher: %s is ready\n' % name)
+            else:
+                sys.stderr.write('Launcher: %s is not ready after %.0f sec\n' % (name, self.ready_timeout))
+        if len(modules) == len(self.specs):
+            sys.stderr.write('Launcher: all modules are ready (%.1f sec)\n' % (time.time() - start_time))
+
+        try:
+            while True:
+                time.sleep(1.0)
+        except KeyboardInterrupt:
+            pass
+        # 各モジュールのスレッドは終了しないためプロセスごと終了
+        os._exit(0)
+
+def main():
+    parser = argparse.ArgumentParser(description='Launch and supervise all modules')
+    parser.add_argument('--topology', default='../config/topology.yaml')
+    parser.add_argument('--config', default='../config/config.yaml')
+    parser.add_argument('--mode', choices=['process', 'thread'], default=None,
+                        help='overrides the mode in the topology')
+    parser.add_argument('--only', default=None,
+                        help='comma separated module names to launch')
+    args = parser.parse_args()
+
+    with open(args.topology, encoding='utf-8') as f:
+        topology = yaml.safe_load(f)
+    if args.mode:
+        topology['mode'] = args.mode
+    if args.only:
+        names = args.only.split(',')
+        topology['modules'] = [spec for spec in topology['modules'] if spec['name'] in names]
+
+    Launcher(topology, args.config).run()
+
+if __name__ == '__main__':
+    main()
@@ -48,6 +48,10 @@ class ResponseGenerator:
 
         self.log(f"Call ChatGPT: {query=}")
 
+        # 応答生成の開始時刻と最初のトークンの受信時刻 (レイテンシの記録用)
+        self.request_time = time.time()
+        self.first_token_time = None
+
         # ChatGPTに対話文脈を入力してストリーミング形式で応答の生成を開始
         self.response = openai.ChatCompletion.create(
             model=self.model,
@@ -86,6 +90,8 @@ class ResponseGenerator:
 
             if 'content' in chunk_message.keys():
                 new_token = chunk_message.get('content')
+                if self.first_token_time is None:
+                    self.first_token_time = time.time()
 
                 # 応答の断片を追加
                 if new_token != "/":
@@ -136,9 +142,12 @@ class ResponseChatGPT():
         self.response = ''
         self.last_asr_iu_id = ''
         self.asr_time = 0.0
+        # 応答生成の元になった音声認識結果のIU (lineageの記録用)
+        self.last_asr_iu = None
     
     # ChatGPTの呼び出しを開始
-    def run(self, asr_timestamp, user_utterance, dialogue_history, last_asr_iu_id, parent_llm_buffer):
+    # (ストリームの開始までブロックするため，Dialogueモジュールからはスレッドプールで実行される)
+    def run(self, asr_timestamp, user_utterance, dialogue_history, last_asr_iu_id):
         self.user_utterance = user_utterance
         self.last_asr_iu_id = last_asr_iu_id
         self.asr_time = asr_timestamp
@@ -146,9 +155,6 @@ class ResponseChatGPT():
         # ChataGPTを呼び出して応答の生成を開始
         self.response = ResponseGenerator(self.config, asr_timestamp, user_utterance, dialogue_history, self.prompts)
 
-        # 自身をDialogueモジュールが持つLLMバッファに追加
-        parent_llm_buffer.put(self)
-
 
 if __name__ == "__main__":
     openai.api_key = '<enter your API key>'
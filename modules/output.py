@@ -1,17 +1,17 @@
 import sys, os
 
 import pyaudio
-import queue
-import base64
 
 import threading
 
-from base import RemdisModule, RemdisUpdateType
+from base import RemdisModule, RemdisUpdateType, RemdisQueuePolicy
 
 class AOUT(RemdisModule):
     def __init__(self,
+                 pub_exchanges=['trace'],
                  sub_exchanges=['tts']):
-        super().__init__(sub_exchanges=sub_exchanges)
+        super().__init__(pub_exchanges=pub_exchanges,
+                         sub_exchanges=sub_exchanges)
         
         self.frame_length = self.config['AOUT']['frame_length']
         self.rate = self.config['AOUT']['sample_rate']
@@ -19,7 +19,9 @@ class AOUT(RemdisModule):
         self.channel = self.config['AOUT']['num_channel']
         self.chunk_size = round(self.frame_length * self.rate * self.sample_width)
 
-        self.input_iu_buffer = queue.Queue()
+        self.input_iu_buffer = self.mk_queue('input_iu_buffer', 100, RemdisQueuePolicy.DROP_OLDEST)
+        # 再生開始をトレースした応答 (TTSの入力IUのid)
+        self.traced_parent_ids = None
 
         # 音声再生ストリームの宣言
         self._p = pyaudio.PyAudio()
@@ -59,9 +61,17 @@ class AOUT(RemdisModule):
         while True:
             in_msg = self.input_iu_buffer.get(block=True)
             
+            # 再生開始時刻をトレース用に送信 (応答ごとに最初のチャンクのみ)
+            if 'trace' in self.trace_exchanges and 'lineage' in in_msg:
+                parent_ids = [parent[0] for parent in in_msg['lineage']['parents']]
+                if parent_ids and parent_ids != self.traced_parent_ids:
+                    self.traced_parent_ids = parent_ids
+                    snd_iu = self.createIU('playout', 'trace', RemdisUpdateType.ADD, [in_msg])
+                    self.publish(snd_iu, 'trace')
+
             # 音声再生処理
             t = 0
-            output_wav = base64.b64decode(in_msg['body'].encode())
+            output_wav = self.decode_audio(in_msg['body'])
             while t <= len(output_wav):
                 output_segment = output_wav[t:t+self.chunk_size]
                 self.stream.write(output_segment)
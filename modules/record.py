@@ -0,0 +1,165 @@
+import sys, os
+import json
+import time
+import mmap
+import argparse
+import threading
+
+import numpy
+
+from base import RemdisModule, RemdisSerializer
+
+# セッションファイルの形式
+# <name>.dat: binary形式でシリアライズしたIUを受信順に追記
+# <name>.idx: IUごとの固定長のインデックス (受信時刻・.dat内の位置・長さ・exchange番号) を追記
+# <name>.json: exchange番号とexchange名の対応
+SESSION_INDEX_DTYPE = numpy.dtype([('time', '<f8'),
+                                   ('offset', '<u8'),
+                                   ('length', '<u4'),
+                                   ('exchange', '<u2')])
+
+# セッションファイルへの書き込み (追記のみ)
+class SessionWriter:
+    def __init__(self, name):
+        self.name = name
+        dirname = os.path.dirname(name)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.data_file = open(name + '.dat', 'ab')
+        self.index_file = open(name + '.idx', 'ab')
+        self.offset = self.data_file.tell()
+        self.exchanges = []
+        self.serializer = RemdisSerializer()
+        self.lock = threading.Lock()
+
+    def write(self, iu, exchange, received_time):
+        data = self.serializer.encode_binary(iu)
+        with self.lock:
+            # 終了後に受信したIUは記録しない
+            if self.data_file.closed:
+                return
+            if exchange not in self.exchanges:
+                self.exchanges.append(exchange)
+                self.write_exchanges()
+            entry = numpy.array([(received_time, self.offset, len(data),
+                                  self.exchanges.index(exchange))],
+                                dtype=SESSION_INDEX_DTYPE)
+            self.data_file.write(data)
+            self.index_file.write(entry.tobytes())
+            self.offset += len(data)
+
+    def write_exchanges(self):
+        with open(self.name + '.json', 'w', encoding='utf-8') as f:
+            json.dump({'exchanges': self.exchanges}, f)
+
+    # インデックスより先にデータを書き出す (インデックスが指すデータは常にファイル上に存在する)
+    def flush(self):
+        with self.lock:
+            self.data_file.flush()
+            self.index_file.flush()
+
+    def close(self):
+        with self.lock:
+            self.data_file.close()
+            self.index_file.close()
+
+# セッションファイルの読み込み (インデックス・データともにメモリマップで参照)
+class SessionReader:
+    def __init__(self, name):
+        with open(name + '.json', encoding='utf-8') as f:
+            self.exchanges = json.load(f)['exchanges']
+
+        if os.path.getsize(name + '.idx') > 0:
+            self.index = numpy.memmap(name + '.idx', dtype=SESSION_INDEX_DTYPE, mode='r')
+        else:
+            self.index = numpy.zeros(0, dtype=SESSION_INDEX_DTYPE)
+        # 受信スレッドが複数あるため書き込み順と時刻順が一致しない場合は時刻順に並べ替え
+        if numpy.any(numpy.diff(self.index['time']) < 0):
+            self.index = self.index[numpy.argsort(self.index['time'], kind='stable')]
+
+        self.data_file = open(name + '.dat', 'rb')
+        self.data = mmap.mmap(self.data_file.fileno(), 0, access=mmap.ACCESS_READ) \
+            if os.path.getsize(name + '.dat') > 0 else b''
+        self.serializer = RemdisSerializer()
+
+    # exchangesとstart/end (セッション開始からの秒数) で絞り込んだインデックス
+    def select(self, exchanges=None, start=None, end=None):
+        index = self.index
+        if len(index) == 0:
+            return index
+        t0 = index['time'][0]
+        if start is not None:
+            index = index[index['time'] >= t0 + start]
+        if end is not None:
+            index = index[index['time'] < t0 + end]
+        if exchanges is not None:
+            ids = [i for i, exchange in enumerate(self.exchanges) if exchange in exchanges]
+            index = index[numpy.isin(index['exchange'], ids)]
+        return index
+
+    # (受信時刻, exchange, IU) を時刻順に返す
+    def records(self, exchanges=None, start=None, end=None):
+        for entry in self.select(exchanges, start, end):
+            offset = int(entry['offset'])
+            message = self.data[offset:offset+int(entry['length'])]
+            yield (float(entry['time']),
+                   self.exchanges[entry['exchange']],
+                   self.serializer.decode_binary(message))
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data_file.close()
+
+# 全てのexchangeを受信してセッションファイルに記録するモジュール
+class Recorder(RemdisModule):
+    def __init__(self,
+                 output=None,
+                 sub_exchanges=['ain', 'asr', 'vap', 'score', 'dialogue', 'dialogue2',
+                                'tts', 'bc', 'emo_act']):
+        super().__init__(sub_exchanges=sub_exchanges)
+
+        if output is None:
+            output = time.strftime('../log/session_%Y%m%d_%H%M%S')
+        self.writer = SessionWriter(output)
+        self._is_running = True
+
+    def run(self):
+        # exchangeごとの受信スレッド
+        for exchange in self.sub_exchanges:
+            threading.Thread(target=self.listen_loop, args=(exchange,), daemon=True).start()
+        sys.stderr.write('Recording to %s\n' % self.writer.name)
+
+        # 1秒ごとにファイルに書き出す
+        try:
+            while self._is_running:
+                time.sleep(1.0)
+                self.writer.flush()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.writer.close()
+
+    def listen_loop(self, exchange):
+        self.subscribe(exchange, lambda ch, method, properties, in_msg:
+                       self.callback(exchange, in_msg))
+
+    def callback(self, exchange, in_msg):
+        self.writer.write(in_msg, exchange, time.time())
+
+def main():
+    parser = argparse.ArgumentParser(description='Record IUs on the bus to a session file')
+    parser.add_argument('--output', default=None,
+                        help='session file name without extension (default: ../log/session_<date>)')
+    parser.add_argument('--exchanges', default=None,
+                        help='comma separated exchanges to record (default: all)')
+    args = parser.parse_args()
+
+    kwargs = {}
+    if args.exchanges:
+        kwargs['sub_exchanges'] = args.exchanges.split(',')
+    recorder = Recorder(output=args.output, **kwargs)
+    recorder.run()
+
+if __name__ == '__main__':
+    main()
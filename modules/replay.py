@@ -0,0 +1,81 @@
+import sys
+import time
+import argparse
+
+from base import RemdisModule
+from record import SessionReader
+
+# セッションファイルに記録したIUを記録時の間隔で再送信するモジュール
+# speed: 再生速度 (1.0で記録時と同じ間隔，0では待たずに送信)
+# keep_timestamps: Falseの場合はタイムスタンプを再送信時刻に合わせてずらす
+#                  (Dialogueなどはタイムスタンプの前後関係を比較するため)
+class Replayer(RemdisModule):
+    def __init__(self, session, speed=1.0, exchanges=None, start=None, end=None,
+                 keep_timestamps=False):
+        self.reader = SessionReader(session)
+        self.index = self.reader.select(exchanges, start, end)
+        self.exchanges = exchanges
+        self.start = start
+        self.end = end
+        self.speed = speed
+        self.keep_timestamps = keep_timestamps
+
+        pub_exchanges = [self.reader.exchanges[i] for i in sorted(set(self.index['exchange']))]
+        super().__init__(pub_exchanges=pub_exchanges)
+
+    def run(self):
+        if len(self.index) == 0:
+            sys.stderr.write('No IUs to replay\n')
+            return
+
+        t0 = float(self.index['time'][0])
+        replay_start_time = time.time()
+        replay_start_monotonic = time.monotonic()
+        count = 0
+        for received_time, exchange, iu in self.reader.records(self.exchanges, self.start, self.end):
+            if self.speed > 0:
+                elapsed = (received_time - t0) / self.speed
+                wait_time = replay_start_monotonic + elapsed - time.monotonic()
+                if wait_time > 0:
+                    time.sleep(wait_time)
+                replay_time = replay_start_time + elapsed
+            else:
+                replay_time = time.time()
+
+            if not self.keep_timestamps:
+                iu['timestamp'] += replay_time - received_time
+                if iu['monotonic'] is not None:
+                    iu['monotonic'] = iu['timestamp'] + replay_start_monotonic - replay_start_time
+            self.publish(iu, exchange)
+            count += 1
+
+        self.flush()
+        proc_time = time.time() - replay_start_time
+        sys.stderr.write('Replayed %d IUs in %.3f sec (%.1f IUs/sec)\n'
+                         % (count, proc_time, count / max(proc_time, 1e-9)))
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay IUs recorded by record.py')
+    parser.add_argument('session', help='session file name without extension')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay speed (1.0: real time, 0: as fast as possible)')
+    parser.add_argument('--exchanges', default=None,
+                        help='comma separated exchanges to replay (default: all recorded)')
+    parser.add_argument('--start', type=float, default=None,
+                        help='start time in seconds from the beginning of the session')
+    parser.add_argument('--end', type=float, default=None,
+                        help='end time in seconds from the beginning of the session')
+    parser.add_argument('--keep-timestamps', action='store_true',
+                        help='publish IUs with the recorded timestamps')
+    args = parser.parse_args()
+
+    replayer = Replayer(args.session,
+                        speed=args.speed,
+                        exchanges=args.exchanges.split(',') if args.exchanges else None,
+                        start=args.start,
+                        end=args.end,
+                        keep_timestamps=args.keep_timestamps)
+    replayer.run()
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,15 @@
 import sys
 import json
-import threading
-import queue
 import time
 import re
 
 import openai
 
-from base import RemdisModule, RemdisUtil, RemdisUpdateType
+from base import AsyncRemdisModule, RemdisUtil, RemdisUpdateType, RemdisIUBuffer
 from base import MMDAgentEXLabel
 import prompt.util as prompt_util
 
-class TextVAP(RemdisModule):
+class TextVAP(AsyncRemdisModule):
     def __init__(self, 
                  pub_exchanges=['bc', 'vap', 'emo_act'],
                  sub_exchanges=['asr']):
@@ -29,9 +27,9 @@ class TextVAP(RemdisModule):
         self.text_vap_interval = self.config['TEXT_VAP']['text_vap_interval']
 
         # バックチャネルの送信回数を制限するための変数
+        # (テキストVAPのタスクは全て同じイベントループ上で実行されるためロックは不要)
         self.max_verbal_backchannel_num = self.config['TEXT_VAP']['max_verbal_backchannel_num']
         self.max_nonverbal_backchannel_num = self.config['TEXT_VAP']['max_nonverbal_backchannel_num']
-        self.backchannel_sent_lock = threading.Lock()
         self.sent_verbal_backchannel_counter = 0
         self.last_verbal_backchannel_timestamp = -1
         self.sent_nonverbal_backchannel_counter = 0
@@ -41,26 +39,21 @@ class TextVAP(RemdisModule):
         self.is_listening = False
 
         # IU処理用のバッファ
-        self.input_iu_buffer = queue.Queue()
+        self.input_iu_buffer = self.mk_queue('input_iu_buffer')
         
         # IU処理用の関数
         self.util_func = RemdisUtil()
 
-    # メインループ
-    def run(self):
-        t1 = threading.Thread(target=self.listen_asr_loop)
-        t2 = threading.Thread(target=self.parallel_text_vap)
-
-        t1.start()
-        t2.start()
-
-    # 音声認識結果受信用のコールバックを登録
-    def listen_asr_loop(self):
-        self.subscribe('asr', self.callback_asr)
+    # ハンドラ・タスクの登録
+    async def main(self):
+        await self.subscribe_async('asr', self.callback_asr)
+        self.create_task(self.parallel_text_vap())
 
     # 随時受信される音声認識結果に対して並列にテキストVAPを実施
-    def parallel_text_vap(self):
-        iu_memory = []
+    # (LLMの呼び出し1回ごとに1タスクを生成)
+    async def parallel_text_vap(self):
+        # 受信したIUを保持しておくバッファ (REVOKEされたIUはバッファから削除される)
+        iu_memory = RemdisIUBuffer()
         new_iu_count = 0
 
         while True:
@@ -70,15 +63,12 @@ class TextVAP(RemdisModule):
                 self.sent_verbal_backchannel_counter = 0
                 self.sent_nonverbal_backchannel_counter = 0
                 
-            input_iu = self.input_iu_buffer.get()
+            input_iu = await self.input_iu_buffer.get()
             iu_memory.append(input_iu)
             
-            # IUがREVOKEだった場合はメモリから削除
-            if input_iu['update_type'] == RemdisUpdateType.REVOKE:
-                iu_memory = self.util_func.remove_revoked_ius(iu_memory)
             # ADD/COMMITの場合は応答候補生成
-            else:
-                user_utterance = self.util_func.concat_ius_body(iu_memory)
+            if input_iu['update_type'] != RemdisUpdateType.REVOKE:
+                user_utterance = iu_memory.text()
                 if user_utterance == '':
                     continue
 
@@ -91,18 +81,13 @@ class TextVAP(RemdisModule):
                         new_iu_count = 0
 
                 # パラレルなテキストVAP処理
-                t = threading.Thread(
-                    target=self.run_text_vap,
-                    args=(input_iu['timestamp'],
-                          user_utterance)
-                )
-                t.start()
+                self.create_task(self.run_text_vap(input_iu['timestamp'], user_utterance))
 
                 # ユーザ発話終端の処理
                 if input_iu['update_type'] == RemdisUpdateType.COMMIT:
                     self.is_listening = False
                     self.sent_backchannel_counter = 0
-                    iu_memory = []
+                    iu_memory.clear()
     
     # テキストVAPの判定結果をパース
     def parse_line_for_text_vap(self, line):
@@ -128,8 +113,18 @@ class TextVAP(RemdisModule):
     def parse_line_for_action(self, message):
         return self.parse_line_for_backchannel(message)[0]
 
+    # ChatGPTにプロンプトを入力してストリーミング形式で応答の生成を開始
+    # (ストリームの開始までブロックするためスレッドプールで実行される)
+    def create_completion(self, messages):
+        return openai.ChatCompletion.create(
+            model=self.model,
+            messages=messages,
+            max_tokens=self.max_tokens,
+            stream=True
+        )
+
     # テキストVAPを実行
-    def run_text_vap(self, asr_timestamp, query):
+    async def run_text_vap(self, asr_timestamp, query):
         # ChatGPTに入力するプロンプト
         messages = [
             {'role': 'user', 'content': self.prompts['BC']},
@@ -137,20 +132,14 @@ class TextVAP(RemdisModule):
             {'role': 'user', 'content': query}
         ]
         
-        # ChatGPTにプロンプトを入力してストリーミング形式で応答の生成を開始
-        self.response = openai.ChatCompletion.create(
-            model=self.model,
-            messages=messages,
-            max_tokens=self.max_tokens,
-            stream=True
-        )
+        response = await self.run_in_thread(self.create_completion, messages)
 
         # ChatGPTの応答を保持しおく変数
         current_completion_line = ""
         nonverbal_backchannel = {}
 
-        # ChatGPTの応答を順次パース
-        for chunk in self.response:
+        # ChatGPTの応答を順次パース (チャンクは受信し次第スレッドプール経由で受け取る)
+        async for chunk in self.iterate_in_thread(response):
             chunk_message = chunk['choices'][0]['delta']
             if 'content' in chunk_message.keys():
                 new_token = chunk_message.get('content')
@@ -197,30 +186,29 @@ class TextVAP(RemdisModule):
 
     # バックチャネルを送信
     def send_backchannel(self, asr_timestamp, content):
-        with self.backchannel_sent_lock:
-            triggered = False
-
-            if 'bc' in content:
-                if (self.last_verbal_backchannel_timestamp < asr_timestamp
-                    and self.is_listening
-                    and self.sent_verbal_backchannel_counter < self.max_verbal_backchannel_num):
-                    self.last_verbal_backchannel_timestamp = asr_timestamp
-                    self.sent_verbal_backchannel_counter += 1
-                    triggered = True
-                    exchange = 'bc'
-            elif 'expression' in content or 'action' in content:
-                if (self.last_nonverbal_backchannel_timestamp < asr_timestamp
-                    and self.is_listening
-                    and self.sent_nonverbal_backchannel_counter < self.max_nonverbal_backchannel_num):
-                    self.last_nonverbal_backchannel_timestamp = asr_timestamp
-                    self.sent_nonverbal_backchannel_counter += 1
-                    triggered = True
-                    exchange = 'emo_act'
-
-            if triggered:
-                snd_iu = self.createIU(content, exchange, RemdisUpdateType.ADD)
-                self.printIU(snd_iu)
-                self.publish(snd_iu, exchange)
+        triggered = False
+
+        if 'bc' in content:
+            if (self.last_verbal_backchannel_timestamp < asr_timestamp
+                and self.is_listening
+                and self.sent_verbal_backchannel_counter < self.max_verbal_backchannel_num):
+                self.last_verbal_backchannel_timestamp = asr_timestamp
+                self.sent_verbal_backchannel_counter += 1
+                triggered = True
+                exchange = 'bc'
+        elif 'expression' in content or 'action' in content:
+            if (self.last_nonverbal_backchannel_timestamp < asr_timestamp
+                and self.is_listening
+                and self.sent_nonverbal_backchannel_counter < self.max_nonverbal_backchannel_num):
+                self.last_nonverbal_backchannel_timestamp = asr_timestamp
+                self.sent_nonverbal_backchannel_counter += 1
+                triggered = True
+                exchange = 'emo_act'
+
+        if triggered:
+            snd_iu = self.createIU(content, exchange, RemdisUpdateType.ADD)
+            self.printIU(snd_iu)
+            self.publish(snd_iu, exchange)
     
     # システム発話の開始を送信
     def send_system_take_turn(self):
@@ -228,10 +216,9 @@ class TextVAP(RemdisModule):
         self.printIU(snd_iu)
         self.publish(snd_iu, 'vap')
                             
-    # メッセージ受信用コールバック関数
-    def callback_asr(self, ch, method, properties, in_msg):
-        in_msg = self.parse_msg(in_msg)
-        self.input_iu_buffer.put(in_msg)
+    # メッセージ受信用ハンドラ
+    def callback_asr(self, in_msg):
+        self.input_iu_buffer.put_nowait(in_msg)
 
     # デバッグ用のログを出力
     def log(self, *args, **kwargs):
@@ -0,0 +1,211 @@
+import sys
+import json
+import time
+import atexit
+import collections
+
+from base import AsyncRemdisModule, RemdisUpdateType
+
+# レイテンシのヒストグラム (ミリ秒)
+class LatencyHistogram:
+    # 各ビンの上限 (ミリ秒)
+    bounds = [5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+    def __init__(self, max_samples=10000):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0
+        self.sum = 0.0
+        self.max = 0.0
+        # パーセンタイル計算用の直近のサンプル
+        self.samples = collections.deque(maxlen=max_samples)
+
+    def add(self, seconds):
+        value = seconds * 1000.0
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.total += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        self.samples.append(value)
+
+    def percentile(self, samples, p):
+        return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+    def to_dict(self):
+        samples = sorted(self.samples)
+        buckets = {'le_%d' % bound: count for bound, count in zip(self.bounds, self.counts)}
+        buckets['inf'] = self.counts[-1]
+        return {'count': self.total,
+                'mean': self.sum / self.total if self.total else None,
+                'p50': self.percentile(samples, 0.5) if samples else None,
+                'p90': self.percentile(samples, 0.9) if samples else None,
+                'p99': self.percentile(samples, 0.99) if samples else None,
+                'max': self.max,
+                'buckets': buckets}
+
+# IUのlineageからターンごとのクリティカルパスを再構成し，レイテンシを集計するモジュール
+# ASR(COMMIT) -> Dialogue(最初の発話) -> TTS(最初の音声) -> AOUT(再生開始)
+# 設定ファイルのTRACE.enabledを有効にして各モジュールを起動する
+class Tracer(AsyncRemdisModule):
+    def __init__(self,
+                 sub_exchanges=['asr', 'dialogue', 'tts.control', 'trace']):
+        super().__init__(sub_exchanges=sub_exchanges)
+
+        trace_config = self.config.get('TRACE') or {}
+        self.output_filename = trace_config.get('output', 'trace_latency.json')
+        self.interval = trace_config.get('interval', 10.0)
+
+        # 受信したIUの処理時刻と受信したモジュール (id -> (処理時刻, 受信モジュール))．古いものから破棄
+        self.ius = collections.OrderedDict()
+        self.max_ius = 10000
+
+        # メトリクス名 -> ヒストグラム
+        self.histograms = collections.defaultdict(LatencyHistogram)
+
+        # 集計中のターンと直近の完了したターン
+        self.turn = None
+        self.turns = collections.deque(maxlen=100)
+        # 音声合成時間を記録済みの発話IUのid
+        self.synthesized = collections.OrderedDict()
+
+    # ハンドラ・タイマーの登録
+    async def main(self):
+        for exchange in self.sub_exchanges:
+            await self.subscribe_async(exchange, self.callback)
+        self.call_every(self.interval, self.dump)
+        atexit.register(self.dump)
+
+    def callback(self, iu):
+        lineage = iu.get('lineage')
+        if lineage is None:
+            return
+        hops = self.hop_times(iu)
+        self.record_hops(iu, lineage, hops)
+
+        exchange = iu['exchange']
+        if exchange == 'asr':
+            self.on_asr(iu, hops)
+        elif exchange == 'dialogue':
+            self.on_dialogue(iu, hops)
+        elif exchange == 'tts':
+            self.on_tts(iu, lineage, hops)
+        elif exchange == 'trace':
+            self.on_playout(iu, lineage, hops)
+
+        self.ius[iu['id']] = (hops, set())
+        if len(self.ius) > self.max_ius:
+            self.ius.popitem(last=False)
+
+    # lineageの処理時刻を 処理名 -> 時刻 の辞書に変換 (受信時刻は親IUの情報として別に記録される)
+    def hop_times(self, iu):
+        hops = {}
+        for producer, event, t in iu['lineage']['hops']:
+            if producer == iu['producer'] and t is not None:
+                hops[event] = t
+        return hops
+
+    # 全てのIUに共通する区間のレイテンシ
+    # queue.<exchange>: 送信キューでの待ち時間
+    # transport.<exchange>: 送信から受信側モジュールでの受信まで
+    # process.<module>: 親IUの受信からIUの作成まで
+    def record_hops(self, iu, lineage, hops):
+        exchange = iu['exchange']
+        if 'enqueue' in hops and 'publish' in hops:
+            self.histograms['queue.%s' % exchange].add(hops['publish'] - hops['enqueue'])
+        for parent_id, parent_exchange, received in lineage['parents']:
+            if received is None:
+                continue
+            self.histograms['process.%s' % iu['producer']].add(hops['create'] - received)
+            # 1つの受信IUから複数のIUが作成される場合 (TTSの音声チャンクなど) は1回だけ記録
+            parent = self.ius.get(parent_id)
+            if parent is not None and 'publish' in parent[0] and iu['producer'] not in parent[1]:
+                parent[1].add(iu['producer'])
+                self.histograms['transport.%s' % parent_exchange].add(received - parent[0]['publish'])
+
+    # ユーザ発話終端 (ASRのCOMMIT) で新しいターンを開始
+    def on_asr(self, iu, hops):
+        if iu['update_type'] != RemdisUpdateType.COMMIT:
+            return
+        self.finish_turn()
+        self.turn = {'user_end': hops['create'], 'asr_id': iu['id']}
+
+    # ターン開始後の最初のシステム発話
+    def on_dialogue(self, iu, hops):
+        if 'llm_first_token' in hops and 'llm_request' in hops:
+            self.histograms['llm_ttft'].add(hops['llm_first_token'] - hops['llm_request'])
+
+        turn = self.turn
+        if (turn is None or 'dialogue_id' in turn
+                or iu['update_type'] != RemdisUpdateType.ADD
+                or hops['create'] < turn['user_end']):
+            return
+        turn['dialogue_id'] = iu['id']
+        turn['dialogue_create'] = hops['create']
+        if 'llm_request' in hops:
+            turn['llm_request'] = hops['llm_request']
+            turn['llm_first_token'] = hops.get('llm_first_token')
+
+    # 発話IUごとに最初の音声の合成時間を記録
+    def on_tts(self, iu, lineage, hops):
+        if not lineage['parents']:
+            return
+        parent_id = lineage['parents'][0][0]
+        if parent_id in self.synthesized:
+            return
+        self.synthesized[parent_id] = True
+        if len(self.synthesized) > self.max_ius:
+            self.synthesized.popitem(last=False)
+
+        if 'synthesis_start' in hops:
+            self.histograms['tts_synthesis'].add(hops['create'] - hops['synthesis_start'])
+
+        turn = self.turn
+        if turn is not None and turn.get('dialogue_id') == parent_id:
+            turn['tts_id'] = iu['id']
+            turn['tts_synthesis_start'] = hops.get('synthesis_start')
+            turn['tts_publish'] = hops.get('publish')
+
+    # 音声の再生開始
+    def on_playout(self, iu, lineage, hops):
+        if not lineage['parents']:
+            return
+        parent_id, parent_exchange, received = lineage['parents'][0]
+        parent = self.ius.get(parent_id)
+        if parent is not None and 'publish' in parent[0]:
+            self.histograms['aout_playout_delay'].add(hops['create'] - parent[0]['publish'])
+
+        turn = self.turn
+        if turn is not None and 'tts_id' in turn and 'playout' not in turn:
+            turn['playout'] = hops['create']
+            self.histograms['user_end_to_system_start'].add(turn['playout'] - turn['user_end'])
+            self.finish_turn()
+
+    # ターンの記録を確定
+    # 再生開始の記録がない場合 (MMDAgent-EXで再生する場合など) は最初の音声の送信までを記録
+    def finish_turn(self):
+        turn = self.turn
+        if turn is None:
+            return
+        if 'playout' not in turn and turn.get('tts_publish') is not None:
+            self.histograms['user_end_to_first_tts'].add(turn['tts_publish'] - turn['user_end'])
+        self.turns.append(turn)
+        self.turn = None
+
+    # ヒストグラムと直近のターンをJSONで書き出し
+    def dump(self):
+        result = {'time': time.time(),
+                  'histograms': {name: histogram.to_dict()
+                                 for name, histogram in sorted(self.histograms.items())},
+                  'turns': list(self.turns)}
+        with open(self.output_filename, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=1)
+        sys.stderr.write('Trace: %d turns written to %s\n' % (len(self.turns), self.output_filename))
+
+def main():
+    tracer = Tracer()
+    tracer.run()
+
+if __name__ == '__main__':
+    main()
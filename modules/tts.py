@@ -1,21 +1,28 @@
 import sys, os
 import numpy
-import queue
+import asyncio
 
 import time
 
-import threading
-import base64
 import librosa
 
 from ttslearn.pretrained import create_tts_engine
 import pyopenjtalk
-from base import RemdisModule, RemdisUpdateType
+from base import AsyncRemdisModule, RemdisUpdateType, RemdisQueuePolicy
 
 import torch
 device = torch.device("cpu")
 
-class TTS(RemdisModule):
+# launcher.pyが割り当てたtorchのスレッド数
+if 'REMDIS_TORCH_THREADS' in os.environ:
+    torch.set_num_threads(int(os.environ['REMDIS_TORCH_THREADS']))
+
+# 受信・音声合成・送信をイベントループ上のタスクとして実行し，
+# 音声合成 (ブロッキング処理) のみスレッドプールで実行する
+class TTS(AsyncRemdisModule):
+    # 音声合成モデルの読み込み・ウォームアップ後に準備完了
+    ready_after_warmup = True
+
     def __init__(self, 
                  pub_exchanges=['tts'],
                  sub_exchanges=['dialogue']):
@@ -28,8 +35,9 @@ class TTS(RemdisModule):
         self.sample_width = self.config['TTS']['sample_width']
         self.chunk_size = round(self.frame_length * self.rate)
 
-        self.input_iu_buffer = queue.Queue()
-        self.output_iu_buffer = queue.Queue()
+        # 制御用のIU (COMMIT・REVOKEなど) を含むため破棄せずに空きを待つ
+        self.input_iu_buffer = self.mk_queue('input_iu_buffer', 100, RemdisQueuePolicy.BLOCK)
+        self.output_iu_buffer = self.mk_queue('output_iu_buffer', 200, RemdisQueuePolicy.BLOCK)
         self.engine_name = self.config['TTS']['engine_name']
         self.model_name = self.config['TTS']['model_name']
         if self.engine_name == 'ttslearn':
@@ -39,91 +47,100 @@ class TTS(RemdisModule):
         self.is_revoked = False
         self._is_running = True
 
-    def run(self):
-        # メッセージ受信スレッド
-        t1 = threading.Thread(target=self.listen_loop)
-        # 音声合成処理スレッド
-        t2 = threading.Thread(target=self.synthesis_loop)
-        # メッセージ送信スレッド
-        t3 = threading.Thread(target=self.send_loop)
-
-        # スレッド実行
-        t1.start()
-        t2.start()
-        t3.start()
-
-        t1.join()
-        t2.join()
-        t3.join()
-
-    def listen_loop(self):
-        self.subscribe('dialogue', self.callback)
-
-    def send_loop(self):
+        # ウォームアップ (初回の合成は遅いため短いテキストを1回合成)
+        if self.engine_name == 'ttslearn':
+            self.engine.tts('あ')
+        elif self.engine_name == 'openjtalk':
+            pyopenjtalk.tts('あ')
+        self.notify_ready()
+
+    # ハンドラ・タスクの登録
+    async def main(self):
+        await self.subscribe_async('dialogue', self.callback)
+        # 音声合成処理タスク
+        self.create_task(self.synthesis_loop())
+        # メッセージ送信タスク
+        self.create_task(self.send_loop())
+
+    async def send_loop(self):
         # 音声データをチャンクごとに送信
         while True:
             # REVOKEされた場合は送信を停止 (= ユーザ割り込み時の処理)
             if self.is_revoked:
-                self.output_iu_buffer = queue.Queue()
+                self.output_iu_buffer.clear()
                 self.send_commitIU('tts')
                 
-            snd_iu = self.output_iu_buffer.get(block=True)
-            self.publish(snd_iu, 'tts')
+            snd_iu = await self.output_iu_buffer.get()
+            await self.publish_async(snd_iu, 'tts')
 
             # チャンクの間隔ごとに送信を実行(音が切れるので少し早い間隔で送信)
-            time.sleep(self.send_interval)
+            await asyncio.sleep(self.send_interval)
 
             # システム発話終端まで送信した場合の処理
             if snd_iu['update_type'] == RemdisUpdateType.COMMIT:
                 self.send_commitIU('tts')
 
-    def synthesis_loop(self):
+    async def synthesis_loop(self):
         while True:
             if self.is_revoked:
-                self.input_iu_buffer = queue.Queue()
+                self.input_iu_buffer.clear()
 
             # 入力バッファから受信したIUを取得
-            in_msg = self.input_iu_buffer.get(block=True)
+            in_msg = await self.input_iu_buffer.get()
             output_text = in_msg['body']
             tgt_id = in_msg['id']
             update_type = in_msg['update_type']
 
             x = numpy.array([])
-            sr = 0
             sleep_time = 0
+            synthesis_start_time = time.time()
 
             if output_text != '':
-                # 音声合成
-                if self.engine_name == 'ttslearn':
-                    x, sr = self.engine.tts(output_text)
-                elif self.engine_name == 'openjtalk':
-                    x, sr = pyopenjtalk.tts(output_text, half_tone=-3.0)
-                else:
-                    sys.stderr.write('Currently, ttslearn and openjtalk are acceptable as a tts engine.')
-
-                # MMDAgent-EXの仕様に合わせて音声をダウンサンプリング
-                x = librosa.resample(x.astype(numpy.float32),
-                                     orig_sr=sr,
-                                     target_sr=self.rate)
+                # 音声合成 (合成中も受信・送信を続けるためスレッドプールで実行)
+                x = await self.run_in_thread(self.synthesize, output_text)
+
+                # 実時間比 (合成時間 / 音声長)
+                if len(x) > 0:
+                    synthesis_time = time.time() - synthesis_start_time
+                    self.metrics.observe('tts_synthesis_seconds', synthesis_time)
+                    self.metrics.set_gauge('tts_real_time_factor',
+                                           synthesis_time / (len(x) / self.rate))
                 
                 # チャンクに分割して出力バッファに格納
                 t = 0
                 while t <= len(x):
                     chunk = x[t:t+self.chunk_size]
-                    chunk = base64.b64encode(chunk.astype(numpy.int16).tobytes()).decode('utf-8')
+                    chunk = chunk.astype(numpy.int16).tobytes()
                     snd_iu = self.createIU(chunk, 'tts',
-                                           update_type)
+                                           update_type, [in_msg])
+                    self.add_hop(snd_iu, 'synthesis_start', synthesis_start_time)
                     snd_iu['data_type'] = 'audio'
-                    self.output_iu_buffer.put(snd_iu)
+                    await self.output_iu_buffer.put(snd_iu)
                     t += self.chunk_size
             else:
                 # テキストがない場合も処理を実施
                 x = numpy.zeros(self.chunk_size)
-                chunk = base64.b64encode(x.astype(numpy.int16).tobytes()).decode('utf-8')
+                chunk = x.astype(numpy.int16).tobytes()
                 snd_iu = self.createIU(chunk, 'tts',
-                                       update_type)
+                                       update_type, [in_msg])
+                self.add_hop(snd_iu, 'synthesis_start', synthesis_start_time)
                 snd_iu['data_type'] = 'audio'
-                self.output_iu_buffer.put(snd_iu)
+                await self.output_iu_buffer.put(snd_iu)
+
+    # テキストを音声合成し，MMDAgent-EXの仕様に合わせてダウンサンプリングした音声を返す
+    def synthesize(self, output_text):
+        x = numpy.array([])
+        sr = 0
+        if self.engine_name == 'ttslearn':
+            x, sr = self.engine.tts(output_text)
+        elif self.engine_name == 'openjtalk':
+            x, sr = pyopenjtalk.tts(output_text, half_tone=-3.0)
+        else:
+            sys.stderr.write('Currently, ttslearn and openjtalk are acceptable as a tts engine.')
+
+        return librosa.resample(x.astype(numpy.float32),
+                                orig_sr=sr,
+                                target_sr=self.rate)
 
     # 発話終了時のメッセージ送信関数
     def send_commitIU(self, channel):
@@ -133,17 +150,16 @@ class TTS(RemdisModule):
         self.printIU(snd_iu)
         self.publish(snd_iu, channel)
 
-    # メッセージ受信用コールバック関数
-    def callback(self, ch, method, properties, in_msg):
-        in_msg = self.parse_msg(in_msg)
+    # メッセージ受信用ハンドラ (入力バッファが一杯の場合は空きを待つ)
+    async def callback(self, in_msg):
         self.printIU(in_msg)
         
         # システム発話のupdate_typeを監視
         if in_msg['update_type'] == RemdisUpdateType.REVOKE:
             self.is_revoked = True
         else:
-            self.input_iu_buffer.put(in_msg)
             self.is_revoked = False
+            await self.input_iu_buffer.put(in_msg)
 
 def main():
     tts = TTS()
@@ -0,0 +1,261 @@
+import sys, os
+import time
+import argparse
+import functools
+import threading
+
+import numpy
+import torch
+import torch.nn as nn
+
+from base import RemdisModule, RemdisUpdateType, RemdisQueuePolicy
+from audio_vap import AudioRingBuffer, device
+from _audio_vap.optimized import load_checkpoint_model
+
+# 1つのVAPモデルで複数の対話セッションのターンテイキングを推論するサーバ
+# セッションごとの音声 (ain@<セッション名>, tts@<セッション名>) をバッファに格納し，
+# 推論の周期ごとに新たな音声を受信したセッションをまとめて1回のバッチで推論する
+# 結果はセッションごとにvap@<セッション名>, score@<セッション名>に送信する
+# 各セッションのモジュール (audio_vap.py以外) は環境変数REMDIS_SESSIONにセッション名を指定して起動する
+
+# セッションごとの音声バッファと判定結果
+class VAPSession:
+    def __init__(self, name, buffer_size, ss_msg_buffer):
+        self.name = name
+        self.us_audio_buffer = AudioRingBuffer(buffer_size)
+        self.ss_audio_buffer = AudioRingBuffer(buffer_size)
+        self.ss_msg_buffer = ss_msg_buffer
+        # 推論済みのユーザ音声のサンプル数
+        self.processed_samples = 0
+        self.inference_time = 0.0
+        self.prev_event = None
+
+    # 前回の推論以降にユーザ音声を受信したかどうか
+    def is_ready(self):
+        return self.us_audio_buffer.total > self.processed_samples
+
+class VAPServer(RemdisModule):
+    # VAPモデルの読み込み・ウォームアップ後に準備完了
+    ready_after_warmup = True
+
+    def __init__(self, sessions=None):
+        # セッションごとのexchangeを送受信するため，先に設定ファイルからセッション名を取得
+        config = self.load_config(os.environ.get('REMDIS_CONFIG', '../config/config.yaml'))
+        self.session_names = sessions or config['VAP_SERVER']['sessions']
+
+        pub_exchanges = []
+        sub_exchanges = []
+        for name in self.session_names:
+            pub_exchanges += ['vap@' + name, 'score@' + name]
+            sub_exchanges += ['ain@' + name, 'tts@' + name]
+        super().__init__(pub_exchanges=pub_exchanges,
+                         sub_exchanges=sub_exchanges)
+
+        # VAP用変数
+        self.model_name = self.config['VAP']['model_filename']
+        self.buffer_length = self.config['VAP']['buffer_length']
+        self.threshold = self.config['VAP']['threshold']
+        self.hop_frames = self.config['VAP']['hop_frames']
+        self.sample_rate = self.config['TTS']['sample_rate']
+        self.buffer_size = int(self.buffer_length * self.sample_rate)
+        self.tts_frame_length = self.config['TTS']['frame_length']
+
+        # バッチ化の設定
+        # max_batch: 1回の推論でまとめるセッション数の上限
+        # max_wait: 推論の周期の開始から他のセッションの音声を待つ時間 (sec)
+        # quantize: 線形層・LSTMをint8に動的量子化 (CPUで推論)
+        self.max_batch = self.config['VAP_SERVER']['max_batch']
+        self.max_wait = self.config['VAP_SERVER']['max_wait']
+        self.quantize = self.config['VAP_SERVER']['quantize']
+
+        self.sessions = [VAPSession(name, self.buffer_size,
+                                    self.mk_queue('ss_msg_buffer.' + name, 100,
+                                                  RemdisQueuePolicy.DROP_OLDEST))
+                         for name in self.session_names]
+        # ユーザ音声の受信を推論スレッドに通知
+        self.audio_event = threading.Event()
+
+        self._is_running = True
+
+    def run(self):
+        threads = []
+        for session in self.sessions:
+            # ユーザ発話・システム発話受信スレッド
+            threads.append(threading.Thread(target=self.subscribe,
+                                            args=('ain@' + session.name,
+                                                  functools.partial(self.us_callback, session))))
+            threads.append(threading.Thread(target=self.subscribe,
+                                            args=('tts@' + session.name,
+                                                  functools.partial(self.ss_callback, session))))
+        # システム発話構築スレッド
+        threads.append(threading.Thread(target=self.ss_buffering_loop))
+        # VAP実行スレッド
+        threads.append(threading.Thread(target=self.vap_loop))
+
+        # スレッド実行
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    # 全セッションのシステム発話をTTSのフレーム長に同期してバッファに格納 (Audio_VAPと同じ)
+    def ss_buffering_loop(self):
+        delay_time = 0.0
+        while True:
+            start_time = time.time()
+            for session in self.sessions:
+                if session.ss_msg_buffer.empty():
+                    # ない場合は遅延時間とTTSのフレーム長を合わせた分の無音を格納
+                    chunk_size = int((delay_time + self.tts_frame_length) * self.sample_rate)
+                    session.ss_audio_buffer.write(numpy.zeros(chunk_size, dtype=numpy.float32))
+                    continue
+                # システム発話がキューにあったら全てバッファに格納
+                while not session.ss_msg_buffer.empty():
+                    session.ss_audio_buffer.write(session.ss_msg_buffer.get())
+            delay_time = 0.0
+
+            # TTSのフレーム長に同期してループ
+            proc_time = time.time() - start_time
+            sleep_time = self.tts_frame_length - proc_time
+            if sleep_time > 0:
+                time.sleep(sleep_time)
+            delay_time += proc_time
+
+    def load_model(self):
+        model = load_checkpoint_model(self.model_name, map_location='cpu')
+        if self.quantize:
+            # 量子化したモデルはCPUのみで推論
+            model = torch.ao.quantization.quantize_dynamic(
+                model, {nn.Linear, nn.LSTM, nn.GRU}, dtype=torch.qint8)
+            return model, torch.device('cpu')
+        return model.to(device), device
+
+    def vap_loop(self):
+        # VAPモデルの読み込み
+        model, model_device = self.load_model()
+        sys.stderr.write('Load VAP model: %s\n' % (self.model_name))
+        sys.stderr.write('Device: %s, sessions: %s\n' % (model_device, ', '.join(self.session_names)))
+
+        # 推論の入力バッファ (input_tensorはinput_audioとメモリを共有)
+        max_batch = min(self.max_batch, len(self.sessions))
+        input_audio = numpy.zeros((max_batch, 2, self.buffer_size), dtype=numpy.float32)
+        input_tensor = torch.from_numpy(input_audio)
+
+        # ウォームアップ (最大のバッチサイズで1回推論)
+        with torch.no_grad():
+            model.probs(input_tensor.to(model_device))
+        self.notify_ready()
+
+        # モデルのフレームに同期した一定間隔で推論
+        # 推論が間に合わなかった周期は後から実行せずに飛ばし，その数を記録
+        period = self.hop_frames / model.frame_hz
+        next_tick = time.monotonic()
+        while True:
+            wait_time = next_tick - time.monotonic()
+            if wait_time > 0:
+                time.sleep(wait_time)
+            missed_ticks = int((time.monotonic() - next_tick) // period)
+            if missed_ticks > 0:
+                self.metrics.inc('vap_overrun_ticks', missed_ticks)
+            next_tick += (missed_ticks + 1) * period
+            self.metrics.inc('vap_ticks')
+
+            # 新たな音声を受信したセッションがmax_batchに達するかmax_waitが経過するまで待つ
+            deadline = time.monotonic() + self.max_wait
+            while True:
+                self.audio_event.clear()
+                ready_sessions = [session for session in self.sessions if session.is_ready()]
+                wait_time = deadline - time.monotonic()
+                if len(ready_sessions) >= max_batch or wait_time <= 0:
+                    break
+                self.audio_event.wait(wait_time)
+            if not ready_sessions:
+                continue
+
+            # 前回の推論が古いセッションから順にmax_batchずつ推論
+            ready_sessions.sort(key=lambda session: session.inference_time)
+            for i in range(0, len(ready_sessions), max_batch):
+                self.infer(model, model_device, ready_sessions[i:i + max_batch],
+                           input_audio, input_tensor)
+
+    def infer(self, model, model_device, sessions, input_audio, input_tensor):
+        # 各セッションの両話者のデータを入力バッファにコピーしてバッチを作成
+        for i, session in enumerate(sessions):
+            session.processed_samples = session.us_audio_buffer.total
+            session.ss_audio_buffer.copy_to(input_audio[i, 0])
+            session.us_audio_buffer.copy_to(input_audio[i, 1])
+        batch = input_tensor[:len(sessions)].to(model_device)
+
+        # 推論
+        inference_start_time = time.perf_counter()
+        out = model.probs(batch)
+        self.metrics.observe('vap_inference_seconds', time.perf_counter() - inference_start_time)
+        self.metrics.observe('vap_batch_size', len(sessions))
+
+        # 最終フレームの結果を判定に利用
+        p_ns = out['p_now'][:, -1].cpu()
+        p_fs = out['p_future'][:, -1].cpu()
+        inference_time = time.monotonic()
+        for i, session in enumerate(sessions):
+            session.inference_time = inference_time
+            score_n = p_ns[i].item()
+            score_f = p_fs[i].item()
+
+            # イベントの判定
+            event = None
+            if score_n >= self.threshold and score_f >= self.threshold:
+                event = 'SYSTEM_TAKE_TURN'
+            if score_n < self.threshold and score_f < self.threshold:
+                event = 'USER_TAKE_TURN'
+
+            # メッセージの発出
+            # 可視化用スコア
+            score = {'p_now': score_n,
+                     'p_future': score_f}
+            snd_iu = self.createIU(score, 'score@' + session.name,
+                                   RemdisUpdateType.ADD)
+            self.publish(snd_iu, 'score@' + session.name)
+
+            # 変化があった時のみイベントを発出
+            if event and event != session.prev_event:
+                snd_iu = self.createIU(event, 'vap@' + session.name,
+                                       RemdisUpdateType.ADD)
+                print('%s n:%.3f, f:%.3f, %s' % (session.name,
+                                                 score_n,
+                                                 score_f,
+                                                 event))
+                # ターンテイキングイベントは送信待ちのスコアより先に送信
+                self.publish(snd_iu, 'vap@' + session.name, priority=True)
+                session.prev_event = event
+
+    def us_callback(self, session, ch, method, properties, in_msg):
+        in_msg = self.parse_msg(in_msg)
+        chunk = self.decode_audio(in_msg['body'])
+        chunk = numpy.frombuffer(chunk, dtype=numpy.int16)
+        # 振幅を-1.0から1.0の範囲に正規化
+        chunk = chunk.astype(numpy.float32) / 32768.0
+        session.us_audio_buffer.write(chunk)
+        self.audio_event.set()
+
+    def ss_callback(self, session, ch, method, properties, in_msg):
+        in_msg = self.parse_msg(in_msg)
+        # ADD以外 (COMMITなど) は音声を取り出さずに破棄
+        if in_msg['update_type'] != RemdisUpdateType.ADD:
+            return
+        chunk = self.decode_audio(in_msg['body'])
+        chunk = numpy.frombuffer(chunk, dtype=numpy.int16)
+        # 振幅を-1.0から1.0の範囲に正規化
+        chunk = chunk.astype(numpy.float32) / 32768.0
+        session.ss_msg_buffer.put(chunk)
+
+def main():
+    parser = argparse.ArgumentParser(description='Batched VAP inference for multiple sessions')
+    parser.add_argument('--sessions', default=None,
+                        help='comma separated session names (default: VAP_SERVER.sessions)')
+    args = parser.parse_args()
+
+    server = VAPServer(args.sessions.split(',') if args.sessions else None)
+    server.run()
+
+if __name__ == '__main__':
+    main()